@@ -1,38 +1,75 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, session, abort
+from flask import Flask, render_template, request, redirect, url_for, session, abort, jsonify, Response, stream_with_context
 import os
+import logging
+import math
 import secrets
+import time
 import datetime
-import redis
+import csv
+import hashlib
+import io
+import config
 import redis_db as db # 引入 Redis 資料庫操作模組
+import metrics
+import live_updates
+import queue
 import re # 用於正規表達式驗證
 from functools import wraps # <<< 修正：新增這行來引入正確的 wraps 函式
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # --- Flask 設定 ---
 app = Flask(__name__)
-# 使用 secrets 模組產生安全密鑰
-app.secret_key = secrets.token_hex(16) 
+# 使用 secrets 模組產生安全密鑰 (多個 worker 時請以 SECRET_KEY 環境變數設定相同的密鑰，否則登入狀態無法共用)
+app.secret_key = config.SECRET_KEY or secrets.token_hex(16) 
 app.config['JSON_AS_ASCII'] = False # 確保中文正常顯示
-
-# --- Redis 連線設定 (請替換為您的連線資訊) ---
-# ⚠️ 請將這裡替換成您的 Redis 連線資訊 ⚠️
-REDIS_HOST = 'redis-13609.c16.us-east-1-2.ec2.cloud.redislabs.com' # 請替換
-REDIS_PORT = 13609 # 請替換
-REDIS_PASSWORD = 'B0clHH6UC4SQf3FeWmAls9FJEArApTxQ' # 請替換
-
-# 連線到 Redis
-try:
-    # 注意：如果您的 Redis 伺服器在遠端，請確保您的環境允許出站連線。
-    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, decode_responses=True)
-    r.ping()
-    print("成功連線到 Redis！")
-except Exception as e:
-    print(f"Redis 連線失敗: {e}")
-    # 在實際應用中，這裡可能需要更優雅的處理
-
-# 啟動時初始化資料庫
-db.init_redis(r)
+if config.PROXY_FIX_X_FOR:
+    # 位於反向代理之後時，以 X-Forwarded-For 取得用戶端 IP (限流使用)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.PROXY_FIX_X_FOR)
+if config.REDIS_DEBUG_HEADERS:
+    app.logger.setLevel(logging.INFO) # 輸出每個請求的 Redis 使用量
+
+# --- Redis 連線設定 (由環境變數設定，詳見 config.py) ---
+# 建立客戶端時不會實際連線；每個 gunicorn worker 在 fork 後的第一個請求才建立連線並初始化資料
+r = db.create_client(**config.redis_client_options())
+db.init_redis(r, replica_clients=[db.create_client(**options) for options in config.redis_replica_options()],
+              replica_max_lag=config.REDIS_REPLICA_MAX_LAG)
+
+# 報名人數即時更新：每個 worker 共用一個 Redis 訂閱 (見 live_updates.py)
+event_hub = live_updates.EventHub(lambda: db.r, db.SLOT_EVENTS_CHANNEL)
+
+@app.context_processor
+def inject_live_updates():
+    """模板是否啟用即時更新 (首頁與報名頁的 EventSource)"""
+    return {'live_updates': config.LIVE_UPDATES_ENABLED}
+
+@app.before_request
+def start_redis_metrics():
+    """開始統計此請求的 Redis 往返次數與時間"""
+    metrics.start_request()
+
+@app.after_request
+def record_redis_metrics(response):
+    """依 endpoint 記錄此請求的 Redis 使用量；開啟 REDIS_DEBUG_HEADERS 時加上除錯標頭"""
+    stats = metrics.finish_request(request.endpoint or 'unknown')
+    if stats and config.REDIS_DEBUG_HEADERS:
+        redis_ms = stats['seconds'] * 1000
+        response.headers['X-Redis-Roundtrips'] = str(stats['roundtrips'])
+        response.headers['X-Redis-Commands'] = str(stats['commands'])
+        response.headers['X-Redis-Time-Ms'] = f"{redis_ms:.2f}"
+        app.logger.info("%s %s: Redis 往返 %d 次 / %d 個指令 / %.2f ms", request.method, request.path,
+                        stats['roundtrips'], stats['commands'], redis_ms)
+    return response
+
+@app.before_request
+def ensure_redis_initialized():
+    """確認資料遷移已套用 (遷移於部署時以 manage.py migrate 執行；尚未套用時直接返回 503)"""
+    try:
+        db.ensure_initialized()
+    except db.MigrationRequiredError as e:
+        app.logger.error("%s", e)
+        return render_template('error.html', title="系統維護中", message="系統正在更新，請稍後再試。"), 503
 
 # --- 裝飾器：登入檢查 ---
 def login_required(f):
@@ -44,12 +81,74 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- 裝飾器：限流與負載控制 ---
+
+# 排隊報名佇列長度的 process 內快取 (秒)，避免每個請求都查詢一次 XINFO
+QUEUE_DEPTH_CACHE_TTL = 1
+_queue_depth_cache = {'value': 0, 'expires_at': 0}
+
+def _booking_queue_depth():
+    """獲取排隊報名佇列長度 (使用短暫快取)"""
+    now = time.monotonic()
+    if now >= _queue_depth_cache['expires_at']:
+        _queue_depth_cache['value'] = db.get_booking_queue_length()
+        _queue_depth_cache['expires_at'] = now + QUEUE_DEPTH_CACHE_TTL
+    return _queue_depth_cache['value']
+
+def _rate_limit_identity(kind):
+    """返回限流規則的識別值 (無法識別時返回 None，該規則不套用)"""
+    if kind == 'ip':
+        return request.remote_addr
+    if request.method != 'POST':
+        return None
+    if kind == 'employee':
+        name = request.form.get('name')
+        id_last_4 = request.form.get('id_last_4')
+        return db._employee_lookup_field(name, id_last_4) if name and id_last_4 else None
+    if kind == 'username':
+        return request.form.get('username') or None
+    return None
+
+def _too_many_requests(reason, retry_after, message):
+    """直接返回 429 頁面 (不再存取 Redis)"""
+    metrics.REQUESTS_REJECTED.labels(request.endpoint, reason).inc()
+    response = app.make_response((render_template('error.html', title="請求過於頻繁", message=message), 429))
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def rate_limited(f):
+    """依 config.RATE_LIMITS 對此 endpoint 限流；Redis 延遲或排隊佇列超過門檻時直接返回 429"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not config.RATE_LIMIT_ENABLED:
+            return f(*args, **kwargs)
+
+        # 1. 負載控制：Redis 已經變慢或佇列過長時，不再增加 Redis 的負擔
+        if metrics.redis_latency() * 1000 > config.SHED_REDIS_LATENCY_MS:
+            return _too_many_requests('redis_latency', 1, "系統目前忙碌，請稍後再試。")
+        if (request.method == 'POST' and config.BOOKING_MODE == 'queue'
+                and _booking_queue_depth() > config.SHED_QUEUE_DEPTH):
+            return _too_many_requests('queue_depth', 5, "目前報名人數眾多，請稍後再試。")
+
+        # 2. 限流：所有規則以單次原子腳本檢查
+        rules = []
+        for kind, (limit, window) in config.RATE_LIMITS.get(request.endpoint, {}).items():
+            identity = _rate_limit_identity(kind)
+            if identity:
+                rules.append((f'{request.endpoint}:{kind}', identity, limit, window))
+        retry_after = db.check_rate_limit(rules)
+        if retry_after:
+            return _too_many_requests('rate_limit', retry_after,
+                                      f"操作過於頻繁，請於 {math.ceil(retry_after)} 秒後再試。")
+        return f(*args, **kwargs)
+    return decorated_function
+
 # --- 前台報名介面 ---
 
 @app.route('/')
 def index():
-    """首頁：顯示可報名天數/班別"""
-    open_slots = db.get_open_slots() 
+    """首頁：顯示可報名天數/班別 (使用 process 內快取，減少重複讀取 Redis)"""
+    open_slots = db.get_open_slots_cached()
     return render_template('index.html', slots=open_slots)
 
 
@@ -82,6 +181,7 @@ def new_employee():
 
 
 @app.route('/signup/<slot_id>', methods=['GET', 'POST'])
+@rate_limited
 def signup(slot_id):
     """報名表單及處理邏輯"""
     slot = db.get_slot_by_id(slot_id)
@@ -101,6 +201,10 @@ def signup(slot_id):
 
         if not employee_id:
             error = "員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。"
+        elif config.BOOKING_MODE == 'queue':
+            # 2. 排隊模式：加入報名佇列並立即返回 ticket，由 booking_worker.py 依序處理
+            ticket = db.enqueue_booking(slot_id, date_str, slot_name, employee_id, name, id_last_4)
+            return redirect(url_for('signup_pending', ticket=ticket))
         else:
             # 2. 嘗試報名
             success, msg = db.add_booking(slot_id, date_str, employee_id, name, id_last_4)
@@ -124,6 +228,54 @@ def signup(slot_id):
                            slot=slot,
                            error=error)
 
+@app.route('/signup_batch', methods=['POST'])
+@rate_limited
+def signup_batch():
+    """一次報名首頁勾選的多個班別 (員工只驗證一次，所有班別以單一原子腳本報名)"""
+    slot_ids = request.form.getlist('slot_ids')
+    name = request.form.get('name')
+    id_last_4 = request.form.get('id_last_4')
+    all_or_nothing = request.form.get('all_or_nothing') == 'on'
+
+    if not slot_ids:
+        return render_template('signup_batch.html', error="請至少勾選一個班別。")
+    if len(slot_ids) > config.SIGNUP_BATCH_MAX_SLOTS:
+        return render_template('signup_batch.html', error=f"一次最多報名 {config.SIGNUP_BATCH_MAX_SLOTS} 個班別。")
+
+    employee_id, _ = db.get_employee_by_info(name, id_last_4)
+    if not employee_id:
+        return render_template('signup_batch.html',
+                               error="員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。")
+
+    # 排隊模式下也直接執行：整批報名只是一次腳本呼叫
+    results = db.add_bookings(slot_ids, employee_id, all_or_nothing=all_or_nothing)
+    return render_template('signup_batch.html', name=name, results=results, all_or_nothing=all_or_nothing)
+
+@app.route('/signup/pending/<ticket>')
+def signup_pending(ticket):
+    """排隊報名等待頁面 (瀏覽器會定期查詢 signup_status 直到有結果)"""
+    booking = db.get_booking_ticket(ticket)
+    if not booking:
+        return render_template('error.html', title="查無報名紀錄", message="報名紀錄不存在或已過期，請重新報名。")
+
+    return render_template('signup_pending.html', ticket=ticket, booking=booking)
+
+@app.route('/signup/status/<ticket>')
+def signup_status(ticket):
+    """排隊報名結果查詢 (JSON)：status 為 pending / success / failed"""
+    booking = db.get_booking_ticket(ticket)
+    if not booking:
+        return jsonify({'status': 'missing', 'message': "報名紀錄不存在或已過期，請重新報名。"}), 404
+
+    result = {'status': booking['status'], 'message': booking.get('message')}
+    if booking['status'] == 'success':
+        result['redirect'] = url_for('success_page',
+                                     slot_id=booking['slot_id'],
+                                     name=booking['name'],
+                                     date_str=booking['work_date'],
+                                     slot_name=booking['slot_name'])
+    return jsonify(result)
+
 @app.route('/success')
 def success_page():
     """報名成功頁面"""
@@ -136,9 +288,142 @@ def success_page():
 
     return render_template('success.html', name=name, date_str=date_str, slot_name=slot_name)
 
+# --- 員工自助：我的班別 ---
+
+@app.route('/my_shifts', methods=['GET', 'POST'])
+@rate_limited
+def my_shifts():
+    """員工以姓名與身分證後四碼驗證後，查看自己即將到來的班別 (固定兩次 Redis 往返)"""
+    error = None
+    if request.method == 'POST':
+        name = request.form.get('name')
+        id_last_4 = request.form.get('id_last_4')
+        employee_id, _ = db.get_employee_by_info(name, id_last_4)
+        if employee_id:
+            session['employee_id'] = employee_id
+            session['employee_name'] = name
+            return redirect(url_for('my_shifts'))
+        error = "員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。"
+
+    employee_id = session.get('employee_id')
+    if not employee_id:
+        return render_template('my_shifts.html', shifts=None, error=error)
+
+    return render_template('my_shifts.html',
+                           shifts=db.get_employee_shifts(employee_id),
+                           name=session.get('employee_name'),
+                           message=request.args.get('message'))
+
+@app.route('/my_shifts/cancel/<slot_id>', methods=['POST'])
+@rate_limited
+def my_shifts_cancel(slot_id):
+    """員工取消自己即將到來的班別"""
+    employee_id = session.get('employee_id')
+    if not employee_id:
+        return redirect(url_for('my_shifts'))
+
+    slot = db.get_slot_by_id(slot_id)
+    if not slot or slot['work_date'] < datetime.date.today().isoformat():
+        message = "該班別不存在或已結束，無法取消。"
+    elif db.delete_booking(slot_id, employee_id):
+        message = f"已取消 {slot['work_date']} {slot['slot_name']} 的報名。"
+    else:
+        message = "您未報名此班別。"
+    return redirect(url_for('my_shifts', message=message))
+
+@app.route('/my_shifts/logout')
+def my_shifts_logout():
+    """員工登出"""
+    session.pop('employee_id', None)
+    session.pop('employee_name', None)
+    return redirect(url_for('my_shifts'))
+
+# --- JSON API (資訊看板與排班工具使用) ---
+# 回應帶有由版本號組成的 ETag；帶 If-None-Match 的請求只讀取版本號 (一次 Redis 往返)，未異動時直接返回 304
+
+def api_login_required(f):
+    """JSON API 版的 login_required：未登入時返回 401 而不是導向登入頁面"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'logged_in' not in session:
+            return jsonify({'error': "請先登入管理員帳號。"}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _api_slot(slot):
+    """班別的 JSON 表示"""
+    return {
+        'id': slot['id'],
+        'work_date': slot['work_date'],
+        'slot_name': slot['slot_name'],
+        'capacity': slot['capacity'],
+        'booked': slot['current_bookings'],
+        'is_open': slot['is_open'],
+    }
+
+def _open_slots_etag(today, version):
+    # 開放班別只列出今天以後的場次，日期改變時列表也可能不同
+    return 'slots-' + hashlib.sha1(repr((today, version)).encode('utf-8')).hexdigest()[:16]
+
+def _not_modified(etag):
+    """If-None-Match 包含 etag 時返回 304 回應，否則返回 None"""
+    if etag not in request.if_none_match:
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+def _api_response(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # 每次使用前都要以 If-None-Match 重新確認
+    return response
+
+@app.route('/api/slots')
+def api_open_slots():
+    """開放報名的班別 (同首頁，依日期排序)"""
+    today = datetime.date.today().isoformat()
+    if request.if_none_match:
+        not_modified = _not_modified(_open_slots_etag(today, db.get_slots_version()))
+        if not_modified:
+            return not_modified
+
+    version, slots = db.get_open_slots_with_version()
+    return _api_response({'slots': [_api_slot(slot) for slot in slots]}, _open_slots_etag(today, version))
+
+@app.route('/api/slots/<slot_id>')
+def api_slot(slot_id):
+    """單一班別的資料與報名人數"""
+    if request.if_none_match:
+        version = db.get_slot_version(slot_id)
+        not_modified = version is not None and _not_modified(f'slot-{slot_id}-{version}')
+        if not_modified:
+            return not_modified
+
+    slot = db.get_slot_by_id(slot_id, replica=True)
+    if not slot:
+        return jsonify({'error': "該班別不存在。"}), 404
+    return _api_response(_api_slot(slot), f"slot-{slot_id}-{slot['version']}")
+
+@app.route('/api/slots/<slot_id>/bookings')
+@api_login_required
+def api_slot_bookings(slot_id):
+    """班別的報名名單 (依報名順序，需登入管理員帳號)"""
+    if request.if_none_match:
+        version = db.get_slot_version(slot_id)
+        not_modified = version is not None and _not_modified(f'bookings-{slot_id}-{version}')
+        if not_modified:
+            return not_modified
+
+    version, bookings = db.get_bookings_with_version(slot_id)
+    if version is None:
+        return jsonify({'error': "該班別不存在。"}), 404
+    return _api_response({'slot_id': slot_id, 'bookings': bookings}, f'bookings-{slot_id}-{version}')
+
 # --- 管理員後台介面 ---
 
 @app.route('/admin/login', methods=['GET', 'POST'])
+@rate_limited
 def admin_login():
     """管理員登入頁面"""
     error = None
@@ -229,11 +514,33 @@ def admin_logout():
 @app.route('/admin/dashboard')
 @login_required
 def admin_dashboard():
-    """管理員儀表板：顯示所有班別和摘要名單"""
-    slots = db.get_all_slots()
-    
+    """管理員儀表板：依日期區間分頁顯示班別與報名人數 (名單在展開時才讀取)"""
+    default_start = datetime.date.today() - datetime.timedelta(days=config.DASHBOARD_DAYS_BEFORE)
+    start_date = request.args.get('start_date', default_start.isoformat())
+    end_date = request.args.get('end_date', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = request.args.get('page_size', config.DASHBOARD_PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), config.DASHBOARD_MAX_PAGE_SIZE)
+
+    # 空白的日期代表不限
+    try:
+        for value in (start_date, end_date):
+            if value:
+                datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return render_template('error.html', title="查詢失敗", message="日期格式必須為 YYYY-MM-DD。"), 400
+
+    slots, total = db.get_slots_page(start_date or None, end_date or None,
+                                     offset=(page - 1) * page_size, count=page_size)
+
     return render_template('admin_dashboard.html', 
                            slots=slots,
+                           total=total,
+                           page=page,
+                           page_count=max(math.ceil(total / page_size), 1),
+                           page_size=page_size,
+                           start_date=start_date,
+                           end_date=end_date,
                            user_role=session.get('user_role'))
 
 @app.route('/admin/add_slot', methods=['GET', 'POST'])
@@ -279,6 +586,255 @@ def admin_add_slot():
                            is_new=True, 
                            user_role=session.get('user_role'))
 
+# 批次新增班別的上限 (避免單一請求建立過多資料)
+BULK_SLOT_LIMIT = 5000
+WEEKDAY_NAMES = ['一', '二', '三', '四', '五', '六', '日']
+
+def _parse_bulk_capacity(value):
+    """解析批次新增時的容量欄位，格式錯誤時拋出 ValueError"""
+    try:
+        capacity = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("容量必須為整數")
+    if capacity < 1:
+        raise ValueError("容量必須大於 0")
+    return capacity
+
+def _expand_recurring_slots(start_date, end_date, weekdays, shift_lines, is_open):
+    """依日期區間 × 星期 × 班別範本展開班別列表，返回 (slots, errors)"""
+    errors = []
+    try:
+        start = datetime.date.fromisoformat(start_date)
+        end = datetime.date.fromisoformat(end_date)
+    except (TypeError, ValueError):
+        return [], ["日期格式錯誤，請使用 YYYY-MM-DD。"]
+    if end < start:
+        return [], ["結束日期不可早於開始日期。"]
+    if not weekdays:
+        errors.append("請至少選擇一個星期。")
+
+    # 班別範本：每行「班別名稱,容量」
+    shifts = []
+    for line_no, line in enumerate(shift_lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        slot_name, _, capacity_str = line.rpartition(',')
+        try:
+            if not slot_name.strip():
+                raise ValueError("班別名稱不可為空")
+            shifts.append((slot_name.strip(), _parse_bulk_capacity(capacity_str)))
+        except ValueError as e:
+            errors.append(f"班別範本第 {line_no} 行格式錯誤 ({e})，請使用「班別名稱,容量」。")
+    if not shifts and not errors:
+        errors.append("請至少輸入一個班別範本。")
+    if errors:
+        return [], errors
+
+    slots = []
+    day = start
+    while day <= end:
+        if day.weekday() in weekdays:
+            for slot_name, capacity in shifts:
+                slots.append({'work_date': day.isoformat(), 'slot_name': slot_name,
+                              'capacity': capacity, 'is_open': is_open})
+        day += datetime.timedelta(days=1)
+    return slots, []
+
+def _parse_slots_csv(file_storage):
+    """解析 CSV (欄位：work_date,slot_name,capacity[,is_open])，返回 (slots, errors)"""
+    slots = []
+    errors = []
+    reader = csv.DictReader(io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig'))
+    missing = {'work_date', 'slot_name', 'capacity'} - set(reader.fieldnames or [])
+    if missing:
+        return [], [f"CSV 缺少欄位：{', '.join(sorted(missing))}"]
+
+    for row_no, row in enumerate(reader, start=2): # 第 1 行為標題
+        try:
+            work_date = (row.get('work_date') or '').strip()
+            try:
+                datetime.date.fromisoformat(work_date)
+            except ValueError:
+                raise ValueError("日期格式錯誤，請使用 YYYY-MM-DD")
+            slot_name = (row.get('slot_name') or '').strip()
+            if not slot_name:
+                raise ValueError("slot_name 不可為空")
+            capacity = _parse_bulk_capacity(row.get('capacity'))
+            is_open = (row.get('is_open') or 'true').strip().lower() in ('1', 'true', 'yes', 'y', '是')
+        except ValueError as e:
+            errors.append(f"第 {row_no} 行：{e}")
+            continue
+        slots.append({'work_date': work_date, 'slot_name': slot_name, 'capacity': capacity, 'is_open': is_open})
+    return slots, errors
+
+@app.route('/admin/bulk_slots', methods=['GET', 'POST'])
+@login_required
+def admin_bulk_slots():
+    """管理員：依週期範本或 CSV 批次新增班別 (全部驗證通過後才寫入)"""
+    if session.get('user_role') != 'super':
+        return redirect(url_for('admin_dashboard'))
+
+    errors = []
+    success = None
+
+    if request.method == 'POST':
+        if request.form.get('mode') == 'csv':
+            csv_file = request.files.get('csv_file')
+            if not csv_file or not csv_file.filename:
+                slots, errors = [], ["請選擇要上傳的 CSV 檔案。"]
+            else:
+                slots, errors = _parse_slots_csv(csv_file)
+        else:
+            weekdays = {int(d) for d in request.form.getlist('weekdays') if d.isdigit()}
+            slots, errors = _expand_recurring_slots(request.form.get('start_date'),
+                                                    request.form.get('end_date'),
+                                                    weekdays,
+                                                    request.form.get('shifts', '').splitlines(),
+                                                    'is_open' in request.form)
+
+        if not errors and not slots:
+            errors = ["沒有符合條件的班別可新增。"]
+        elif not errors and len(slots) > BULK_SLOT_LIMIT:
+            errors = [f"單次最多新增 {BULK_SLOT_LIMIT} 個班別 (目前 {len(slots)} 個)，請縮小範圍。"]
+
+        if not errors:
+            slot_ids = db.add_slots_bulk(slots)
+            success = f"已成功新增 {len(slot_ids)} 個班別。"
+
+    today = datetime.date.today()
+    return render_template('admin_bulk_slots.html',
+                           errors=errors,
+                           success=success,
+                           weekday_names=WEEKDAY_NAMES,
+                           default_start=today.isoformat(),
+                           default_end=(today + datetime.timedelta(days=30)).isoformat(),
+                           user_role=session.get('user_role'))
+
+# 匯入結果頁面最多顯示的錯誤筆數 (完整錯誤請使用 manage.py import-employees)
+IMPORT_ERROR_DISPLAY_LIMIT = 200
+
+@app.route('/admin/import_employees', methods=['GET', 'POST'])
+@login_required
+def admin_import_employees():
+    """管理員：上傳 CSV 批次匯入員工 (串流讀取、分批寫入，並回報每一列的錯誤)"""
+    if session.get('user_role') != 'super':
+        return redirect(url_for('admin_dashboard'))
+
+    error = None
+    result = None
+
+    if request.method == 'POST':
+        csv_file = request.files.get('csv_file')
+        if not csv_file or not csv_file.filename:
+            error = "請選擇要上傳的 CSV 檔案。"
+        else:
+            reader = csv.DictReader(io.TextIOWrapper(csv_file.stream, encoding='utf-8-sig'))
+            missing = {'name', 'id_full', 'phone'} - set(reader.fieldnames or [])
+            if missing:
+                error = f"CSV 缺少欄位：{', '.join(sorted(missing))}"
+            else:
+                result = {'created': 0, 'failed': 0, 'errors': []}
+                for row_no, employee_id, message in db.import_employees(reader):
+                    if employee_id:
+                        result['created'] += 1
+                        continue
+                    result['failed'] += 1
+                    if len(result['errors']) < IMPORT_ERROR_DISPLAY_LIMIT:
+                        # 第 1 行為標題，資料列從第 2 行開始
+                        result['errors'].append(f"第 {row_no + 1} 行：{message}")
+
+    return render_template('admin_import_employees.html',
+                           error=error,
+                           result=result,
+                           error_limit=IMPORT_ERROR_DISPLAY_LIMIT,
+                           user_role=session.get('user_role'))
+
+# 員工搜尋每次最多返回的筆數
+EMPLOYEE_SEARCH_LIMIT = 10
+EMPLOYEE_SEARCH_MAX_LIMIT = 50
+
+@app.route('/admin/employees')
+@login_required
+def admin_employees():
+    """管理員：以姓名或電話前綴搜尋員工 (輸入時即時查詢 admin_search_employees)"""
+    query = request.args.get('q', '').strip()
+    employees = db.search_employees(query, limit=EMPLOYEE_SEARCH_LIMIT) if query else []
+    return render_template('admin_employees.html',
+                           query=query,
+                           employees=employees,
+                           limit=EMPLOYEE_SEARCH_LIMIT,
+                           message=request.args.get('message'),
+                           user_role=session.get('user_role'))
+
+@app.route('/admin/employees/search')
+@api_login_required
+def admin_search_employees():
+    """員工前綴搜尋 (JSON，供搜尋框即時查詢)：q 為姓名或電話開頭，limit 為筆數上限"""
+    limit = request.args.get('limit', EMPLOYEE_SEARCH_LIMIT, type=int)
+    limit = min(max(limit, 1), EMPLOYEE_SEARCH_MAX_LIMIT)
+    return jsonify({'employees': db.search_employees(request.args.get('q', ''), limit=limit)})
+
+@app.route('/admin/employees/<employee_id>/edit', methods=['GET', 'POST'])
+@login_required
+def admin_edit_employee(employee_id):
+    """管理員：修改員工姓名與電話 (非 super 只能查看)"""
+    employee = db.get_employee(employee_id)
+    if not employee:
+        abort(404)
+
+    error = None
+    if request.method == 'POST':
+        name = (request.form.get('name') or '').strip()
+        phone = (request.form.get('phone') or '').strip()
+        if session.get('user_role') != 'super':
+            error = "⚠️ 權限不足！您無權編輯。"
+        elif not name or not phone:
+            error = "姓名和聯絡電話不可為空。"
+        else:
+            updated, error = db.update_employee(employee_id, name, phone)
+            if updated:
+                return redirect(url_for('admin_employees', q=name, message=f"已更新員工 {name} 的資料。"))
+        employee.update(name=name, phone=phone)
+
+    return render_template('admin_edit_employee.html',
+                           employee=employee,
+                           error=error,
+                           user_role=session.get('user_role'))
+
+@app.route('/admin/employees/<employee_id>/delete', methods=['POST'])
+@login_required
+def admin_delete_employee(employee_id):
+    """管理員：刪除員工 (僅限 Super Admin；已報名的班別不會取消)"""
+    if session.get('user_role') != 'super':
+        return redirect(url_for('admin_edit_employee', employee_id=employee_id))
+
+    message = "已刪除員工資料。" if db.delete_employee(employee_id) else "員工資料不存在。"
+    return redirect(url_for('admin_employees', message=message))
+
+@app.route('/admin/export_bookings')
+@login_required
+def admin_export_bookings():
+    """管理員：依日期區間串流匯出所有班別的報名資料 (CSV 或 JSONL)，不會一次載入全部資料"""
+    start_date = request.args.get('start_date') or None
+    end_date = request.args.get('end_date') or None
+    fmt = request.args.get('format', 'csv')
+
+    try:
+        for value in (start_date, end_date):
+            if value:
+                datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return render_template('error.html', title="匯出失敗", message="日期格式必須為 YYYY-MM-DD。"), 400
+    if fmt not in db.EXPORT_FORMATS:
+        return render_template('error.html', title="匯出失敗", message="匯出格式只能是 csv 或 jsonl。"), 400
+
+    filename = f"bookings_{start_date or 'all'}_{end_date or 'all'}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(db.export_bookings(start_date, end_date, fmt)),
+                    mimetype=f'{mimetype}; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @app.route('/admin/edit_slot/<slot_id>', methods=['GET', 'POST'])
 @login_required
 def admin_edit_slot(slot_id):
@@ -338,7 +894,7 @@ def admin_edit_slot(slot_id):
 @login_required
 def admin_view_bookings(slot_id):
     """查看特定班別的報名名單"""
-    slot = db.get_slot_by_id(slot_id)
+    slot = db.get_slot_by_id(slot_id, replica=True)
     if not slot:
         abort(404)
         
@@ -348,6 +904,13 @@ def admin_view_bookings(slot_id):
                             slot=slot, 
                             bookings=bookings, 
                             user_role=session.get('user_role'))
+
+@app.route('/admin/view_bookings/<slot_id>/fragment', methods=['GET'])
+@login_required
+def admin_bookings_fragment(slot_id):
+    """儀表板展開名單時載入的 HTML 片段 (只讀取這個班別的名單)"""
+    bookings = db.get_bookings_for_slot(slot_id)
+    return render_template('admin_bookings_fragment.html', slot_id=slot_id, bookings=bookings)
                             
 @app.route('/admin/delete_booking/<slot_id>/<employee_id>', methods=['POST'])
 @login_required
@@ -361,11 +924,42 @@ def admin_delete_booking(slot_id, employee_id):
     db.delete_booking(slot_id, employee_id)
     return redirect(url_for('admin_view_bookings', slot_id=slot_id))
 
+# --- 監控 ---
+
+@app.route('/events')
+def slot_events():
+    """以 Server-Sent Events 推送班別報名人數變化 (不讀取 Redis，只轉送此 worker 訂閱到的事件)"""
+    if not config.LIVE_UPDATES_ENABLED:
+        abort(404)
+    listener = event_hub.subscribe()
+
+    def stream():
+        try:
+            yield live_updates.format_retry()
+            deadline = time.monotonic() + config.LIVE_UPDATES_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    yield live_updates.format_event(listener.get(timeout=live_updates.KEEPALIVE_SECONDS))
+                except queue.Empty:
+                    yield live_updates.format_keepalive()
+        finally:
+            event_hub.unsubscribe(listener)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 指標 (多個 gunicorn worker 時需設定 PROMETHEUS_MULTIPROC_DIR)"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
 # --- 錯誤處理 ---
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', title="404 找不到頁面", message="您訪問的頁面不存在，請檢查網址是否正確。"), 404
 
 if __name__ == '__main__':
-    # Flask 啟動
+    # Flask 啟動 (開發用：先套用資料遷移，正式環境請於部署時執行 python manage.py migrate)
+    db.migrate()
     app.run(debug=True,port=5001)
\ No newline at end of file
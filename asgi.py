@@ -0,0 +1,445 @@
+# asgi.py
+# 前台報名介面的 ASGI 入口 (/、/signup/<slot_id>、/new_employee、/success、/events)
+# 使用 redis_db_async，單一 process 即可同時處理大量等待 Redis 回應的報名請求。
+# 後台 (/admin/*) 仍由 app.py (Flask) 提供，兩者共用相同的模板與 Redis 資料。
+#
+# 啟動方式：
+#     uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+
+import asyncio
+import datetime
+import hashlib
+import http.cookies
+import math
+import os
+import re
+import secrets
+import time
+import urllib.parse
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import config
+import live_updates
+import metrics
+import redis_db as db
+import redis_db_async as adb
+
+# --- Redis 連線設定 (與 app.py 相同，由環境變數設定) ---
+adb.init_redis(adb.create_client(**config.redis_client_options(max_connections=config.REDIS_ASYNC_MAX_CONNECTIONS)),
+               replica_clients=[adb.create_client(**options) for options in
+                                config.redis_replica_options(max_connections=config.REDIS_ASYNC_MAX_CONNECTIONS)],
+               replica_max_lag=config.REDIS_REPLICA_MAX_LAG)
+# 資料遷移狀態的檢查沿用同步版本 (遷移本身於部署時以 manage.py migrate 執行)
+db.init_redis(db.create_client(**config.redis_client_options(max_connections=2)))
+
+# --- 模板設定 (與 Flask 相同：templates/ 目錄，.html 自動跳脫) ---
+_URL_RULES = {
+    'index': '/',
+    'signup': '/signup/{slot_id}',
+    'signup_batch': '/signup_batch',
+    'success_page': '/success',
+    'new_employee': '/new_employee',
+    'admin_login': '/admin/login',
+    'my_shifts': '/my_shifts',
+    'my_shifts_cancel': '/my_shifts/cancel/{slot_id}',
+    'my_shifts_logout': '/my_shifts/logout',
+    'slot_events': '/events',
+    'static': '/static/{filename}',
+}
+
+def url_for(endpoint, **values):
+    """模擬 Flask 的 url_for：路徑參數代入規則，其餘參數轉為 query string"""
+    rule = _URL_RULES[endpoint]
+    path_args = {k: urllib.parse.quote(str(values.pop(k)), safe='') for k in re.findall(r'{(\w+)}', rule)}
+    url = rule.format(**path_args)
+    if values:
+        url += '?' + urllib.parse.urlencode(values)
+    return url
+
+templates = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+                        autoescape=select_autoescape(['html']))
+templates.globals['url_for'] = url_for
+templates.globals['live_updates'] = config.LIVE_UPDATES_ENABLED
+
+def render_template(template_name, **context):
+    # 參數名稱不可為 name：頁面本身也會傳入 name (報名者姓名)
+    return templates.get_template(template_name).render(**context)
+
+# --- 回應輔助函式 ---
+
+async def _send_html(send, body, status=200):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/html; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+async def _send_redirect(send, location, headers=()):
+    await send({'type': 'http.response.start', 'status': 302,
+                'headers': [(b'location', location.encode('utf-8')), *headers]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+# --- Session (與 Flask 相同格式的簽章 Cookie：設定相同的 SECRET_KEY 時兩邊的登入狀態可以共用) ---
+
+SESSION_COOKIE_NAME = 'session'
+_session_serializer = URLSafeTimedSerializer(
+    config.SECRET_KEY or secrets.token_hex(16), salt='cookie-session',
+    signer_kwargs={'key_derivation': 'hmac', 'digest_method': hashlib.sha1})
+
+def _read_session(scope):
+    """讀取請求的 session Cookie (沒有或簽章錯誤時返回空字典)"""
+    cookies = http.cookies.SimpleCookie()
+    for key, value in scope.get('headers', []):
+        if key == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    morsel = cookies.get(SESSION_COOKIE_NAME)
+    if morsel is None:
+        return {}
+    try:
+        return _session_serializer.loads(morsel.value)
+    except BadSignature:
+        return {}
+
+def _session_header(session):
+    """寫入 (session 為空時刪除) session Cookie 的 Set-Cookie header"""
+    if session:
+        cookie = f'{SESSION_COOKIE_NAME}={_session_serializer.dumps(session)}; HttpOnly; Path=/'
+    else:
+        cookie = f'{SESSION_COOKIE_NAME}=; Expires=Thu, 01 Jan 1970 00:00:00 GMT; Max-Age=0; HttpOnly; Path=/'
+    return (b'set-cookie', cookie.encode('latin-1'))
+
+async def _read_form(receive, lists=()):
+    """讀取並解析 application/x-www-form-urlencoded 表單 (lists 內的欄位保留所有值)"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    form = urllib.parse.parse_qs(body.decode('utf-8'), keep_blank_values=True)
+    return {k: v if k in lists else v[0] for k, v in form.items()}
+
+# --- 限流與負載控制 (同 app.rate_limited) ---
+
+# 排隊佇列長度的快取時間 (秒)
+QUEUE_DEPTH_CACHE_TTL = 1
+_queue_depth_cache = {'value': 0, 'expires_at': 0}
+
+async def _booking_queue_depth():
+    """獲取排隊報名佇列長度 (使用短暫快取)"""
+    now = time.monotonic()
+    if now >= _queue_depth_cache['expires_at']:
+        _queue_depth_cache['value'] = await adb.get_booking_queue_length()
+        _queue_depth_cache['expires_at'] = now + QUEUE_DEPTH_CACHE_TTL
+    return _queue_depth_cache['value']
+
+def _rate_limit_identity(scope, kind, form):
+    """返回限流規則的識別值 (無法識別時返回 None，該規則不套用)"""
+    if kind == 'ip':
+        return (scope.get('client') or (None,))[0]
+    if scope['method'] != 'POST':
+        return None
+    if kind == 'employee':
+        name = form.get('name')
+        id_last_4 = form.get('id_last_4')
+        return db._employee_lookup_field(name, id_last_4) if name and id_last_4 else None
+    if kind == 'username':
+        return form.get('username') or None
+    return None
+
+async def _too_many_requests(send, endpoint, reason, retry_after, message):
+    """直接返回 429 頁面 (不再存取 Redis)"""
+    metrics.REQUESTS_REJECTED.labels(endpoint, reason).inc()
+    body = render_template('error.html', title="請求過於頻繁", message=message)
+    await send({'type': 'http.response.start', 'status': 429,
+                'headers': [(b'content-type', b'text/html; charset=utf-8'),
+                            (b'retry-after', str(max(1, math.ceil(retry_after))).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+async def _rate_limited(scope, send, endpoint, form=None):
+    """依 config.RATE_LIMITS 對此 endpoint 限流；已返回 429 時返回 True (呼叫端不可再存取 Redis)"""
+    if not config.RATE_LIMIT_ENABLED:
+        return False
+
+    # 1. 負載控制：Redis 已經變慢或佇列過長時，不再增加 Redis 的負擔
+    if metrics.redis_latency() * 1000 > config.SHED_REDIS_LATENCY_MS:
+        await _too_many_requests(send, endpoint, 'redis_latency', 1, "系統目前忙碌，請稍後再試。")
+        return True
+    if (scope['method'] == 'POST' and config.BOOKING_MODE == 'queue'
+            and await _booking_queue_depth() > config.SHED_QUEUE_DEPTH):
+        await _too_many_requests(send, endpoint, 'queue_depth', 5, "目前報名人數眾多，請稍後再試。")
+        return True
+
+    # 2. 限流：所有規則以單次原子腳本檢查
+    rules = []
+    for kind, (limit, window) in config.RATE_LIMITS.get(endpoint, {}).items():
+        identity = _rate_limit_identity(scope, kind, form or {})
+        if identity:
+            rules.append((f'{endpoint}:{kind}', identity, limit, window))
+    retry_after = await adb.check_rate_limit(rules)
+    if retry_after:
+        await _too_many_requests(send, endpoint, 'rate_limit', retry_after,
+                                 f"操作過於頻繁，請於 {math.ceil(retry_after)} 秒後再試。")
+        return True
+    return False
+
+# --- 前台報名介面 ---
+
+async def index(scope, receive, send):
+    """首頁：顯示可報名天數/班別"""
+    open_slots = await adb.get_open_slots_cached()
+    await _send_html(send, render_template('index.html', slots=open_slots))
+
+async def new_employee(scope, receive, send):
+    """新人註冊員工資料"""
+    error = None
+    success = None
+
+    if scope['method'] == 'POST':
+        form = await _read_form(receive)
+        name = form.get('name')
+        id_full = (form.get('id_full') or '').upper()
+        phone = form.get('phone')
+
+        if not re.match(r'^[A-Z][0-9]{9}$', id_full):
+            error = "身分證字號格式錯誤，請輸入大寫英文字母開頭，共 10 碼。"
+        elif not name or not phone:
+            error = "姓名和聯絡電話不可為空。"
+        else:
+            employee_id, msg = await adb.create_employee(name, id_full, phone)
+            if employee_id:
+                success = f"恭喜您，**{name}** 先生/小姐，員工資料註冊成功！<br>您現在可以使用身分證後四碼進行報名。"
+            else:
+                error = msg
+
+    await _send_html(send, render_template('new_employee.html', error=error, success=success))
+
+async def signup(scope, receive, send, slot_id):
+    """報名表單及處理邏輯"""
+    form = await _read_form(receive) if scope['method'] == 'POST' else None
+    if await _rate_limited(scope, send, 'signup', form):
+        return
+
+    slot = await adb.get_slot_by_id(slot_id)
+    if not slot or not slot['is_open']:
+        await _send_html(send, render_template('error.html', title="報名失敗", message="該班別不存在或已關閉報名。"))
+        return
+
+    date_str = slot['work_date']
+    slot_name = slot['slot_name']
+    error = None
+
+    if form is not None:
+        name = form.get('name')
+        id_last_4 = form.get('id_last_4')
+
+        employee_id, employee_data = await adb.get_employee_by_info(name, id_last_4)
+        if not employee_id:
+            error = "員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。"
+        else:
+            success, msg = await adb.add_booking(slot_id, date_str, employee_id, name, id_last_4)
+            if success:
+                await _send_redirect(send, url_for('success_page', slot_id=slot_id, name=name,
+                                                   date_str=date_str, slot_name=slot_name))
+                return
+            error = msg
+            slot = await adb.get_slot_by_id(slot_id)
+
+    await _send_html(send, render_template('signup_form.html', slot_id=slot_id, date_str=date_str,
+                                           slot_name=slot_name, slot=slot, error=error))
+
+async def signup_batch(scope, receive, send):
+    """一次報名首頁勾選的多個班別 (同 app.signup_batch)"""
+    form = await _read_form(receive, lists=('slot_ids',))
+    if await _rate_limited(scope, send, 'signup_batch', form):
+        return
+
+    slot_ids = form.get('slot_ids', [])
+    name = form.get('name')
+
+    if not slot_ids:
+        error = "請至少勾選一個班別。"
+    elif len(slot_ids) > config.SIGNUP_BATCH_MAX_SLOTS:
+        error = f"一次最多報名 {config.SIGNUP_BATCH_MAX_SLOTS} 個班別。"
+    else:
+        employee_id, _ = await adb.get_employee_by_info(name, form.get('id_last_4'))
+        error = None if employee_id else "員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。"
+    if error:
+        await _send_html(send, render_template('signup_batch.html', error=error))
+        return
+
+    all_or_nothing = form.get('all_or_nothing') == 'on'
+    results = await adb.add_bookings(slot_ids, employee_id, all_or_nothing=all_or_nothing)
+    await _send_html(send, render_template('signup_batch.html', name=name, results=results,
+                                           all_or_nothing=all_or_nothing))
+
+async def success_page(scope, receive, send):
+    """報名成功頁面"""
+    query = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('utf-8')))
+    name = query.get('name')
+    date_str = query.get('date_str')
+    slot_name = query.get('slot_name')
+
+    if not name or not date_str or not slot_name:
+        await _send_redirect(send, url_for('index'))
+        return
+
+    await _send_html(send, render_template('success.html', name=name, date_str=date_str, slot_name=slot_name))
+
+# --- 員工自助：我的班別 (同 app.my_shifts) ---
+
+async def my_shifts(scope, receive, send):
+    """員工以姓名與身分證後四碼驗證後，查看自己即將到來的班別"""
+    form = await _read_form(receive) if scope['method'] == 'POST' else None
+    if await _rate_limited(scope, send, 'my_shifts', form):
+        return
+
+    session = _read_session(scope)
+    error = None
+    if form is not None:
+        name = form.get('name')
+        employee_id, _ = await adb.get_employee_by_info(name, form.get('id_last_4'))
+        if employee_id:
+            session.update(employee_id=employee_id, employee_name=name)
+            await _send_redirect(send, url_for('my_shifts'), [_session_header(session)])
+            return
+        error = "員工資料驗證失敗。請確認您的姓名與身分證後四碼是否正確，或是否已進行員工註冊。"
+
+    employee_id = session.get('employee_id')
+    if not employee_id:
+        await _send_html(send, render_template('my_shifts.html', shifts=None, error=error))
+        return
+
+    query = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('utf-8')))
+    await _send_html(send, render_template('my_shifts.html',
+                                           shifts=await adb.get_employee_shifts(employee_id),
+                                           name=session.get('employee_name'),
+                                           message=query.get('message')))
+
+async def my_shifts_cancel(scope, receive, send, slot_id):
+    """員工取消自己即將到來的班別"""
+    await _read_form(receive)
+    if await _rate_limited(scope, send, 'my_shifts_cancel'):
+        return
+
+    employee_id = _read_session(scope).get('employee_id')
+    if not employee_id:
+        await _send_redirect(send, url_for('my_shifts'))
+        return
+
+    slot = await adb.get_slot_by_id(slot_id)
+    if not slot or slot['work_date'] < datetime.date.today().isoformat():
+        message = "該班別不存在或已結束，無法取消。"
+    elif await adb.delete_booking(slot_id, employee_id):
+        message = f"已取消 {slot['work_date']} {slot['slot_name']} 的報名。"
+    else:
+        message = "您未報名此班別。"
+    await _send_redirect(send, url_for('my_shifts', message=message))
+
+async def my_shifts_logout(scope, receive, send):
+    """員工登出"""
+    session = _read_session(scope)
+    session.pop('employee_id', None)
+    session.pop('employee_name', None)
+    await _send_redirect(send, url_for('my_shifts'), [_session_header(session)])
+
+# 報名人數即時更新：每個 process 共用一個 Redis 訂閱 (見 live_updates.py)
+event_hub = live_updates.AsyncEventHub(lambda: adb.r, db.SLOT_EVENTS_CHANNEL)
+
+async def slot_events(scope, receive, send):
+    """以 Server-Sent Events 推送班別報名人數變化 (瀏覽器斷線或超過 LIVE_UPDATES_MAX_SECONDS 時結束)"""
+    if not config.LIVE_UPDATES_ENABLED:
+        await page_not_found(scope, receive, send)
+        return
+
+    listener = event_hub.subscribe()
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        await _send_chunk(send, live_updates.format_retry())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.LIVE_UPDATES_MAX_SECONDS
+        while loop.time() < deadline:
+            next_event = asyncio.ensure_future(listener.get())
+            done, _ = await asyncio.wait({next_event, disconnected}, timeout=live_updates.KEEPALIVE_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                next_event.cancel()
+                return
+            if next_event in done:
+                await _send_chunk(send, live_updates.format_event(next_event.result()))
+            else:
+                next_event.cancel()
+                await _send_chunk(send, live_updates.format_keepalive())
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        event_hub.unsubscribe(listener)
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+async def page_not_found(scope, receive, send):
+    await _send_html(send, render_template('error.html', title="404 找不到頁面",
+                                           message="您訪問的頁面不存在，請檢查網址是否正確。"), status=404)
+
+# (HTTP 方法, 路徑規則, 處理函式)
+ROUTES = [
+    (('GET',), re.compile(r'^/$'), index),
+    (('GET', 'POST'), re.compile(r'^/new_employee$'), new_employee),
+    (('GET', 'POST'), re.compile(r'^/signup/(?P<slot_id>[^/]+)$'), signup),
+    (('POST',), re.compile(r'^/signup_batch$'), signup_batch),
+    (('GET',), re.compile(r'^/success$'), success_page),
+    (('GET', 'POST'), re.compile(r'^/my_shifts$'), my_shifts),
+    (('POST',), re.compile(r'^/my_shifts/cancel/(?P<slot_id>[^/]+)$'), my_shifts_cancel),
+    (('GET',), re.compile(r'^/my_shifts/logout$'), my_shifts_logout),
+    (('GET',), re.compile(r'^/events$'), slot_events),
+]
+
+# --- ASGI 應用程式 ---
+
+_initialized = False
+_init_lock = asyncio.Lock()
+
+async def _ensure_initialized():
+    """第一個請求時在執行緒中確認資料遷移已套用 (尚未套用時拋出 db.MigrationRequiredError)"""
+    global _initialized
+    if _initialized:
+        return
+    async with _init_lock:
+        if not _initialized:
+            await asyncio.to_thread(db.ensure_initialized)
+            _initialized = True
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await adb.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    try:
+        await _ensure_initialized()
+    except db.MigrationRequiredError:
+        await _send_html(send, render_template('error.html', title="系統維護中", message="系統正在更新，請稍後再試。"),
+                         status=503)
+        return
+    for methods, pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] in methods:
+            await handler(scope, receive, send, **match.groupdict())
+            return
+    await page_not_found(scope, receive, send)
@@ -0,0 +1,80 @@
+# booking_worker.py
+"""
+排隊報名 consumer (BOOKING_MODE=queue 時使用)
+
+從 booking_requests Stream 以 consumer group 讀取報名請求，依到達順序執行與直接報名相同的
+原子報名腳本 (容量與重複檢查規則不變)，並把結果寫回 booking_ticket:<ticket> 供瀏覽器查詢。
+可同時啟動多個 process (或以 --threads 啟動多個 consumer)，Redis 會把請求分配給不同 consumer。
+
+用法：
+    python booking_worker.py --threads 2
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import redis
+
+import config
+import redis_db as db
+
+
+def run_consumer(consumer, stop_event, batch_size, block_ms, reclaim_idle_ms):
+    """單一 consumer 的處理迴圈：定期接手逾時未確認的請求，其餘時間處理新請求"""
+    last_reclaim = 0
+    while not stop_event.is_set():
+        try:
+            if time.monotonic() - last_reclaim > reclaim_idle_ms / 1000:
+                db.reclaim_stale_booking_requests(consumer, min_idle_ms=reclaim_idle_ms, count=batch_size)
+                last_reclaim = time.monotonic()
+            db.process_booking_requests(consumer, count=batch_size, block_ms=block_ms)
+        except redis.exceptions.ConnectionError as e:
+            print(f"[{consumer}] Redis 連線失敗，稍後重試: {e}")
+            time.sleep(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="排隊報名 consumer")
+    parser.add_argument('--threads', type=int, default=1, help="此 process 內的 consumer 數")
+    parser.add_argument('--batch-size', type=int, default=100, help="每次讀取並以單一 Pipeline 處理的請求數")
+    parser.add_argument('--block-ms', type=int, default=5000, help="沒有請求時等待的毫秒數")
+    parser.add_argument('--reclaim-idle-ms', type=int, default=30000, help="接手其他 consumer 未確認請求的閒置門檻")
+    args = parser.parse_args(argv)
+
+    # XREADGROUP BLOCK 會佔用連線，socket 逾時必須大於等待時間
+    db.init_redis(db.create_client(**config.redis_client_options(
+        max_connections=args.threads + 2,
+        socket_timeout=args.block_ms / 1000 + config.REDIS_SOCKET_TIMEOUT,
+    )))
+    try:
+        db.ensure_initialized()
+    except db.MigrationRequiredError as e:
+        sys.exit(str(e))
+    db.ensure_booking_group()
+
+    stop_event = threading.Event()
+    prefix = f'{socket.gethostname()}-{os.getpid()}'
+    threads = [
+        threading.Thread(target=run_consumer, name=f'{prefix}-{i}',
+                         args=(f'{prefix}-{i}', stop_event, args.batch_size, args.block_ms, args.reclaim_idle_ms))
+        for i in range(args.threads)
+    ]
+    for t in threads:
+        t.start()
+    print(f"排隊報名 consumer 已啟動 ({args.threads} 個)，按 Ctrl+C 結束。")
+
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        stop_event.set()
+        for t in threads:
+            t.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# config.py
+# 應用程式設定：全部由環境變數讀取，未設定時使用本機開發用的預設值
+
+import os
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+def _env_bool(name, default=False):
+    value = os.environ.get(name)
+    return value.lower() in ('1', 'true', 'yes', 'on') if value else default
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+def _env_rate(name, default):
+    """讀取「次數/秒數」格式的限流設定 (例如 30/60)，返回 (limit, window_seconds)"""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    limit, window = value.split('/')
+    return int(limit), float(window)
+
+
+# --- Flask ---
+# 多個 gunicorn worker 時必須設定相同的 SECRET_KEY，否則登入狀態無法在 worker 間共用
+SECRET_KEY = os.environ.get('SECRET_KEY')
+
+# --- Redis 連線 ---
+# 設定 REDIS_URL (例如 redis://:password@host:6379/0) 時優先使用，否則使用個別欄位
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+REDIS_PORT = _env_int('REDIS_PORT', 6379)
+REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD') or None
+REDIS_DB = _env_int('REDIS_DB', 0)
+# 連線到 Redis Cluster (REDIS_URL / REDIS_HOST 為任一節點；Cluster 只有 db 0，REDIS_DB 會被忽略)
+REDIS_CLUSTER = _env_bool('REDIS_CLUSTER')
+
+# --- 唯讀副本 (Replica) ---
+# 以逗號分隔的 replica 網址 (例如 redis://10.0.0.2:6379/0,redis://10.0.0.3:6379/0)，設定後首頁、儀表板、
+# 報名名單等唯讀頁面改從 replica 讀取；報名、取消與容量檢查一律使用主節點 (Cluster 模式不使用)
+REDIS_REPLICA_URLS = [url.strip() for url in os.environ.get('REDIS_REPLICA_URLS', '').split(',') if url.strip()]
+REDIS_REPLICA_MAX_LAG = _env_float('REDIS_REPLICA_MAX_LAG', 2) # replica 落後超過此秒數時改讀主節點
+
+# --- Redis 連線池 ---
+REDIS_MAX_CONNECTIONS = _env_int('REDIS_MAX_CONNECTIONS', 20)          # 每個 process 的連線上限
+REDIS_POOL_TIMEOUT = _env_float('REDIS_POOL_TIMEOUT', 5)               # 連線池用盡時等待的秒數
+REDIS_SOCKET_TIMEOUT = _env_float('REDIS_SOCKET_TIMEOUT', 5)           # 單一指令的讀寫逾時 (秒)
+REDIS_SOCKET_CONNECT_TIMEOUT = _env_float('REDIS_SOCKET_CONNECT_TIMEOUT', 3)
+REDIS_HEALTH_CHECK_INTERVAL = _env_int('REDIS_HEALTH_CHECK_INTERVAL', 30)  # 閒置連線重用前的 PING 間隔 (秒)
+REDIS_ASYNC_MAX_CONNECTIONS = _env_int('REDIS_ASYNC_MAX_CONNECTIONS', 100)  # asgi.py 每個 process 的連線上限
+
+# --- 報名模式 ---
+# direct：送出報名時直接執行報名腳本
+# queue： 報名請求先寫入 Stream，由 booking_worker.py 依序處理，瀏覽器再查詢結果
+BOOKING_MODE = os.environ.get('BOOKING_MODE', 'direct')
+# 首頁勾選多個班別一次報名 (/signup_batch) 的班別數上限：整批在單一 Lua 腳本內執行，期間會阻擋其他指令
+SIGNUP_BATCH_MAX_SLOTS = _env_int('SIGNUP_BATCH_MAX_SLOTS', 50)
+
+# --- 歷史班別封存 ---
+# manage.py archive 會封存日期早於「今天 - ARCHIVE_AFTER_DAYS 天」的班別 (建議以 cron 每天執行)
+ARCHIVE_AFTER_DAYS = _env_int('ARCHIVE_AFTER_DAYS', 7)
+
+# --- 後台儀表板 ---
+# 儀表板依日期區間分頁顯示班別，預設從「今天 - DASHBOARD_DAYS_BEFORE 天」開始
+DASHBOARD_DAYS_BEFORE = _env_int('DASHBOARD_DAYS_BEFORE', 7)
+DASHBOARD_PAGE_SIZE = _env_int('DASHBOARD_PAGE_SIZE', 20)
+DASHBOARD_MAX_PAGE_SIZE = 100
+
+# --- 請求限流與負載控制 ---
+RATE_LIMIT_ENABLED = _env_bool('RATE_LIMIT_ENABLED', True)
+# 每個 endpoint 的限流規則：識別方式 -> (次數, 秒數)，可用環境變數覆寫 (例如 RATE_LIMIT_SIGNUP_IP=30/60)
+# ip：依用戶端 IP；employee：依報名的姓名+身分證後四碼 (僅 POST)；username：依登入帳號 (僅 POST)
+RATE_LIMITS = {
+    'signup': {
+        'ip': _env_rate('RATE_LIMIT_SIGNUP_IP', (30, 60)),
+        'employee': _env_rate('RATE_LIMIT_SIGNUP_EMPLOYEE', (10, 60)),
+    },
+    'signup_batch': {
+        'ip': _env_rate('RATE_LIMIT_SIGNUP_BATCH_IP', (10, 60)),
+        'employee': _env_rate('RATE_LIMIT_SIGNUP_BATCH_EMPLOYEE', (5, 60)),
+    },
+    'my_shifts': {
+        'ip': _env_rate('RATE_LIMIT_MY_SHIFTS_IP', (30, 60)),
+        'employee': _env_rate('RATE_LIMIT_MY_SHIFTS_EMPLOYEE', (10, 60)),
+    },
+    'admin_login': {
+        'ip': _env_rate('RATE_LIMIT_LOGIN_IP', (20, 60)),
+        'username': _env_rate('RATE_LIMIT_LOGIN_USERNAME', (5, 300)),
+    },
+}
+# Redis 往返延遲 (毫秒) 或排隊報名佇列長度超過門檻時，受保護的 endpoint 直接返回 429
+SHED_REDIS_LATENCY_MS = _env_float('SHED_REDIS_LATENCY_MS', 250)
+SHED_QUEUE_DEPTH = _env_int('SHED_QUEUE_DEPTH', 20000)
+# 位於反向代理之後時設定代理層數，才能以 X-Forwarded-For 取得真正的用戶端 IP
+PROXY_FIX_X_FOR = _env_int('PROXY_FIX_X_FOR', 0)
+
+# --- 即時更新 ---
+# 首頁與報名頁以 Server-Sent Events (/events) 即時更新報名人數。每個開啟的頁面會佔用一條長連線：
+# 預設的 sync worker 下每條連線會佔住整個 worker (最長 LIVE_UPDATES_MAX_SECONDS)，因此預設關閉；
+# 以執行緒 worker (例如 gunicorn -k gthread --threads 50) 或 asgi.py 執行時再設定 LIVE_UPDATES_ENABLED=1
+LIVE_UPDATES_ENABLED = _env_bool('LIVE_UPDATES_ENABLED', False)
+LIVE_UPDATES_MAX_SECONDS = _env_int('LIVE_UPDATES_MAX_SECONDS', 300) # 每條連線的最長時間，之後瀏覽器會自動重新連線
+
+# --- 監控 ---
+# 開啟後每個回應會加上 X-Redis-Roundtrips / X-Redis-Commands / X-Redis-Time-Ms 標頭並寫入 log
+REDIS_DEBUG_HEADERS = _env_bool('REDIS_DEBUG_HEADERS')
+
+
+def redis_client_options(**overrides):
+    """返回 redis_db.create_client / redis_db_async.create_client 使用的連線參數"""
+    options = {
+        'url': REDIS_URL,
+        'host': REDIS_HOST,
+        'port': REDIS_PORT,
+        'password': REDIS_PASSWORD,
+        'db': REDIS_DB,
+        'max_connections': REDIS_MAX_CONNECTIONS,
+        'pool_timeout': REDIS_POOL_TIMEOUT,
+        'socket_timeout': REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+        'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+        'cluster': REDIS_CLUSTER,
+    }
+    options.update(overrides)
+    return options
+
+def redis_replica_options(**overrides):
+    """返回每個 replica 的連線參數 (除網址外與主節點相同)"""
+    return [redis_client_options(url=url, cluster=False, **overrides) for url in REDIS_REPLICA_URLS]
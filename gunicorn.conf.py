@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# gunicorn 會自動載入目前目錄的這個設定檔。
+# 設定 PROMETHEUS_MULTIPROC_DIR 時 (見 metrics.py)：啟動時清空舊的指標檔案，worker 結束時清除其即時指標。
+
+import glob
+import os
+
+
+def on_starting(server):
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
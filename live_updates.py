@@ -0,0 +1,131 @@
+# live_updates.py
+"""
+班別報名人數的即時更新 (Redis Pub/Sub -> Server-Sent Events)
+
+報名 / 取消 / 編輯班別時 redis_db 會在 slot_events 頻道發布 {"id","booked","capacity","open"}。
+每個 process 只訂閱一次，再把事件分送給所有連線中的瀏覽器 (每個連線一個有上限的佇列)，
+瀏覽器只需保持一條 SSE 連線，不必重新整理頁面也不會對 Redis 產生額外的讀取。
+
+- EventHub：同步版本 (背景執行緒)，供 app.py (Flask) 使用
+- AsyncEventHub：非同步版本 (event loop 內的 task)，供 asgi.py 使用
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+
+import redis
+
+LISTENER_QUEUE_SIZE = 100 # 每個連線最多暫存的事件數 (超過時丟棄最舊的事件)
+RECONNECT_DELAY = 1 # 秒：Redis 連線中斷後重新訂閱前的等待時間
+KEEPALIVE_SECONDS = 15 # 沒有事件時送出註解行的間隔，避免代理伺服器關閉閒置連線
+RETRY_MS = 3000 # 瀏覽器斷線後重新連線的等待時間
+
+
+def format_event(data):
+    """SSE 的一則事件 (data 為 JSON 字串)"""
+    return f'data: {data}\n\n'
+
+def format_keepalive():
+    return ': keepalive\n\n'
+
+def format_retry():
+    return f'retry: {RETRY_MS}\n\n'
+
+def _put_latest(listener, data):
+    """放入事件；佇列已滿 (瀏覽器太慢) 時丟棄最舊的一則 (事件內容為最新人數，之後的事件會覆蓋)"""
+    try:
+        listener.put_nowait(data)
+    except (queue.Full, asyncio.QueueFull):
+        try:
+            listener.get_nowait()
+            listener.put_nowait(data)
+        except (queue.Empty, queue.Full, asyncio.QueueEmpty, asyncio.QueueFull):
+            pass
+
+
+class EventHub:
+    """每個 process 一個 Redis 訂閱 (背景執行緒)，把事件分送給所有 SSE 連線的佇列"""
+
+    def __init__(self, get_client, channel):
+        self._get_client = get_client # 返回目前的 Redis 客戶端 (init_redis 之後才有)
+        self._channel = channel
+        self._lock = threading.Lock()
+        self._listeners = set()
+        self._pid = None
+
+    def subscribe(self):
+        """新增一個連線，返回接收事件的佇列 (第一次使用或 fork 之後才啟動訂閱執行緒)"""
+        listener = queue.Queue(maxsize=LISTENER_QUEUE_SIZE)
+        with self._lock:
+            self._listeners.add(listener)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='live-updates', daemon=True).start()
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+
+    def _run(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._get_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self._dispatch(message['data'])
+            except redis.RedisError:
+                # 中斷期間的事件會遺失，頁面保留最後的人數直到下一則事件
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def _dispatch(self, data):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            _put_latest(listener, data)
+
+
+class AsyncEventHub:
+    """EventHub 的非同步版本：訂閱在 event loop 的 task 中執行"""
+
+    def __init__(self, get_client, channel):
+        self._get_client = get_client
+        self._channel = channel
+        self._listeners = set()
+        self._task = None
+
+    def subscribe(self):
+        listener = asyncio.Queue(maxsize=LISTENER_QUEUE_SIZE)
+        self._listeners.add(listener)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return listener
+
+    def unsubscribe(self, listener):
+        self._listeners.discard(listener)
+
+    async def _run(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._get_client().pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(self._channel)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message:
+                        for listener in list(self._listeners):
+                            _put_latest(listener, message['data'])
+            except redis.RedisError:
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                if pubsub is not None:
+                    await pubsub.aclose()
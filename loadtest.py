@@ -0,0 +1,437 @@
+# loadtest.py
+"""
+報名尖峰壓力測試工具
+
+啟動本機 Redis (redis-server，若未安裝則使用 fakeredis 的 TcpFakeServer)，
+以 gunicorn 啟動 app.py，預先建立 N 位員工與 M 個班別，
+再同時送出報名 / 首頁 / 儀表板請求，最後以 JSON 輸出：
+吞吐量、p50/p95/p99 延遲、每個請求的 Redis 指令數、WatchError/失敗率與超賣檢查結果。
+
+用法：
+    python loadtest.py --employees 500 --slots 20 --capacity 10 --concurrency 50 --duration 30
+    python loadtest.py --redis-port 6379 --output bench_output.txt   # 使用已在執行的 Redis
+    python loadtest.py --cluster 3    # 啟動 3 個 redis-server 節點組成的本機 Cluster (需要 redis-server 與 redis-cli)
+    python loadtest.py --replica      # 另外啟動一個 replica，唯讀頁面改從 replica 讀取 (需要 redis-server)
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import redis
+
+import redis_db as db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SECRET_KEY = 'loadtest-secret-key'
+
+
+# --- 環境準備 ---
+
+def _free_port():
+    """取得一個可用的本機 TCP 連接埠"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _wait_for_port(port, timeout=15):
+    """等待本機連接埠可以連線"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"等待連接埠 {port} 逾時")
+
+def start_redis(port):
+    """啟動本機 Redis，返回停止用的函式"""
+    redis_server = shutil.which('redis-server')
+    if redis_server:
+        proc = subprocess.Popen(
+            [redis_server, '--port', str(port), '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        _wait_for_port(port)
+        return proc.terminate
+
+    # 沒有 redis-server 時改用 fakeredis 的 TCP 伺服器 (在本 process 的背景執行緒中執行)
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        sys.exit("找不到 redis-server，也未安裝 fakeredis[lua]，無法啟動測試用 Redis。")
+    server = TcpFakeServer(('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _wait_for_port(port)
+    return server.shutdown
+
+def start_replica(port, primary_port):
+    """啟動複製本機主節點的 redis-server replica 並等待第一次同步完成，返回停止用的函式"""
+    redis_server = shutil.which('redis-server')
+    if not redis_server:
+        sys.exit("--replica 需要 redis-server。")
+    proc = subprocess.Popen(
+        [redis_server, '--port', str(port), '--replicaof', '127.0.0.1', str(primary_port),
+         '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    _wait_for_port(port)
+
+    client = redis.Redis(host='127.0.0.1', port=port, decode_responses=True)
+    deadline = time.monotonic() + 15
+    while client.info('replication').get('master_link_status') != 'up':
+        if time.monotonic() > deadline:
+            raise RuntimeError("等待 replica 同步逾時")
+        time.sleep(0.1)
+    return proc.terminate
+
+def start_redis_cluster(ports):
+    """以多個 redis-server 節點 (不含 replica) 建立本機 Redis Cluster，返回停止用的函式"""
+    redis_server, redis_cli = shutil.which('redis-server'), shutil.which('redis-cli')
+    if not redis_server or not redis_cli:
+        sys.exit("--cluster 需要 redis-server 與 redis-cli。")
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-cluster-')
+    procs = []
+    for port in ports:
+        procs.append(subprocess.Popen(
+            [redis_server, '--port', str(port), '--cluster-enabled', 'yes',
+             '--cluster-config-file', f'nodes-{port}.conf', '--save', '', '--appendonly', 'no'],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+    for port in ports:
+        _wait_for_port(port)
+
+    subprocess.run([redis_cli, '--cluster', 'create', *[f'127.0.0.1:{port}' for port in ports],
+                    '--cluster-replicas', '0', '--cluster-yes'],
+                   check=True, stdout=subprocess.DEVNULL)
+    # 等待所有 hash slot 都已分配且節點狀態一致
+    deadline = time.monotonic() + 15
+    while b'cluster_state:ok' not in subprocess.run(
+            [redis_cli, '-p', str(ports[0]), 'cluster', 'info'], capture_output=True).stdout:
+        if time.monotonic() > deadline:
+            raise RuntimeError("等待 Redis Cluster 就緒逾時")
+        time.sleep(0.2)
+
+    def stop():
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return stop
+
+def start_app(port, redis_port, workers, worker_class, cluster=False, replica_port=None):
+    """以 gunicorn 啟動 app.py，返回 Popen 物件"""
+    env = dict(os.environ,
+               REDIS_HOST='127.0.0.1', REDIS_PORT=str(redis_port), REDIS_PASSWORD='',
+               REDIS_CLUSTER='1' if cluster else '0',
+               REDIS_REPLICA_URLS=f'redis://127.0.0.1:{replica_port}/0' if replica_port else '',
+               SECRET_KEY=SECRET_KEY)
+    # 所有請求都來自同一個 IP，預設關閉限流 (可設定 RATE_LIMIT_ENABLED=1 測試限流本身)
+    env.setdefault('RATE_LIMIT_ENABLED', '0')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', worker_class,
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        cwd=BASE_DIR, env=env,
+    )
+    _wait_for_port(port, timeout=30)
+    return proc
+
+def seed(client, employees, slots, capacity):
+    """建立測試用員工與班別，返回 (員工資料列表, slot_id 列表, 各班別容量)"""
+    db.init_redis(client)
+    db.migrate()
+
+    employee_list = []
+    for i in range(employees):
+        id_full = f'Z{i:09d}'
+        name = f'壓測員工{i}'
+        db.create_employee(name, id_full, '0900000000')
+        employee_list.append((name, id_full[-4:]))
+
+    start = datetime.date.today() + datetime.timedelta(days=1)
+    slot_ids = []
+    for i in range(slots):
+        work_date = (start + datetime.timedelta(days=i % 30)).isoformat()
+        slot_ids.append(db.add_slot(work_date, f'壓測班別 {i}', True, capacity))
+
+    capacities = {slot_id: capacity for slot_id in slot_ids}
+    return employee_list, slot_ids, capacities
+
+def redis_total_calls(client):
+    """從 INFO commandstats 取得目前為止 Redis 執行的指令總數 (Cluster 為所有主節點合計，不支援時返回 None)"""
+    if isinstance(client, redis.RedisCluster):
+        calls = [redis_total_calls(node.redis_connection) for node in client.get_primaries()]
+        return None if None in calls else sum(calls)
+    try:
+        stats = client.info('commandstats')
+    except redis.exceptions.ResponseError:
+        return None
+    if not stats:
+        return None
+    return sum(int(v['calls']) for v in stats.values())
+
+
+# --- 流量產生 ---
+
+class Stats:
+    """執行緒安全的結果統計"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.outcomes = {}
+
+    def record(self, kind, latency, outcome):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            key = f'{kind}:{outcome}'
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+
+def _request(port, method, path, body=None, headers=None):
+    """送出單一 HTTP 請求，返回 (狀態碼, 回應標頭, 內容)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.getheaders(), resp.read().decode('utf-8', 'replace')
+    finally:
+        conn.close()
+
+def admin_cookie(port):
+    """登入預設管理員帳號並返回 session Cookie"""
+    body = urllib.parse.urlencode({'username': 'admin', 'password': 'super'})
+    status, headers, _ = _request(port, 'POST', '/admin/login', body,
+                                  {'Content-Type': 'application/x-www-form-urlencoded'})
+    for name, value in headers:
+        if name.lower() == 'set-cookie':
+            return value.split(';', 1)[0]
+    raise RuntimeError(f"管理員登入失敗 (HTTP {status})")
+
+def classify_signup(status, headers, text):
+    """依報名回應判斷結果"""
+    if status == 302 and any(n.lower() == 'location' and '/success' in v for n, v in headers):
+        return 'success'
+    if status != 200:
+        return f'http_{status}'
+    if '系統忙碌' in text:
+        return 'watch_error'
+    if '額滿' in text:
+        return 'full'
+    if '重複報名' in text:
+        return 'duplicate'
+    if '已關閉' in text or '不存在' in text:
+        return 'closed'
+    return 'failure'
+
+def worker_loop(port, args, employees, slot_ids, hot_slots, cookie, stats, deadline, counter):
+    """單一執行緒：依比例隨機送出報名 / 首頁 / 儀表板請求直到時間結束"""
+    rnd = random.Random()
+    while time.monotonic() < deadline:
+        with counter['lock']:
+            if args.requests and counter['sent'] >= args.requests:
+                return
+            counter['sent'] += 1
+
+        roll = rnd.random()
+        if roll < args.signup_ratio:
+            kind = 'signup'
+        elif roll < args.signup_ratio + args.index_ratio:
+            kind = 'index'
+        else:
+            kind = 'dashboard'
+
+        start = time.perf_counter()
+        try:
+            if kind == 'signup':
+                name, id_last_4 = rnd.choice(employees)
+                slot_id = rnd.choice(hot_slots if rnd.random() < args.hot_ratio else slot_ids)
+                body = urllib.parse.urlencode({'name': name, 'id_last_4': id_last_4})
+                status, headers, text = _request(port, 'POST', f'/signup/{slot_id}', body,
+                                                 {'Content-Type': 'application/x-www-form-urlencoded'})
+                outcome = classify_signup(status, headers, text)
+            elif kind == 'index':
+                status, _, _ = _request(port, 'GET', '/')
+                outcome = 'ok' if status == 200 else f'http_{status}'
+            else:
+                status, _, _ = _request(port, 'GET', '/admin/dashboard', headers={'Cookie': cookie})
+                outcome = 'ok' if status == 200 else f'http_{status}'
+        except (OSError, http.client.HTTPException):
+            outcome = 'connection_error'
+        stats.record(kind, time.perf_counter() - start, outcome)
+
+
+# --- 結果整理 ---
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _latency_summary(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': round(_percentile(values, 50) * 1000, 2) if values else None,
+        'p95_ms': round(_percentile(values, 95) * 1000, 2) if values else None,
+        'p99_ms': round(_percentile(values, 99) * 1000, 2) if values else None,
+        'max_ms': round(values[-1] * 1000, 2) if values else None,
+    }
+
+def check_overbooking(client, capacities):
+    """檢查每個班別的報名人數 (roster 大小) 是否超過容量"""
+    pipe = client.pipeline()
+    for slot_id in capacities:
+        pipe.zcard(db._slot_key(slot_id, 'roster'))
+    results = pipe.execute()
+
+    violations = []
+    for (slot_id, capacity), roster_size in zip(capacities.items(), results):
+        if roster_size > capacity:
+            violations.append({'slot_id': slot_id, 'capacity': capacity, 'roster_size': roster_size})
+    return violations
+
+def build_report(args, stats, elapsed, redis_calls, violations, replica_calls=None):
+    total = sum(len(v) for v in stats.latencies.values())
+    signup_total = len(stats.latencies.get('signup', []))
+    signup_outcomes = {k.split(':', 1)[1]: v for k, v in stats.outcomes.items() if k.startswith('signup:')}
+    failures = sum(v for k, v in stats.outcomes.items()
+                   if k.split(':', 1)[1] in ('failure', 'connection_error') or ':http_' in k)
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'employees': args.employees, 'slots': args.slots, 'capacity': args.capacity,
+            'concurrency': args.concurrency, 'duration': args.duration, 'requests': args.requests,
+            'gunicorn_workers': args.workers, 'worker_class': args.worker_class,
+            'signup_ratio': args.signup_ratio, 'index_ratio': args.index_ratio,
+            'hot_slots': args.hot_slots, 'hot_ratio': args.hot_ratio,
+            'cluster_nodes': args.cluster, 'replica': args.replica,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+        'latency': {'all': _latency_summary([x for v in stats.latencies.values() for x in v]),
+                    **{kind: _latency_summary(v) for kind, v in stats.latencies.items()}},
+        'outcomes': stats.outcomes,
+        'signup_outcomes': signup_outcomes,
+        'watch_error_rate': round(signup_outcomes.get('watch_error', 0) / signup_total, 4) if signup_total else 0,
+        'failure_rate': round(failures / total, 4) if total else 0,
+        'redis_commands_per_request': round(redis_calls / total, 2) if redis_calls is not None and total else None,
+        # replica 的指令數包含唯讀頁面的讀取，以及從主節點複製過來的寫入
+        'replica_commands_per_request': round(replica_calls / total, 2) if replica_calls is not None and total else None,
+        'overbooking_violations': violations,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="報名尖峰壓力測試")
+    parser.add_argument('--employees', type=int, default=200, help="預先建立的員工數")
+    parser.add_argument('--slots', type=int, default=20, help="預先建立的班別數")
+    parser.add_argument('--capacity', type=int, default=10, help="每個班別的容量")
+    parser.add_argument('--concurrency', type=int, default=50, help="同時送出請求的執行緒數")
+    parser.add_argument('--duration', type=float, default=20, help="測試秒數")
+    parser.add_argument('--requests', type=int, default=0, help="總請求數上限 (0 表示只依時間)")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn worker 數")
+    parser.add_argument('--worker-class', default='sync', help="gunicorn worker 類型")
+    parser.add_argument('--signup-ratio', type=float, default=0.6, help="報名請求比例")
+    parser.add_argument('--index-ratio', type=float, default=0.35, help="首頁請求比例 (其餘為儀表板)")
+    parser.add_argument('--hot-slots', type=int, default=2, help="熱門班別數 (模擬同時搶同一班)")
+    parser.add_argument('--hot-ratio', type=float, default=0.7, help="報名請求落在熱門班別的比例")
+    parser.add_argument('--redis-port', type=int, default=0, help="使用已在執行的本機 Redis (0 表示自動啟動)")
+    parser.add_argument('--cluster', type=int, default=0, help="啟動 N 個節點的本機 Redis Cluster (0 表示單機；需 N >= 3)")
+    parser.add_argument('--replica', action='store_true', help="另外啟動一個 replica 並讓唯讀頁面從 replica 讀取")
+    parser.add_argument('--output', help="將 JSON 結果寫入檔案")
+    args = parser.parse_args(argv)
+
+    if args.cluster and args.replica:
+        sys.exit("--cluster 與 --replica 不能同時使用。")
+    if args.cluster:
+        if args.cluster < 3:
+            sys.exit("Redis Cluster 至少需要 3 個主節點。")
+        ports = [_free_port() for _ in range(args.cluster)]
+        redis_port = ports[0]
+        stop_redis = start_redis_cluster(ports)
+    else:
+        redis_port = args.redis_port or _free_port()
+        stop_redis = start_redis(redis_port) if not args.redis_port else None
+    app_proc = None
+    stop_replica = replica_client = None
+    try:
+        if args.cluster:
+            client = redis.RedisCluster(host='127.0.0.1', port=redis_port, decode_responses=True)
+        else:
+            client = redis.Redis(host='127.0.0.1', port=redis_port, decode_responses=True)
+        if not args.redis_port:
+            client.flushall()
+        employees, slot_ids, capacities = seed(client, args.employees, args.slots, args.capacity)
+        hot_slots = slot_ids[:max(1, args.hot_slots)]
+
+        replica_port = None
+        if args.replica:
+            replica_port = _free_port()
+            stop_replica = start_replica(replica_port, redis_port)
+            replica_client = redis.Redis(host='127.0.0.1', port=replica_port, decode_responses=True)
+
+        app_port = _free_port()
+        app_proc = start_app(app_port, redis_port, args.workers, args.worker_class,
+                             cluster=bool(args.cluster), replica_port=replica_port)
+        cookie = admin_cookie(app_port)
+
+        stats = Stats()
+        counter = {'lock': threading.Lock(), 'sent': 0}
+        calls_before = redis_total_calls(client)
+        replica_before = redis_total_calls(replica_client) if replica_client else None
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [
+            threading.Thread(target=worker_loop,
+                             args=(app_port, args, employees, slot_ids, hot_slots, cookie, stats, deadline, counter))
+            for _ in range(args.concurrency)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+        calls_after = redis_total_calls(client)
+        replica_after = redis_total_calls(replica_client) if replica_client else None
+
+        redis_calls = calls_after - calls_before if calls_before is not None and calls_after is not None else None
+        replica_calls = (replica_after - replica_before
+                         if replica_before is not None and replica_after is not None else None)
+        report = build_report(args, stats, elapsed, redis_calls, check_overbooking(client, capacities), replica_calls)
+    finally:
+        if app_proc:
+            app_proc.terminate()
+            app_proc.wait()
+        if stop_replica:
+            stop_replica()
+        if stop_redis:
+            stop_redis()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    return 1 if report['overbooking_violations'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
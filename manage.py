@@ -0,0 +1,125 @@
+# manage.py
+"""
+管理用指令列工具 (連線設定與 app.py 相同，由環境變數設定)
+
+用法：
+    python manage.py import-employees employees.csv [--batch-size 500]
+    python manage.py export-bookings --start 2025-01-01 --end 2025-12-31 [--format jsonl] [-o bookings.csv]
+    python manage.py archive [--before 2025-01-01]   (建議以 cron 每天執行)
+    python manage.py memory-report    (不會執行資料遷移；也能統計舊版格式的資料，可在 migrate 前後各執行一次比較)
+    python manage.py migrate    (部署時執行：套用資料遷移並寫入預設資料，網站與 booking_worker 不會自行遷移)
+"""
+
+import argparse
+import csv
+import datetime
+import sys
+
+import config
+import redis_db as db
+
+
+def cmd_import_employees(args):
+    """以串流方式匯入員工 CSV (欄位：name,id_full,phone)，逐筆輸出錯誤，最後輸出統計"""
+    created = failed = 0
+    with open(args.path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        missing = {'name', 'id_full', 'phone'} - set(reader.fieldnames or [])
+        if missing:
+            sys.exit(f"CSV 缺少欄位：{', '.join(sorted(missing))}")
+
+        # 第 1 行為標題，資料列從第 2 行開始
+        for row_no, employee_id, message in db.import_employees(reader, batch_size=args.batch_size):
+            if employee_id:
+                created += 1
+            else:
+                failed += 1
+                print(f"第 {row_no + 1} 行：{message}", file=sys.stderr)
+
+    print(f"匯入完成：成功 {created} 筆，失敗 {failed} 筆。")
+    return 1 if failed else 0
+
+
+def cmd_export_bookings(args):
+    """依日期區間匯出報名資料 (CSV 或 JSONL)，逐行寫出，未指定 -o 時輸出到 stdout"""
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for chunk in db.export_bookings(args.start, args.end, args.format):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def cmd_archive(args):
+    """從開放索引移除已過日期的班別，並封存已結束的班別 (預設為 ARCHIVE_AFTER_DAYS 天前)"""
+    today = datetime.date.today()
+    before = args.before or (today - datetime.timedelta(days=config.ARCHIVE_AFTER_DAYS)).isoformat()
+    pruned = db.prune_open_slots(today.isoformat())
+    archived = db.archive_slots(before, batch_size=args.batch_size)
+    print(f"已從開放列表移除 {pruned} 個過期班別，封存 {archived} 個 {before} 以前的班別。")
+    return 0
+
+
+def cmd_memory_report(args):
+    """輸出班別與封存資料的 MEMORY USAGE 統計"""
+    report = db.memory_report()
+    print(f"班別數：{report['slots']}，報名數：{report['bookings']}")
+    if report['slot_bytes'] is None:
+        print("伺服器不支援 MEMORY USAGE 指令。")
+        return 1
+    print(f"班別相關鍵：{report['slot_bytes']} bytes")
+    if report['bookings']:
+        print(f"平均每筆報名 (含班別本身)：{report['slot_bytes'] / report['bookings']:.1f} bytes")
+    print(f"封存資料：{report['archive_bytes']} bytes")
+    return 0
+
+
+def cmd_migrate(args):
+    """執行尚未套用的資料遷移與預設資料寫入 (每個遷移會輸出處理結果)"""
+    db.migrate()
+    print("資料遷移完成。")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="演唱會工讀生報班系統管理工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('import-employees', help="從 CSV 批次匯入員工")
+    p.add_argument('path', help="CSV 檔案路徑 (欄位：name,id_full,phone)")
+    p.add_argument('--batch-size', type=int, default=db.BATCH_SIZE, help="每次寫入的筆數")
+    p.set_defaults(func=cmd_import_employees)
+
+    p = subparsers.add_parser('export-bookings', help="依日期區間匯出報名資料")
+    p.add_argument('--start', help="開始日期 YYYY-MM-DD (含)，省略時不限")
+    p.add_argument('--end', help="結束日期 YYYY-MM-DD (含)，省略時不限")
+    p.add_argument('--format', choices=db.EXPORT_FORMATS, default='csv', help="輸出格式")
+    p.add_argument('-o', '--output', help="輸出檔案路徑，省略時輸出到 stdout")
+    p.set_defaults(func=cmd_export_bookings)
+
+    p = subparsers.add_parser('archive', help="封存已結束的班別並清理開放列表")
+    p.add_argument('--before', help="封存此日期 (YYYY-MM-DD，不含) 以前的班別，預設為 ARCHIVE_AFTER_DAYS 天前")
+    p.add_argument('--batch-size', type=int, default=db.SLOTS_PER_PIPELINE, help="每批處理的班別數")
+    p.set_defaults(func=cmd_archive)
+
+    p = subparsers.add_parser('memory-report', help="統計班別與封存資料的記憶體用量")
+    p.set_defaults(func=cmd_memory_report, initialize=False)
+
+    p = subparsers.add_parser('migrate', help="執行資料遷移")
+    p.set_defaults(func=cmd_migrate, initialize=False)
+
+    args = parser.parse_args(argv)
+    db.init_redis(db.create_client(**config.redis_client_options()))
+    # 其他指令只確認資料遷移已套用；memory-report 不檢查，才能在遷移前統計記憶體用量
+    if getattr(args, 'initialize', True):
+        try:
+            db.ensure_initialized()
+        except db.MigrationRequiredError as e:
+            sys.exit(str(e))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
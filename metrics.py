@@ -0,0 +1,163 @@
+# metrics.py
+"""
+Redis 使用量與報名結果的 Prometheus 指標
+
+- redis_db.create_client 建立的客戶端會記錄每個指令 / Pipeline 的次數與延遲
+- redis_db 的公開函式以 @metrics.timed 記錄每個函式的呼叫次數與延遲
+- app.py 以 start_request / finish_request 統計每個請求的 Redis 往返次數與時間 (依 endpoint)
+
+多個 gunicorn worker 時請設定 PROMETHEUS_MULTIPROC_DIR (空目錄)，各 worker 的指標會寫入
+該目錄並於 /metrics 合併輸出；gunicorn.conf.py 會在啟動時清空目錄、worker 結束時清除其資料。
+"""
+
+import contextvars
+import functools
+import os
+import time
+
+import redis
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+REDIS_COMMAND_SECONDS = Histogram(
+    'redis_command_seconds', "單一 Redis 指令 (非 Pipeline) 的往返時間", ['command'], buckets=LATENCY_BUCKETS)
+REDIS_PIPELINE_SECONDS = Histogram(
+    'redis_pipeline_seconds', "Redis Pipeline 的往返時間", buckets=LATENCY_BUCKETS)
+REDIS_PIPELINE_COMMANDS = Histogram(
+    'redis_pipeline_commands', "每個 Pipeline 內的指令數", buckets=SIZE_BUCKETS)
+REDIS_REPLICA_READS = Counter(
+    'redis_replica_reads_total', "可由 replica 執行的唯讀操作實際執行的位置 (replica / primary)", ['target'])
+REDIS_WATCH_ERRORS = Counter(
+    'redis_watch_errors_total', "Pipeline 交易因 WATCH 的鍵被修改而失敗 (需重試) 的次數")
+REDIS_FUNCTION_SECONDS = Histogram(
+    'redis_db_function_seconds', "redis_db 各函式的執行時間", ['function'], buckets=LATENCY_BUCKETS)
+BOOKING_OUTCOMES = Counter(
+    'booking_outcomes_total', "報名腳本的執行結果", ['outcome', 'mode'])
+REQUEST_REDIS_ROUNDTRIPS = Histogram(
+    'http_request_redis_roundtrips', "每個 HTTP 請求對 Redis 的往返次數", ['endpoint'], buckets=SIZE_BUCKETS)
+REQUEST_REDIS_SECONDS = Histogram(
+    'http_request_redis_seconds', "每個 HTTP 請求花在 Redis 的時間", ['endpoint'], buckets=LATENCY_BUCKETS)
+REQUESTS_REJECTED = Counter(
+    'http_requests_rejected_total', "因限流或負載控制而直接返回 429/503 的請求數", ['endpoint', 'reason'])
+
+# 目前請求的 Redis 使用量 (未在請求中時為 None)
+_request_stats = contextvars.ContextVar('redis_request_stats', default=None)
+
+# process 內單一指令往返延遲的指數移動平均 (供負載控制使用，Pipeline 不列入)
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_STALE_SECONDS = 2 # 超過此時間沒有新樣本時視為已恢復
+_latency = {'ewma': 0.0, 'updated_at': 0.0}
+
+
+def _record(seconds, commands, single=False):
+    if single:
+        _latency['ewma'] += LATENCY_EWMA_ALPHA * (seconds - _latency['ewma'])
+        _latency['updated_at'] = time.monotonic()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats['roundtrips'] += 1
+        stats['commands'] += commands
+        stats['seconds'] += seconds
+
+def redis_latency():
+    """返回此 process 最近的 Redis 往返延遲 (秒)；一段時間沒有新樣本時返回 0"""
+    if time.monotonic() - _latency['updated_at'] > LATENCY_STALE_SECONDS:
+        return 0.0
+    return _latency['ewma']
+
+def start_request():
+    """開始統計目前請求的 Redis 使用量"""
+    _request_stats.set({'roundtrips': 0, 'commands': 0, 'seconds': 0.0})
+
+def finish_request(endpoint):
+    """結束統計並依 endpoint 記錄指標，返回 {'roundtrips', 'commands', 'seconds'} (未開始統計時返回 None)"""
+    stats = _request_stats.get()
+    _request_stats.set(None)
+    if stats is None:
+        return None
+    REQUEST_REDIS_ROUNDTRIPS.labels(endpoint).observe(stats['roundtrips'])
+    REQUEST_REDIS_SECONDS.labels(endpoint).observe(stats['seconds'])
+    return stats
+
+def timed(func):
+    """記錄 redis_db 函式的執行時間 (以函式名稱為標籤)"""
+    histogram = REDIS_FUNCTION_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def render():
+    """返回 /metrics 的內容與 Content-Type (多 process 模式時合併所有 worker 的指標)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """記錄 Pipeline 大小、往返時間與 WatchError 的 Pipeline"""
+
+    def execute(self, raise_on_error=True):
+        size = len(self.command_stack)
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except redis.WatchError:
+            REDIS_WATCH_ERRORS.inc()
+            raise
+        finally:
+            if size:
+                elapsed = time.perf_counter() - start
+                REDIS_PIPELINE_SECONDS.observe(elapsed)
+                REDIS_PIPELINE_COMMANDS.observe(size)
+                _record(elapsed, size)
+
+    def immediate_execute_command(self, *args, **options):
+        # WATCH 之後、MULTI 之前的指令會立即執行
+        start = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(elapsed)
+            _record(elapsed, 1, single=True)
+
+
+class InstrumentedRedis(redis.Redis):
+    """記錄每個指令往返時間的 Redis 客戶端 (Lua 腳本記錄為 EVALSHA)"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(elapsed)
+            _record(elapsed, 1, single=True)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedRedisCluster(redis.RedisCluster):
+    """記錄每個指令往返時間的 Redis Cluster 客戶端 (Pipeline 依節點分批送出，不另外記錄)"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(elapsed)
+            _record(elapsed, 1, single=True)
@@ -1,29 +1,256 @@
 # redis_db.py
 
 import redis
+import csv
+import base64
 import datetime
+import heapq
+import io
+import itertools
 import json
+import os
+import re
 import secrets 
+import threading
 import time
+import zlib
+
+import metrics
 
 # 全域 Redis 客戶端變數
 r = None
+# 是否連線到 Redis Cluster (於 init_redis 時設定)
+CLUSTER_MODE = False
+# 唯讀副本 (replica)：每個元素為 {'client', 'healthy', 'lag', 'checked_at'} (於 init_redis 時設定)
+_replicas = []
+_replica_counter = itertools.count()
+_replica_max_lag = 2
+# 已註冊的 Lua 腳本 (於 init_redis 時建立)
+_book_slot_script = None
+_book_slots_script = None
+_cancel_booking_script = None
+_create_employees_script = None
+_rate_limit_script = None
+_delete_slot_script = None
+_touch_slot_script = None
+_replica_heartbeat_script = None
+# 是否已確認資料遷移與預設資料都已套用 (每個 process 各自記錄)
+_initialized = False
+_init_lock = threading.Lock()
+# 資料遷移鎖的存活時間 (秒)：每完成一個遷移會重新計時，避免 process 中斷後鎖一直存在
+MIGRATION_LOCK_TIMEOUT = 600
+
+
+class MigrationRequiredError(RuntimeError):
+    """資料庫尚未套用所有資料遷移 (請先執行 python manage.py migrate)"""
 
 # --- Redis 鍵命名規範 ---
-# 班別詳細資訊 (Hash):        slot:<slot_id>
-# 開放班別列表 (Sorted Set): open_slots_set (score=work_date的Unix時間戳)
-# 報名人數計數器 (String):    slot:<slot_id>:count
-# 報名名單 (List):            slot:<slot_id>:bookings
-# 報名唯一性索引 (Set):       slot:<slot_id>:members   
+# 班別相關的鍵依 slot_id 分成 KEY_SHARDS 個分片，以 hash tag {<shard>} 放在同一個 Redis Cluster slot，
+# 同一個班別的 Hash、名單、索引與版本號可在同一個 Lua 腳本 / 交易中原子更新；全域列表讀取時合併所有分片。
+# 班別詳細資訊 (Hash):        slot:{<shard>}:<slot_id>
+# 開放班別列表 (Sorted Set): open_slots_set:{<shard>} (score=work_date的Unix時間戳)
+# 全部班別列表 (Sorted Set): all_slots_set:{<shard>} (score=work_date的Unix時間戳)
+# 班別資料版本 (String):      slots_version:{<shard>} (分片內任何班別/報名異動時 INCR，用於快取失效)
+# 報名名單 (Sorted Set):      slot:{<shard>}:<slot_id>:roster (member=employee_id, score=報名時間微秒)
+#                             報名人數為 ZCARD、重複檢查為 ZSCORE，姓名/身分證後四碼於讀取時從員工資料取得
+# 員工已報名班別 (Sorted Set): employee_slots:<employee_id> (member=slot_id, score=work_date 的 YYYYMMDD)
+# 已套用的資料遷移 (Set):   schema_migrations
+# 預設資料寫入標記 (String): defaults_seeded
 # 管理員帳號 (Hash):         admin_user:<username>
-# 員工資料 (Hash):           employee:<employee_id>
-# 員工資料索引 (Hash):       employee_index:<id_full> -> employee_id
+# 排隊報名請求 (Stream):      booking_requests (consumer group: booking_workers)
+# 排隊報名結果 (Hash):        booking_ticket:<ticket> (status / message，含 TTL)
+# 員工資料相關的鍵使用同一個 hash tag {emp}，註冊時的重複檢查與索引寫入可在同一個 Lua 腳本完成
+# 員工資料 (Hash):           employee:{emp}:<employee_id>
+# 員工資料索引 (Hash):       employee_index:{emp} (id_full -> employee_id)
+# 員工報名驗證索引 (Hash):   employee_lookup:{emp} (<name>:<id_last_4> -> employee_id)
+# 已封存班別 (Hash):        archive:<YYYY-MM> (slot_id -> zlib 壓縮的 JSON，base64)
+# 有封存資料的月份 (Set):   archive_months
+# 請求限流視窗 (Sorted Set): ratelimit:<scope>:<identity> (member=請求, score=時間微秒，含 TTL)
+# Replica 心跳 (String):     replica_heartbeat (主節點寫入的 Unix 時間，用於計算 replica 落後秒數)
+# 班別人數變化 (Pub/Sub):     slot_events (JSON：{"id","booked","capacity","open"}，報名/取消/編輯班別時發布)
+
+# 班別鍵的分片數 (固定值：改變後既有的鍵會找不到)
+KEY_SHARDS = 16
+
+# 批次處理時每個 Pipeline 的指令數上限
+BATCH_SIZE = 500
+# 批次新增班別時每個 Pipeline 的班別數 (每個班別約 6 個指令)
+SLOTS_PER_PIPELINE = 100
+
+# 報名人數變化事件的 Pub/Sub 頻道 (訂閱端見 live_updates.py)
+SLOT_EVENTS_CHANNEL = 'slot_events'
+
+# Replica 落後時間的檢查間隔 (秒)：每個 process 每個間隔最多讀取一次 replica 的心跳
+REPLICA_CHECK_INTERVAL = 1
+REPLICA_HEARTBEAT_KEY = 'replica_heartbeat'
+# 心跳寫入間隔 (秒)：使用 replica 的 process 以背景執行緒定期寫入，與讀取流量無關
+REPLICA_HEARTBEAT_INTERVAL = 0.5
+_replica_heartbeat_pid = None
+_replica_heartbeat_lock = threading.Lock()
+
+# 首頁開放班別快取 (每個 process 各自一份，以 slots_version 判斷是否失效)
+OPEN_SLOTS_CACHE_TTL = 5 # 秒：即使版本未變，超過此時間也會重新讀取
+_open_slots_cache = {'version': None, 'expires_at': 0, 'slots': None}
+_open_slots_cache_lock = threading.Lock()
 
 # --- 輔助函式 ---
 
-def _create_slot_data(slot_id, work_date, slot_name, is_open=True, capacity=5):
-    """創建或更新班別 Hash 資料並設定計數器和開放索引"""
-    pipe = r.pipeline()
+def _slot_shard(slot_id):
+    """班別所屬的分片 (0 ~ KEY_SHARDS-1)"""
+    return zlib.crc32(slot_id.encode('utf-8')) % KEY_SHARDS
+
+def _slot_key(slot_id, field=None):
+    """組合班別相關的 Redis 鍵名稱：slot:{<shard>}:<id> 或 slot:{<shard>}:<id>:<field>"""
+    key = f'slot:{{{_slot_shard(slot_id)}}}:{slot_id}'
+    return f'{key}:{field}' if field else key
+
+def _shard_key(name, shard):
+    """班別全域索引 / 版本號在某個分片的鍵名稱：<name>:{<shard>}"""
+    return f'{name}:{{{shard}}}'
+
+def _slot_index_key(name, slot_id):
+    """班別所在分片的索引 / 版本號鍵 (與 _slot_key 位於同一個 hash slot)"""
+    return _shard_key(name, _slot_shard(slot_id))
+
+def _shard_keys(name):
+    """某個全域索引 / 版本號的所有分片鍵"""
+    return [_shard_key(name, shard) for shard in range(KEY_SHARDS)]
+
+def _merge_index_results(results):
+    """合併各分片 ZRANGE ... WITHSCORES 的結果，依 (score, slot_id) 排序 (與單一 Sorted Set 的順序相同)"""
+    return list(heapq.merge(*results, key=lambda item: (item[1], item[0])))
+
+def _index_range(name, min_score='-inf', max_score='+inf', count=None, client=None):
+    """以單一 Pipeline 讀取所有分片的索引並合併，返回依日期排序的 slot_id 列表 (count 為筆數上限)"""
+    limit = {'start': 0, 'num': count} if count else {}
+    pipe = (client or r).pipeline(transaction=False)
+    for key in _shard_keys(name):
+        pipe.zrangebyscore(key, min_score, max_score, withscores=True, **limit)
+    return [slot_id for slot_id, _ in _merge_index_results(pipe.execute())][:count]
+
+def _index_page(name, min_score, max_score, offset, count, client=None):
+    """
+    以單一 Pipeline 讀取所有分片索引合併後第 offset 筆起的 count 個 slot_id，並返回區間內的總筆數；
+    每個分片只讀取前 offset + count 筆，讀取量與區間外 (或頁面之後) 的資料量無關
+    """
+    pipe = (client or r).pipeline(transaction=False)
+    for key in _shard_keys(name):
+        pipe.zrangebyscore(key, min_score, max_score, start=0, num=offset + count, withscores=True)
+        pipe.zcount(key, min_score, max_score)
+    results = pipe.execute()
+    merged = _merge_index_results(results[0::2])
+    return [slot_id for slot_id, _ in merged[offset:offset + count]], sum(results[1::2])
+
+def _iter_shard_index(key, min_score, max_score, page_size):
+    """依 (score, 同分已讀筆數) 游標逐頁讀取單一分片索引，逐筆產生 (slot_id, score)"""
+    offset = 0 # 與 min_score 同分、已讀過的班別數
+    while True:
+        page = r.zrangebyscore(key, min_score, max_score, start=offset, num=page_size, withscores=True)
+        if not page:
+            return
+        yield from page
+
+        # 移動游標：下一頁從最後一筆的 score 開始，略過該 score 已讀過的班別
+        last_score = page[-1][1]
+        same_score = sum(1 for _, score in page if score == last_score)
+        offset = offset + same_score if last_score == min_score else same_score
+        min_score = last_score
+
+def _iter_index(name, min_score='-inf', max_score='+inf', page_size=SLOTS_PER_PIPELINE):
+    """依日期順序逐筆產生所有分片索引中的 (slot_id, score)，每個分片分頁讀取，記憶體用量與資料量無關"""
+    shards = [_iter_shard_index(key, min_score, max_score, page_size) for key in _shard_keys(name)]
+    return heapq.merge(*shards, key=lambda item: (item[1], item[0]))
+
+def _slots_version(client=None):
+    """所有分片的版本號 (任何分片異動時結果即不同)"""
+    pipe = (client or r).pipeline(transaction=False)
+    for key in _shard_keys('slots_version'):
+        pipe.get(key)
+    return tuple(pipe.execute())
+
+def _iter_index_batches(name, batch_size=SLOTS_PER_PIPELINE):
+    """依日期順序逐批產生所有分片索引中的 slot_id 列表 (每批最多 batch_size 筆)"""
+    batch = []
+    for slot_id, _ in _iter_index(name, page_size=batch_size):
+        batch.append(slot_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _legacy_slot_key(slot_id, field=None):
+    """舊版 (未分片) 的班別鍵名稱：slot:<id> 或 slot:<id>:<field>，只供資料遷移使用"""
+    return f'slot:{slot_id}:{field}' if field else f'slot:{slot_id}'
+
+def _employee_key(employee_id):
+    return f'employee:{{emp}}:{employee_id}'
+
+EMPLOYEE_INDEX_KEY = 'employee_index:{emp}'
+EMPLOYEE_LOOKUP_KEY = 'employee_lookup:{emp}'
+# 員工搜尋索引 (Sorted Set，score 皆為 0，以字典序排列)：成員為 "<姓名或電話>\x00<employee_id>"
+EMPLOYEE_NAME_INDEX_KEY = 'employee_name_index:{emp}'
+EMPLOYEE_PHONE_INDEX_KEY = 'employee_phone_index:{emp}'
+
+def _slot_data_keys(slot_id):
+    """班別本身與報名名單的所有鍵 (刪除或封存班別時使用)"""
+    return [_slot_key(slot_id), _slot_key(slot_id, 'roster')]
+
+def _employee_lookup_field(name, id_last_4):
+    """組合員工報名驗證索引的欄位名稱 (姓名 + 身分證後四碼)"""
+    return f'{name}:{id_last_4}'
+
+def _search_value(value):
+    """姓名搜尋索引使用的值 (去除前後空白，英文不分大小寫)"""
+    return (value or '').strip().lower()
+
+def _phone_digits(phone):
+    """電話搜尋索引使用的值 (只保留數字，搜尋時不需輸入 - 或空白)"""
+    return re.sub(r'\D', '', phone or '')
+
+def _employee_search_members(employee_id, name, phone):
+    """員工在姓名 / 電話搜尋索引中的成員，返回 (姓名成員, 電話成員)；電話沒有數字時電話成員為 None"""
+    digits = _phone_digits(phone)
+    return f'{_search_value(name)}\x00{employee_id}', f'{digits}\x00{employee_id}' if digits else None
+
+def _lex_prefix_range(prefix):
+    """ZRANGEBYLEX 的前綴範圍 (以 bytes 傳入：0xFF 不會出現在 UTF-8 字串中，可作為上界)"""
+    value = prefix.encode('utf-8')
+    return b'[' + value, b'[' + value + b'\xff'
+
+def _date_score(work_date):
+    """將 YYYY-MM-DD 日期轉換為 Unix Timestamp，作為 Sorted Set 的 Score"""
+    return int(datetime.datetime.strptime(work_date, '%Y-%m-%d').timestamp())
+
+def _date_int(work_date):
+    """YYYY-MM-DD -> YYYYMMDD 整數 (員工班別索引的 Score，Lua 腳本可直接由班別 Hash 的日期算出)"""
+    return int(work_date.replace('-', ''))
+
+def _employee_slots_key(employee_id):
+    return f'employee_slots:{employee_id}'
+
+def _today_score():
+    """今天日期的 Score (開放班別只列出今天以後的場次)"""
+    return _date_score(datetime.date.today().isoformat())
+
+def _scan_primary_keys(pattern):
+    """以 SCAN 逐批列出主鍵 (格式為 <prefix>:<id>，略過 <prefix>:<id>:xxx 輔助鍵)，每批最多 BATCH_SIZE 筆"""
+    batch = []
+    for key in r.scan_iter(match=pattern, count=BATCH_SIZE):
+        if len(key.split(':')) != 2:
+            continue
+        batch.append(key)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _create_slot_data(slot_id, work_date, slot_name, is_open=True, capacity=5, pipe=None):
+    """創建或更新班別 Hash 資料並設定開放索引 (傳入 pipe 時只加入指令，由呼叫端執行)"""
+    execute = pipe is None
+    if execute:
+        pipe = r.pipeline(transaction=True) # 所有鍵在同一個 hash slot，Cluster 模式也可使用交易
     
     # 1. 班別詳細資訊 (Hash)
     slot_data = {
@@ -32,149 +259,560 @@ def _create_slot_data(slot_id, work_date, slot_name, is_open=True, capacity=5):
         'is_open': str(is_open), # Redis Hash 儲存字串
         'capacity': str(capacity)
     }
-    pipe.hset(f'slot:{slot_id}', mapping=slot_data)
+    pipe.hset(_slot_key(slot_id), mapping=slot_data)
     
-    # 2. 報名人數計數器 (String) - 如果不存在才建立並設為 0
-    pipe.setnx(f'slot:{slot_id}:count', 0)
-    
-    # 3. 開放班別索引 (Sorted Set)
+    # 將日期轉換為 Unix Timestamp 作為 Score (確保排序)
+    timestamp = _date_score(work_date)
+
+    # 2. 全部班別索引 (Sorted Set，班別所在的分片)
+    pipe.zadd(_slot_index_key('all_slots_set', slot_id), {slot_id: timestamp})
+
+    # 3. 開放班別索引 (Sorted Set，班別所在的分片)
     if is_open:
-        # 將日期轉換為 Unix Timestamp 作為 Score (確保排序)
-        timestamp = int(datetime.datetime.strptime(work_date, '%Y-%m-%d').timestamp())
-        pipe.zadd('open_slots_set', {slot_id: timestamp})
+        pipe.zadd(_slot_index_key('open_slots_set', slot_id), {slot_id: timestamp})
     else:
-        pipe.zrem('open_slots_set', slot_id)
+        pipe.zrem(_slot_index_key('open_slots_set', slot_id), slot_id)
+
+    # 4. 更新版本號，讓各 process 的首頁快取失效；班別本身的版本號供 JSON API 的 ETag 使用
+    pipe.incr(_slot_index_key('slots_version', slot_id))
+    pipe.hincrby(_slot_key(slot_id), 'version', 1)
         
-    pipe.execute()
+    if execute:
+        pipe.execute()
 
 # --- 員工 (Employee) 相關功能 ---
 
+# 身分證字號格式 (大寫英文字母 + 9 位數字)
+ID_FULL_PATTERN = re.compile(r'^[A-Z][0-9]{9}$')
+
+# 原子註冊腳本：在伺服器端檢查身分證是否重複、報名驗證欄位 (姓名 + 身分證後四碼) 是否已被其他員工使用，通過後才寫入員工資料與索引
+# KEYS[1]=employee_index:{emp}  KEYS[2]=employee_lookup:{emp}
+# KEYS[3]=employee_name_index:{emp}  KEYS[4]=employee_phone_index:{emp}  KEYS[4+i]=第 i 位員工的 employee:{emp}:<id>
+# ARGV 每 7 個一組：employee_id, id_full, 報名驗證索引欄位, name, phone, 姓名搜尋成員, 電話搜尋成員 (空字串時不加入)
+# 返回值：每位員工一個 1 (新增) / 0 (身分證已存在) / 2 (姓名與身分證後四碼和其他員工相同)
+CREATE_EMPLOYEES_LUA = """
+local results = {}
+local n = #ARGV / 7
+for i = 1, n do
+    local base = (i - 1) * 7
+    local employee_id, id_full = ARGV[base + 1], ARGV[base + 2]
+    if redis.call('HEXISTS', KEYS[1], id_full) == 1 then
+        results[i] = 0
+    elseif redis.call('HEXISTS', KEYS[2], ARGV[base + 3]) == 1 then
+        results[i] = 2
+    else
+        redis.call('HSET', KEYS[1], id_full, employee_id)
+        redis.call('HSET', KEYS[4 + i],
+                   'name', ARGV[base + 4], 'id_full', id_full,
+                   'id_last_4', string.sub(id_full, -4), 'phone', ARGV[base + 5])
+        redis.call('HSET', KEYS[2], ARGV[base + 3], employee_id)
+        redis.call('ZADD', KEYS[3], 0, ARGV[base + 6])
+        if ARGV[base + 7] ~= '' then
+            redis.call('ZADD', KEYS[4], 0, ARGV[base + 7])
+        end
+        results[i] = 1
+    end
+end
+return results
+"""
+
+# CREATE_EMPLOYEES_LUA 的返回值 -> 訊息
+CREATE_EMPLOYEE_MESSAGES = {
+    1: "註冊成功",
+    0: "員工資料已存在。",
+    2: "已有姓名與身分證後四碼都相同的員工，報名時無法區分，請聯絡管理員協助處理。",
+}
+
+def _create_employees_call(employees):
+    """組合 CREATE_EMPLOYEES_LUA 的 KEYS / ARGV；employees 為 (name, id_full, phone) 列表，返回 (employee_ids, keys, args)"""
+    employee_ids = [secrets.token_urlsafe(8) for _ in employees]
+    keys = [EMPLOYEE_INDEX_KEY, EMPLOYEE_LOOKUP_KEY, EMPLOYEE_NAME_INDEX_KEY, EMPLOYEE_PHONE_INDEX_KEY]
+    keys += [_employee_key(employee_id) for employee_id in employee_ids]
+    args = []
+    for employee_id, (name, id_full, phone) in zip(employee_ids, employees):
+        args += [employee_id, id_full, _employee_lookup_field(name, id_full[-4:]), name, phone]
+        args += [member or '' for member in _employee_search_members(employee_id, name, phone)]
+    return employee_ids, keys, args
+
+@metrics.timed
 def create_employee(name, id_full, phone):
-    """註冊新員工，返回 employee_id"""
-    if r.hexists('employee_index', id_full):
-        # 由於 Redis 的 HSET 不支援直接儲存密碼或敏感資訊，employee_index 儲存的是 id_full -> employee_id
-        # 我們假設如果 index 存在，員工資料就存在
-        return None, "員工資料已存在。"
-    
-    employee_id = secrets.token_urlsafe(8)
-    pipe = r.pipeline()
-    # 1. 儲存員工資料 Hash
-    pipe.hset(f'employee:{employee_id}', mapping={
-        'name': name,
-        'id_full': id_full,
-        'id_last_4': id_full[-4:],
-        'phone': phone
-    })
-    # 2. 建立反向索引 (完整身分證 -> employee_id)
-    pipe.hset('employee_index', id_full, employee_id)
-    pipe.execute()
-    return employee_id, "註冊成功"
+    """註冊新員工，返回 employee_id (身分證重複檢查與寫入在同一個 Lua 腳本中原子完成)"""
+    employee_ids, keys, args = _create_employees_call([(name, id_full, phone)])
+    result = _create_employees_script(keys=keys, args=args)[0]
+    return employee_ids[0] if result == 1 else None, CREATE_EMPLOYEE_MESSAGES[result]
+
+def import_employees(rows, batch_size=BATCH_SIZE):
+    """
+    批次匯入員工 (rows 為含 name / id_full / phone 的 dict，可為串流讀取的 CSV)。
+    每 batch_size 筆以一次腳本呼叫寫入，逐筆產生 (列號, employee_id 或 None, 訊息)，記憶體用量與檔案大小無關。
+    """
+    batch = []
+
+    def flush():
+        valid = [(row_no, employee) for row_no, employee, error in batch if not error]
+        results = []
+        if valid:
+            employee_ids, keys, args = _create_employees_call([employee for _, employee in valid])
+            created = _create_employees_script(keys=keys, args=args)
+            results = dict(zip((row_no for row_no, _ in valid), zip(employee_ids, created)))
+        for row_no, employee, error in batch:
+            if error:
+                yield row_no, None, error
+            else:
+                employee_id, result = results[row_no]
+                yield row_no, employee_id if result == 1 else None, CREATE_EMPLOYEE_MESSAGES[result]
+
+    for row_no, row in enumerate(rows, start=1):
+        name = (row.get('name') or '').strip()
+        id_full = (row.get('id_full') or '').strip().upper()
+        phone = (row.get('phone') or '').strip()
+        error = None
+        if not ID_FULL_PATTERN.match(id_full):
+            error = "身分證字號格式錯誤，請輸入大寫英文字母開頭，共 10 碼。"
+        elif not name or not phone:
+            error = "姓名和聯絡電話不可為空。"
+        batch.append((row_no, (name, id_full, phone), error))
 
+        if len(batch) >= batch_size:
+            yield from flush()
+            batch = []
+
+    if batch:
+        yield from flush()
+
+@metrics.timed
 def get_employee_by_info(name, id_last_4):
-    """透過姓名和身分證後四碼查找員工 ID"""
-    
-    # 由於沒有直接的 name:last_4 索引，只能查找所有 employee:* 的 key
-    # ⚠️ 注意：在生產環境中，如果有大量數據，應避免使用 KEYS 命令
-    
-    employee_keys = r.keys('employee:*')
-    for key in employee_keys:
-        employee_data = r.hgetall(key)
-        if employee_data.get('name') == name and employee_data.get('id_last_4') == id_last_4:
-            return key.split(':')[-1], employee_data # 返回 employee_id 和資料
-    
-    return None, None # 未找到
+    """透過姓名和身分證後四碼查找員工 ID (使用 employee_lookup 索引)"""
+    employee_id = r.hget(EMPLOYEE_LOOKUP_KEY, _employee_lookup_field(name, id_last_4))
+    if not employee_id:
+        return None, None # 未找到
 
-# --- 班別 (Slot) 相關功能 ---
+    employee_data = r.hgetall(_employee_key(employee_id))
+    if not employee_data:
+        return None, None # 索引存在但員工資料已被移除
 
-def get_slot_by_id(slot_id):
-    """獲取單個班別的詳細資訊，包含報名人數"""
-    slot_hash = r.hgetall(f'slot:{slot_id}')
-    if not slot_hash:
+    return employee_id, employee_data # 返回 employee_id 和資料
+
+@metrics.timed
+def get_employee(employee_id):
+    """獲取員工資料 (含 employee_id)，不存在時返回 None"""
+    employee = r.hgetall(_employee_key(employee_id))
+    if not employee:
         return None
+    employee['employee_id'] = employee_id
+    return employee
+
+@metrics.timed
+def search_employees(prefix, limit=10, replica=True):
+    """
+    以姓名或電話前綴搜尋員工 (ZRANGEBYLEX，伺服器端 O(log N + limit))，返回最多 limit 筆
+    [{'employee_id', 'name', 'id_last_4', 'phone'}]，姓名符合的排在前面；固定兩次往返
+    """
+    name_prefix = _search_value(prefix)
+    # 只有數字 (可含空白、-、+、括號) 的查詢才搜尋電話
+    phone_prefix = _phone_digits(prefix) if re.fullmatch(r'[\d\s()+-]+', name_prefix) else ''
+    if not name_prefix:
+        return []
+
+    def read(client):
+        pipe = client.pipeline(transaction=False)
+        pipe.zrangebylex(EMPLOYEE_NAME_INDEX_KEY, *_lex_prefix_range(name_prefix), start=0, num=limit)
+        if phone_prefix:
+            pipe.zrangebylex(EMPLOYEE_PHONE_INDEX_KEY, *_lex_prefix_range(phone_prefix), start=0, num=limit)
+        members = [member for result in pipe.execute() for member in result]
+        employee_ids = list(dict.fromkeys(member.split('\x00', 1)[1] for member in members))[:limit]
+        if not employee_ids:
+            return []
+
+        pipe = client.pipeline(transaction=False)
+        for employee_id in employee_ids:
+            pipe.hmget(_employee_key(employee_id), 'name', 'id_last_4', 'phone')
+        return [{'employee_id': employee_id, 'name': name, 'id_last_4': id_last_4, 'phone': phone}
+                for employee_id, (name, id_last_4, phone) in zip(employee_ids, pipe.execute()) if name is not None]
+
+    return _read(read, replica)
+
+def _queue_employee_indexes(pipe, employee_id, employee, lookup_owner, remove=False):
+    """
+    在 Pipeline 中加入 (或移除) 員工的報名驗證索引與姓名 / 電話搜尋索引；
+    lookup_owner 為報名驗證索引目前指向的 employee_id，移除時只刪除指向此員工的欄位
+    """
+    lookup_field = _employee_lookup_field(employee['name'], employee['id_last_4'])
+    name_member, phone_member = _employee_search_members(employee_id, employee['name'], employee.get('phone'))
+    if remove:
+        if lookup_owner == employee_id:
+            pipe.hdel(EMPLOYEE_LOOKUP_KEY, lookup_field)
+        pipe.zrem(EMPLOYEE_NAME_INDEX_KEY, name_member)
+        if phone_member:
+            pipe.zrem(EMPLOYEE_PHONE_INDEX_KEY, phone_member)
+    else:
+        pipe.hset(EMPLOYEE_LOOKUP_KEY, lookup_field, employee_id)
+        pipe.zadd(EMPLOYEE_NAME_INDEX_KEY, {name_member: 0})
+        if phone_member:
+            pipe.zadd(EMPLOYEE_PHONE_INDEX_KEY, {phone_member: 0})
+
+def _watch_employee(pipe, employee_id):
+    """WATCH 員工資料與報名驗證索引並讀取目前的資料，返回 (employee, 報名驗證索引指向的 employee_id)"""
+    pipe.watch(_employee_key(employee_id), EMPLOYEE_LOOKUP_KEY)
+    employee = pipe.hgetall(_employee_key(employee_id))
+    if not employee:
+        return None, None
+    return employee, pipe.hget(EMPLOYEE_LOOKUP_KEY, _employee_lookup_field(employee['name'], employee['id_last_4']))
+
+@metrics.timed
+def update_employee(employee_id, name, phone):
+    """
+    修改員工姓名與電話 (身分證不可修改)，並以交易同時更新所有索引，返回 (是否成功, 訊息)；
+    新姓名與身分證後四碼和其他員工相同時不修改 (報名時會無法區分)
+    """
+    with r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                employee, lookup_owner = _watch_employee(pipe, employee_id)
+                if not employee:
+                    return False, "員工不存在。"
+                new_owner = pipe.hget(EMPLOYEE_LOOKUP_KEY, _employee_lookup_field(name, employee['id_last_4']))
+                if new_owner not in (None, employee_id):
+                    pipe.unwatch()
+                    return False, CREATE_EMPLOYEE_MESSAGES[2]
+                pipe.multi()
+                _queue_employee_indexes(pipe, employee_id, employee, lookup_owner, remove=True)
+                pipe.hset(_employee_key(employee_id), mapping={'name': name, 'phone': phone})
+                _queue_employee_indexes(pipe, employee_id, dict(employee, name=name, phone=phone), employee_id)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+
+    _touch_employee_slots(employee_id)
+    return True, "更新成功"
+
+@metrics.timed
+def delete_employee(employee_id):
+    """
+    刪除員工資料與所有索引 (含員工班別索引)，員工不存在時返回 False。
+    已報名的班別不會取消，名單中會顯示為「員工資料已刪除」
+    """
+    with r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                employee, lookup_owner = _watch_employee(pipe, employee_id)
+                if not employee:
+                    return False
+                pipe.multi()
+                _queue_employee_indexes(pipe, employee_id, employee, lookup_owner, remove=True)
+                pipe.hdel(EMPLOYEE_INDEX_KEY, employee['id_full'])
+                pipe.delete(_employee_key(employee_id))
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+
+    _touch_employee_slots(employee_id)
+    r.delete(_employee_slots_key(employee_id))
+    return True
+
+def _touch_employee_slots(employee_id):
+    """員工姓名異動或刪除後，遞增其已報名班別的版本號 (名單 JSON API 的 ETag 隨之失效)"""
+    slot_ids = r.zrange(_employee_slots_key(employee_id), 0, -1)
+    if not slot_ids:
+        return
+    pipe = r.pipeline(transaction=False)
+    for slot_id in slot_ids:
+        _touch_slot_script(keys=[_slot_key(slot_id)], client=pipe)
+    pipe.execute()
+
+def backfill_employee_search_index():
+    """為既有員工建立姓名 / 電話搜尋索引 (以 HSCAN 逐批讀取 employee_index)，返回處理筆數"""
+    def index_batch(employee_ids):
+        pipe = r.pipeline(transaction=False)
+        for employee_id in employee_ids:
+            pipe.hmget(_employee_key(employee_id), 'name', 'phone')
+        results = pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        for employee_id, (name, phone) in zip(employee_ids, results):
+            if name is None:
+                continue
+            name_member, phone_member = _employee_search_members(employee_id, name, phone)
+            pipe.zadd(EMPLOYEE_NAME_INDEX_KEY, {name_member: 0})
+            if phone_member:
+                pipe.zadd(EMPLOYEE_PHONE_INDEX_KEY, {phone_member: 0})
+        pipe.execute()
+
+    total = 0
+    batch = []
+    for _, employee_id in r.hscan_iter(EMPLOYEE_INDEX_KEY, count=BATCH_SIZE):
+        batch.append(employee_id)
+        if len(batch) >= BATCH_SIZE:
+            index_batch(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        index_batch(batch)
+        total += len(batch)
+
+    print(f"  已建立 {total} 位員工的搜尋索引")
+    return total
+
+def backfill_employee_lookup():
+    """為既有的 employee:<id> 資料補建 employee_lookup 索引 (舊版鍵，使用 SCAN 分批處理)，返回處理筆數"""
+    total = 0
+    for keys in _scan_primary_keys('employee:*'):
+        pipe = r.pipeline()
+        for key in keys:
+            pipe.hmget(key, 'name', 'id_last_4')
+        results = pipe.execute()
+
+        pipe = r.pipeline()
+        for key, (name, id_last_4) in zip(keys, results):
+            if name and id_last_4:
+                pipe.hset('employee_lookup', _employee_lookup_field(name, id_last_4), key.split(':')[-1])
+        pipe.execute()
+        total += len(keys)
 
-    slot = {k: v for k, v in slot_hash.items()}
+    return total
+
+# --- 唯讀副本 (Replica) ---
+# 首頁、儀表板等唯讀讀取可改由 replica 執行 (replica=True)；報名 / 取消 / 容量檢查一律使用主節點 r。
+# 落後時間以心跳計算：背景執行緒每 REPLICA_HEARTBEAT_INTERVAL 秒把主節點的 TIME 寫入主節點，檢查時從 replica 讀取心跳，
+# 再與主節點目前的 TIME 比較 (兩者都是主節點的時鐘，不受各主機時鐘誤差影響)，
+# 心跳距今超過 _replica_max_lag 秒 (或 replica 無法連線) 時該 replica 暫停使用，改讀主節點。
+
+# 以主節點的 TIME 寫入心跳 (秒，含微秒)；KEYS[1]=replica_heartbeat
+REPLICA_HEARTBEAT_LUA = """
+local t = redis.call('TIME')
+redis.call('SET', KEYS[1], t[1] .. '.' .. string.format('%06d', tonumber(t[2])))
+return 1
+"""
+
+def _new_replica_state(client):
+    return {'client': client, 'healthy': False, 'lag': None, 'checked_at': float('-inf')}
+
+def _replica_lag(heartbeat, primary_time):
+    """由 replica 上讀到的心跳與主節點 TIME ((秒, 微秒)) 計算落後秒數 (沒有心跳時返回 None)"""
+    if not heartbeat:
+        return None
+    seconds, microseconds = primary_time
+    return seconds + microseconds / 1_000_000 - float(heartbeat)
+
+def _check_replica(replica, now):
+    """更新 replica 的落後時間與可用狀態 (先讀 replica 的心跳再讀主節點時間，誤差只會讓落後時間偏大)"""
+    try:
+        heartbeat = replica['client'].get(REPLICA_HEARTBEAT_KEY)
+        lag = _replica_lag(heartbeat, r.time())
+    except redis.RedisError:
+        lag = None
+    replica['lag'] = lag
+    replica['healthy'] = replica['lag'] is not None and replica['lag'] <= _replica_max_lag
+    replica['checked_at'] = now
+
+def _write_replica_heartbeat():
+    """背景執行緒：定期把主節點的 TIME 寫入心跳 (寫入失敗時心跳會逐漸過期，replica 隨之停用)"""
+    while True:
+        try:
+            _replica_heartbeat_script(keys=[REPLICA_HEARTBEAT_KEY])
+        except redis.RedisError:
+            pass
+        time.sleep(REPLICA_HEARTBEAT_INTERVAL)
+
+def _ensure_replica_heartbeat():
+    """第一次使用 replica 或 fork 之後啟動心跳執行緒"""
+    global _replica_heartbeat_pid
+    if _replica_heartbeat_pid == os.getpid():
+        return
+    with _replica_heartbeat_lock:
+        if _replica_heartbeat_pid != os.getpid():
+            _replica_heartbeat_pid = os.getpid()
+            threading.Thread(target=_write_replica_heartbeat, name='replica-heartbeat', daemon=True).start()
+
+def _pick_replica():
+    """輪流選擇一個可用的 replica (每 REPLICA_CHECK_INTERVAL 秒重新檢查落後時間)，都不可用時返回 None"""
+    if not _replicas:
+        return None
+    _ensure_replica_heartbeat()
+    now = time.monotonic()
+    start = next(_replica_counter)
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        if now - replica['checked_at'] >= REPLICA_CHECK_INTERVAL:
+            _check_replica(replica, now)
+        if replica['healthy']:
+            return replica
+    return None
+
+def _read(func, replica=True):
+    """以 func(client) 執行唯讀操作：replica=True 時優先使用可用的 replica，讀取失敗時改用主節點"""
+    chosen = _pick_replica() if replica else None
+    if chosen is not None:
+        try:
+            result = func(chosen['client'])
+            metrics.REDIS_REPLICA_READS.labels('replica').inc()
+            return result
+        except (redis.ConnectionError, redis.TimeoutError):
+            chosen['healthy'] = False # 下次檢查前不再使用
+    if replica and _replicas:
+        metrics.REDIS_REPLICA_READS.labels('primary').inc()
+    return func(r)
+
+def get_replica_status():
+    """各 replica 的可用狀態與最近一次檢查的落後秒數 (監控用)"""
+    return [{'healthy': replica['healthy'], 'lag': replica['lag']} for replica in _replicas]
+
+# --- 班別 (Slot) 相關功能 ---
+
+def _parse_slot(slot_id, slot_data, count):
+    """將 Redis 讀出的班別 Hash (str) 與報名人數轉換為 Python 字典"""
+    slot = {k: v for k, v in slot_data.items()}
+
+    # 將字串轉換回正確的類型
     slot['id'] = slot_id
     slot['is_open'] = slot.get('is_open') == 'True'
     slot['capacity'] = int(slot.get('capacity', 5))
-    
-    # 獲取目前的報名人數
-    slot['current_bookings'] = get_current_booking_count(slot_id)
-    
+    slot['current_bookings'] = int(count) if count else 0
+    slot['version'] = int(slot.get('version', 0))
     return slot
 
-def get_all_slots():
+def _format_booking_time(score):
+    """報名順序 Score (微秒 Unix Timestamp) -> 'YYYY-MM-DD HH:MM:SS'"""
+    return datetime.datetime.fromtimestamp(float(score) / 1_000_000).strftime('%Y-%m-%d %H:%M:%S')
+
+def _parse_bookings(roster, employee_map):
     """
-    獲取所有班別的詳細資訊 (已修正 WRONGTYPE 錯誤)。
-    
-    此處僅獲取 'slot:<id>' 格式的主鍵，過濾掉輔助鍵 (例如: slot:<id>:count)。
+    依報名順序 (roster 為 ZRANGE WITHSCORES 的 (employee_id, score) 列表) 組合報名資料，
+    姓名與身分證後四碼取自 employee_map (employee_id -> [name, id_full])
     """
-    # 1. 獲取所有以 'slot:' 開頭的鍵
-    all_keys = r.keys('slot:*')
-    
-    # 2. **修正邏輯**：過濾出真正的班別 Hash 鍵 (即鍵中只有一個 ':'，格式為 slot:<id>)
-    slot_hash_keys = [key for key in all_keys if len(key.split(':')) == 2]
-    
+    bookings = []
+    for employee_id, score in roster:
+        name, id_full = employee_map.get(employee_id) or (None, None)
+        bookings.append({
+            'employee_id': employee_id,
+            'name': name or "(員工資料已刪除)",
+            'id_last_4': id_full[-4:] if id_full else '',
+            'booking_time': _format_booking_time(score),
+        })
+    return bookings
+
+def _queue_employee_lookups(pipe, employee_ids):
+    """在 Pipeline 中加入讀取員工姓名/身分證的指令，返回去除重複後的 employee_id 列表 (順序同結果)"""
+    unique_ids = list(dict.fromkeys(employee_ids))
+    for employee_id in unique_ids:
+        pipe.hmget(_employee_key(employee_id), 'name', 'id_full')
+    return unique_ids
+
+def _get_employee_map(employee_ids, client=None):
+    """以單一 Pipeline 讀取多位員工的姓名/身分證，返回 employee_id -> [name, id_full]"""
+    if not employee_ids:
+        return {}
+    pipe = (client or r).pipeline(transaction=False)
+    unique_ids = _queue_employee_lookups(pipe, employee_ids)
+    return dict(zip(unique_ids, pipe.execute()))
+
+def _read_slots_with_bookings(slot_ids, client=None):
+    """
+    以兩個 Pipeline 讀取多個班別的 Hash 與報名名單 (第一個讀取班別與 roster，第二個讀取報名者姓名)，
+    返回 (slot_id, slot_data, bookings) 列表；班別不存在時 slot_data 為空字典
+    """
+    pipe = (client or r).pipeline(transaction=False)
+    for slot_id in slot_ids:
+        pipe.hgetall(_slot_key(slot_id))
+        pipe.zrange(_slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+    results = pipe.execute()
+
+    rosters = results[1::2]
+    employee_map = _get_employee_map([e for roster in rosters for e, _ in roster], client)
+    return [(slot_id, slot_data, _parse_bookings(roster, employee_map))
+            for slot_id, slot_data, roster in zip(slot_ids, results[0::2], rosters)]
+
+@metrics.timed
+def get_slot_by_id(slot_id, replica=False):
+    """獲取單個班別的詳細資訊，包含報名人數 (報名流程使用預設的主節點；純顯示頁面可傳 replica=True)"""
+    def read(client):
+        pipe = client.pipeline()
+        pipe.hgetall(_slot_key(slot_id))
+        pipe.zcard(_slot_key(slot_id, 'roster'))
+        return pipe.execute()
+
+    slot_hash, count = _read(read, replica)
+    if not slot_hash:
+        return None
+
+    return _parse_slot(slot_id, slot_hash, count)
+
+@metrics.timed
+def get_all_slots(replica=True):
+    """獲取所有班別的詳細資訊 (透過 all_slots_set 依日期排序，預設從 replica 讀取)"""
+    return _read(_read_all_slots, replica)
+
+def _read_all_slots(client):
+    # 1. 從各分片的 Sorted Set 獲取所有 slot_id 並依 score/日期合併
+    slot_ids = _index_range('all_slots_set', client=client)
+
     all_slots = []
-    if not slot_hash_keys:
+    if not slot_ids:
         return []
 
-    # 3. 使用 Pipeline 一次性獲取所有班別的詳細資訊
-    pipe = r.pipeline()
-    for key in slot_hash_keys:
-        pipe.hgetall(key)
-        
-    slot_data_list = pipe.execute()
-    
-    # 4. 處理並轉換資料
-    for i, slot_data in enumerate(slot_data_list):
-        if slot_data: 
-            key_name = slot_hash_keys[i]
-            slot_id = key_name.split(':')[-1]
-            
-            # 從 Redis (str) 轉換為 Python 字典
-            slot = {k: v for k, v in slot_data.items()}
-            
-            # 將字串轉換回正確的類型
-            slot['id'] = slot_id
-            slot['is_open'] = slot.get('is_open') == 'True' 
-            slot['capacity'] = int(slot.get('capacity', 5))
-            
-            # 獲取目前的報名人數和名單
-            slot['current_bookings'] = get_current_booking_count(slot_id)
-            slot['bookings'] = get_bookings_for_slot(slot_id) 
-            
+    # 2. 以兩個 Pipeline 獲取所有班別的詳細資訊、名單和報名者姓名
+    for slot_id, slot_data, bookings in _read_slots_with_bookings(slot_ids, client):
+        if slot_data:
+            slot = _parse_slot(slot_id, slot_data, len(bookings))
+            slot['bookings'] = bookings
             all_slots.append(slot)
-            
-    # 根據日期排序
-    all_slots.sort(key=lambda s: s['work_date'])
-    
+
     return all_slots
 
-def get_open_slots():
-    """獲取目前開放報名的班別，並按日期排序 (使用 ZSET)"""
-    
-    # 1. 從 Sorted Set 獲取所有開放的 slot_id (按 score/日期升序)
-    slot_ids = r.zrange('open_slots_set', 0, -1) 
+@metrics.timed
+def get_slots_page(start_date=None, end_date=None, offset=0, count=20, replica=True):
+    """
+    依日期區間 (含頭尾，YYYY-MM-DD，省略時不限) 分頁讀取班別與報名人數 (不含名單)，返回 (slots, 區間內班別總數)；
+    儀表板使用，名單由 get_bookings_for_slot 另外讀取
+    """
+    min_score = _date_score(start_date) if start_date else '-inf'
+    max_score = _date_score(end_date) if end_date else '+inf'
+
+    def read(client):
+        slot_ids, total = _index_page('all_slots_set', min_score, max_score, offset, count, client)
+        if not slot_ids:
+            return [], total
+
+        pipe = client.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.hgetall(_slot_key(slot_id))
+            pipe.zcard(_slot_key(slot_id, 'roster'))
+        results = pipe.execute()
+
+        slots = [_parse_slot(slot_id, slot_data, booked)
+                 for slot_id, slot_data, booked in zip(slot_ids, results[0::2], results[1::2]) if slot_data]
+        return slots, total
+
+    return _read(read, replica)
+
+@metrics.timed
+def get_open_slots(replica=True):
+    """獲取目前開放報名的班別，並按日期排序 (使用 ZSET，預設從 replica 讀取)"""
+    return _read(_read_open_slots, replica)
+
+def _read_open_slots(client):
+    # 1. 從各分片的 Sorted Set 獲取今天 (含) 以後開放的 slot_id (按 score/日期合併，日期已過的不再讀取)
+    slot_ids = _index_range('open_slots_set', _today_score(), client=client)
     
     open_slots = []
-    pipe = r.pipeline()
+    if not slot_ids:
+        return []
+
+    # 2. 使用 Pipeline 一次性獲取班別資訊和報名人數 (首頁需要顯示容量)
+    pipe = client.pipeline(transaction=False)
     for slot_id in slot_ids:
-        pipe.hgetall(f'slot:{slot_id}')
-        
-    slot_data_list = pipe.execute()
+        pipe.hgetall(_slot_key(slot_id))
+        pipe.zcard(_slot_key(slot_id, 'roster'))
+
+    results = pipe.execute()
     
-    # 2. 處理資料
-    for i, slot_data in enumerate(slot_data_list):
+    # 3. 處理資料 (每個班別對應 2 個結果)
+    for i, slot_id in enumerate(slot_ids):
+        slot_data, count = results[i * 2:i * 2 + 2]
         if slot_data:
-            slot_id = slot_ids[i]
-            slot = {k: v for k, v in slot_data.items()}
-            
-            slot['id'] = slot_id
-            slot['is_open'] = slot.get('is_open') == 'True'
-            slot['capacity'] = int(slot.get('capacity', 5)) 
-            
-            # 為了首頁顯示容量，必須在這裡取得人數
-            slot['current_bookings'] = get_current_booking_count(slot_id)
+            slot = _parse_slot(slot_id, slot_data, count)
             
             # 只有開放報名的班別才應被列在首頁清單
             if slot['is_open']:
@@ -182,163 +820,1198 @@ def get_open_slots():
     
     return open_slots
 
+@metrics.timed
+def get_open_slots_cached(replica=True):
+    """獲取開放班別 (優先使用 process 內快取，只在 slots_version 改變或 TTL 過期時重新讀取)"""
+    return _read(_read_open_slots_cached, replica)[1]
+
+@metrics.timed
+def get_open_slots_with_version(replica=True):
+    """同 get_open_slots_cached，但同時返回讀取前的 slots_version (JSON API 的 ETag)，返回 (version, slots)"""
+    return _read(_read_open_slots_cached, replica)
+
+@metrics.timed
+def get_slots_version(replica=True):
+    """所有分片的 slots_version (單一 Pipeline)，任何班別或報名異動後即不同"""
+    return _read(_slots_version, replica)
+
+def _read_open_slots_cached(client):
+    # 版本與資料從同一個節點讀取，replica 落後時快取的版本也不會比資料新
+    version = _slots_version(client)
+    now = time.monotonic()
+
+    with _open_slots_cache_lock:
+        if (_open_slots_cache['slots'] is not None
+                and _open_slots_cache['version'] == version
+                and now < _open_slots_cache['expires_at']):
+            return version, _open_slots_cache['slots']
+
+    # 先讀版本再讀資料：若讀取期間有異動，下次檢查時版本不同即會重新讀取
+    slots = _read_open_slots(client)
+
+    with _open_slots_cache_lock:
+        _open_slots_cache['version'] = version
+        _open_slots_cache['expires_at'] = now + OPEN_SLOTS_CACHE_TTL
+        _open_slots_cache['slots'] = slots
+
+    return version, slots
+
+@metrics.timed
 def add_slot(work_date, slot_name, is_open=True, capacity=5):
     """新增一個班別"""
     slot_id = secrets.token_urlsafe(8)
     _create_slot_data(slot_id, work_date, slot_name, is_open, capacity)
     return slot_id
 
+@metrics.timed
+def add_slots_bulk(slots):
+    """批次新增班別 (slots 為已驗證的 dict 列表)，每 SLOTS_PER_PIPELINE 個班別一個 Pipeline，返回 slot_id 列表"""
+    slot_ids = []
+    for start in range(0, len(slots), SLOTS_PER_PIPELINE):
+        pipe = r.pipeline(transaction=False)
+        for slot in slots[start:start + SLOTS_PER_PIPELINE]:
+            slot_id = secrets.token_urlsafe(8)
+            _create_slot_data(slot_id, slot['work_date'], slot['slot_name'], slot['is_open'], slot['capacity'], pipe=pipe)
+            slot_ids.append(slot_id)
+        pipe.execute()
+    return slot_ids
+
+@metrics.timed
 def update_slot(slot_id, work_date, slot_name, is_open, capacity):
-    """更新班別 Hash 資料、容量並重新設定 ZSET 索引"""
-    _create_slot_data(slot_id, work_date, slot_name, is_open, capacity)
+    """更新班別 Hash 資料、容量並重新設定 ZSET 索引 (同時更新報名者班別索引中的日期)"""
+    roster_key = _slot_key(slot_id, 'roster')
+    with r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                # 名單在讀取後被修改 (有人報名/取消) 時重試，確保每位報名者的索引都使用新日期
+                pipe.watch(roster_key)
+                employee_ids = pipe.zrange(roster_key, 0, -1)
+                pipe.multi()
+                _create_slot_data(slot_id, work_date, slot_name, is_open, capacity, pipe=pipe)
+                if not CLUSTER_MODE:
+                    _queue_employee_slot_dates(pipe, slot_id, work_date, employee_ids)
+                    pipe.publish(SLOT_EVENTS_CHANNEL, _slot_event(slot_id, len(employee_ids), capacity, is_open))
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+
+    if CLUSTER_MODE:
+        # 員工班別索引位於其他 hash slot，無法放進同一個交易，改為交易完成後再更新
+        pipe = r.pipeline(transaction=False)
+        _queue_employee_slot_dates(pipe, slot_id, work_date, employee_ids)
+        pipe.publish(SLOT_EVENTS_CHANNEL, _slot_event(slot_id, len(employee_ids), capacity, is_open))
+        pipe.execute()
+
+def _queue_employee_slot_dates(pipe, slot_id, work_date, employee_ids):
+    """在 Pipeline 中加入更新報名者班別索引日期的指令 (只更新已存在的項目)"""
+    for employee_id in employee_ids:
+        pipe.zadd(_employee_slots_key(employee_id), {slot_id: _date_int(work_date)}, xx=True)
 
+@metrics.timed
 def delete_slot(slot_id):
-    """刪除班別及其所有相關數據"""
-    pipe = r.pipeline()
-    pipe.delete(f'slot:{slot_id}')              # 刪除 Hash
-    pipe.delete(f'slot:{slot_id}:count')        # 刪除計數器
-    pipe.delete(f'slot:{slot_id}:bookings')     # 刪除報名名單 List
-    pipe.delete(f'slot:{slot_id}:members')      # 刪除成員集合 Set
-    pipe.zrem('open_slots_set', slot_id)        # 刪除 ZSET 索引
+    """刪除班別及其所有相關數據 (包含每位報名者班別索引中的此班別，以 Lua 腳本原子執行)"""
+    keys = _slot_data_keys(slot_id) + [_slot_index_key(name, slot_id)
+                                       for name in ('open_slots_set', 'all_slots_set', 'slots_version')]
+    if CLUSTER_MODE:
+        # 員工班別索引位於其他 hash slot，無法與班別放在同一個腳本，由腳本返回的名單在之後移除
+        employee_ids = _delete_slot_script(keys=keys, args=[slot_id])
+    else:
+        roster_key = _slot_key(slot_id, 'roster')
+        with r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # 名單在讀取後被修改 (有人報名/取消) 時重試，確保每位報名者的索引都會被移除
+                    pipe.watch(roster_key)
+                    employee_ids = pipe.zrange(roster_key, 0, -1)
+                    pipe.multi()
+                    _delete_slot_script(keys=keys + [_employee_slots_key(e) for e in employee_ids],
+                                        args=[slot_id], client=pipe)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+
+    pipe = r.pipeline(transaction=False)
+    if CLUSTER_MODE:
+        for employee_id in employee_ids:
+            pipe.zrem(_employee_slots_key(employee_id), slot_id)
+    pipe.publish(SLOT_EVENTS_CHANNEL, _slot_event(slot_id, 0, 0, False)) # 已開啟的頁面改顯示為關閉
     pipe.execute()
 
+def backfill_slot_registry():
+    """從既有的 slot:<id> Hash 建立 all_slots_set 索引 (舊版鍵，使用 SCAN 分批處理)，返回處理筆數"""
+    total = 0
+    for keys in _scan_primary_keys('slot:*'):
+        pipe = r.pipeline()
+        for key in keys:
+            pipe.hget(key, 'work_date')
+        work_dates = pipe.execute()
+
+        pipe = r.pipeline()
+        for key, work_date in zip(keys, work_dates):
+            if work_date:
+                pipe.zadd('all_slots_set', {key.split(':')[-1]: _date_score(work_date)})
+        pipe.execute()
+        total += len(keys)
+
+    return total
+
 # --- 報名 (Booking) 相關功能 ---
 
+@metrics.timed
 def is_already_booked(slot_id, employee_id):
-    """檢查該員工是否已報名此班別 (使用 Set)"""
-    return r.sismember(f'slot:{slot_id}:members', employee_id)
+    """檢查該員工是否已報名此班別 (ZSCORE)"""
+    return r.zscore(_slot_key(slot_id, 'roster'), employee_id) is not None
 
+@metrics.timed
 def get_current_booking_count(slot_id):
-    """獲取目前報名人數 (使用計數器 String)"""
-    count = r.get(f'slot:{slot_id}:count')
-    return int(count) if count else 0
-
-def get_bookings_for_slot(slot_id):
-    """獲取所有報名名單 (使用 List)"""
-    # Lrange 返回的是 JSON 字串列表
-    booking_list_json = r.lrange(f'slot:{slot_id}:bookings', 0, -1)
-    # 將 JSON 字串轉換為 Python 字典
-    bookings = [json.loads(b) for b in booking_list_json]
-    # List 是按照報名順序排列的，不需要額外排序
-    return bookings
+    """獲取目前報名人數 (ZCARD)"""
+    return r.zcard(_slot_key(slot_id, 'roster'))
+
+def _booking_score(booking_time):
+    """將報名時間轉換為微秒 Unix Timestamp，作為報名順序 Sorted Set 的 Score"""
+    return int(booking_time.timestamp() * 1_000_000)
+
+@metrics.timed
+def get_bookings_for_slot(slot_id, replica=True):
+    """獲取所有報名名單 (依 roster 的報名順序排列，姓名以 Pipeline 從員工資料取得，預設從 replica 讀取)"""
+    def read(client):
+        roster = client.zrange(_slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+        return _parse_bookings(roster, _get_employee_map([e for e, _ in roster], client))
+    return _read(read, replica)
+
+@metrics.timed
+def get_bookings_with_version(slot_id, replica=True):
+    """
+    同 get_bookings_for_slot，但同時返回班別的版本號 (與名單在同一個 Pipeline 讀取)，返回 (version, bookings)；
+    班別不存在時 version 為 None
+    """
+    def read(client):
+        pipe = client.pipeline(transaction=False)
+        pipe.hmget(_slot_key(slot_id), 'version', 'work_date')
+        pipe.zrange(_slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+        (version, work_date), roster = pipe.execute()
+        if not work_date:
+            return None, []
+        return int(version or 0), _parse_bookings(roster, _get_employee_map([e for e, _ in roster], client))
+    return _read(read, replica)
+
+@metrics.timed
+def get_slot_version(slot_id, replica=True):
+    """班別的版本號 (班別資料或名單異動時遞增，單一 HMGET)，班別不存在時返回 None"""
+    version, work_date = _read(lambda client: client.hmget(_slot_key(slot_id), 'version', 'work_date'), replica)
+    if not work_date:
+        return None
+    return int(version or 0)
+
+@metrics.timed
+def get_booking(slot_id, employee_id):
+    """獲取單筆報名資料 (報名時間與員工資料在同一個 Pipeline 取得)，不存在時返回 None"""
+    pipe = r.pipeline(transaction=False)
+    pipe.zscore(_slot_key(slot_id, 'roster'), employee_id)
+    pipe.hmget(_employee_key(employee_id), 'name', 'id_full')
+    score, employee = pipe.execute()
+    if score is None:
+        return None
+    return _parse_bookings([(employee_id, score)], {employee_id: employee})[0]
+
+# 原子報名腳本：在 Redis 伺服器端一次完成狀態、重複、容量檢查與寫入 (同時更新班別版本號、員工的班別索引並發布人數變化)
+# KEYS[1]=slot:{<shard>}:<id>  KEYS[2]=slot:{<shard>}:<id>:roster  KEYS[3]=slots_version:{<shard>}
+# KEYS[4]=employee_slots:<employee_id> (可省略：Cluster 模式下位於其他 hash slot，由呼叫端另外更新)
+# ARGV[1]=employee_id  ARGV[2]=報名順序 Score (報名時間微秒)  ARGV[3]=slot_id  ARGV[4]=事件頻道
+# 返回值：ok / full / duplicate / closed / missing
+BOOK_SLOT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 'missing'
+end
+local slot = redis.call('HMGET', KEYS[1], 'is_open', 'capacity', 'work_date')
+if slot[1] ~= 'True' then
+    return 'closed'
+end
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 'duplicate'
+end
+local capacity = tonumber(slot[2]) or 5
+if redis.call('ZCARD', KEYS[2]) >= capacity then
+    return 'full'
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('INCR', KEYS[3])
+redis.call('PUBLISH', ARGV[4], string.format('{"id":"%s","booked":%d,"capacity":%d,"open":true}',
+    ARGV[3], redis.call('ZCARD', KEYS[2]), capacity))
+if KEYS[4] then
+    local date_score = tonumber((string.gsub(slot[3] or '', '-', ''))) or 0
+    redis.call('ZADD', KEYS[4], date_score, ARGV[3])
+end
+return 'ok'
+"""
+
+# 原子取消報名腳本：只有在報名存在時才移除 (並更新班別版本號、發布人數變化)
+# KEYS 同 BOOK_SLOT_LUA；ARGV[1]=employee_id  ARGV[2]=slot_id  ARGV[3]=事件頻道
+# 返回值：1 (已刪除) / 0 (不存在)
+CANCEL_BOOKING_LUA = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('INCR', KEYS[3])
+if KEYS[4] then
+    redis.call('ZREM', KEYS[4], ARGV[2])
+end
+local slot = redis.call('HMGET', KEYS[1], 'is_open', 'capacity')
+redis.call('PUBLISH', ARGV[3], string.format('{"id":"%s","booked":%d,"capacity":%d,"open":%s}',
+    ARGV[2], redis.call('ZCARD', KEYS[2]), tonumber(slot[2]) or 5, slot[1] == 'True' and 'true' or 'false'))
+return 1
+"""
+
+# 原子刪除班別腳本：刪除班別鍵與索引，並從每位報名者的班別索引移除此班別
+# KEYS[1]=slot:{<shard>}:<id>  KEYS[2]=slot:{<shard>}:<id>:roster
+# KEYS[3]=open_slots_set:{<shard>}  KEYS[4]=all_slots_set:{<shard>}  KEYS[5]=slots_version:{<shard>}
+# KEYS[6..]=報名者的 employee_slots:<employee_id> (呼叫端先 WATCH 並讀取名單；Cluster 模式下不傳，由呼叫端處理)
+# ARGV[1]=slot_id
+# 返回值：刪除前的報名名單 (employee_id 列表)
+DELETE_SLOT_LUA = """
+local roster = redis.call('ZRANGE', KEYS[2], 0, -1)
+for i = 6, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('INCR', KEYS[5])
+return roster
+"""
+
+# 原子批次報名腳本：先檢查所有班別，再依模式寫入 (每個班別的檢查與 BOOK_SLOT_LUA 相同)
+# KEYS 為每個班別 3 個鍵 (slot、roster、slots_version，順序同 ARGV[5..])，最後可再加上 employee_slots:<employee_id>
+# ARGV[1]=employee_id  ARGV[2]=報名順序 Score  ARGV[3]=事件頻道  ARGV[4]=all (全部可報名才寫入) / any (盡量報名)
+# ARGV[5..]=slot_id
+# 返回值：每個班別 {結果代碼, work_date, slot_name}；all 模式有班別失敗時不寫入任何報名，可報名的班別為 aborted
+BOOK_SLOTS_LUA = """
+local count = #ARGV - 4
+local employee_slots = KEYS[count * 3 + 1]
+local results = {}
+local capacities = {}
+local failed = false
+for i = 1, count do
+    local slot = redis.call('HMGET', KEYS[i * 3 - 2], 'is_open', 'capacity', 'work_date', 'slot_name')
+    capacities[i] = tonumber(slot[2]) or 5
+    local status = 'ok'
+    if redis.call('EXISTS', KEYS[i * 3 - 2]) == 0 then
+        status = 'missing'
+    elseif slot[1] ~= 'True' then
+        status = 'closed'
+    elseif redis.call('ZSCORE', KEYS[i * 3 - 1], ARGV[1]) then
+        status = 'duplicate'
+    elseif redis.call('ZCARD', KEYS[i * 3 - 1]) >= capacities[i] then
+        status = 'full'
+    end
+    failed = failed or status ~= 'ok'
+    results[i] = {status, slot[3] or '', slot[4] or ''}
+end
+for i = 1, count do
+    if results[i][1] == 'ok' then
+        if failed and ARGV[4] == 'all' then
+            results[i][1] = 'aborted'
+        else
+            redis.call('ZADD', KEYS[i * 3 - 1], ARGV[2], ARGV[1])
+            redis.call('HINCRBY', KEYS[i * 3 - 2], 'version', 1)
+            redis.call('INCR', KEYS[i * 3])
+            redis.call('PUBLISH', ARGV[3], string.format('{"id":"%s","booked":%d,"capacity":%d,"open":true}',
+                ARGV[4 + i], redis.call('ZCARD', KEYS[i * 3 - 1]), capacities[i]))
+            if employee_slots then
+                redis.call('ZADD', employee_slots, tonumber((string.gsub(results[i][2], '-', ''))) or 0, ARGV[4 + i])
+            end
+        end
+    end
+end
+return results
+"""
 
+# 遞增班別版本號 (班別已被刪除時不會重新建立 Hash)
+# KEYS[1]=slot:{<shard>}:<id>
+TOUCH_SLOT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], 'version', 1)
+end
+return 0
+"""
+
+# 報名腳本結果代碼 -> 顯示訊息
+BOOKING_MESSAGES = {
+    'ok': "報名成功",
+    'full': "報名失敗：該班別已額滿。",
+    'duplicate': "您已報名此班別，請勿重複報名。",
+    'closed': "該班別已關閉報名。",
+    'missing': "該班別不存在。",
+    'aborted': "未報名：同批次中有其他班別無法報名。",
+}
+
+def _book_slot_keys(slot_id, employee_id):
+    """BOOK_SLOT_LUA 使用的 KEYS (Cluster 模式下不含員工班別索引)"""
+    keys = _slot_data_keys(slot_id) + [_slot_index_key('slots_version', slot_id)]
+    if not CLUSTER_MODE:
+        keys.append(_employee_slots_key(employee_id))
+    return keys
+
+def _book_slot_args(slot_id, employee_id):
+    """BOOK_SLOT_LUA 使用的 ARGV (employee_id、報名順序 Score、slot_id 與事件頻道)"""
+    return [employee_id, _booking_score(datetime.datetime.now()), slot_id, SLOT_EVENTS_CHANNEL]
+
+def _book_slots_calls(slot_ids, employee_id, all_or_nothing):
+    """
+    BOOK_SLOTS_LUA 的呼叫列表 [(slot_ids, keys, args)]：單機 / 主從模式只有一次呼叫；
+    Cluster 模式下不同分片的班別位於不同 hash slot，依分片各呼叫一次 (不含員工班別索引)
+    """
+    groups = {}
+    for slot_id in slot_ids:
+        groups.setdefault(_slot_shard(slot_id) if CLUSTER_MODE else None, []).append(slot_id)
+
+    score = _booking_score(datetime.datetime.now())
+    calls = []
+    for group in groups.values():
+        keys = [key for slot_id in group for key in _book_slot_keys(slot_id, employee_id)[:3]]
+        if not CLUSTER_MODE:
+            keys.append(_employee_slots_key(employee_id))
+        args = [employee_id, score, SLOT_EVENTS_CHANNEL, 'all' if all_or_nothing else 'any'] + group
+        calls.append((group, keys, args))
+    return calls
+
+def _book_slots_results(slot_ids, calls, replies, all_or_nothing):
+    """
+    合併各次 BOOK_SLOTS_LUA 的結果，返回 (結果列表, 需要取消的 slot_id, 需要寫入員工班別索引的 {slot_id: 日期})；
+    後兩者只在 Cluster 模式下有內容 (跨分片的 all 模式無法在單一腳本完成，有分片失敗時取消其他分片已寫入的報名)
+    """
+    replies_by_id = {slot_id: reply for (group, _, _), group_replies in zip(calls, replies)
+                     for slot_id, reply in zip(group, group_replies)}
+    booked = [slot_id for slot_id in slot_ids if replies_by_id[slot_id][0] == 'ok']
+    rollback, employee_slots = [], {}
+    if CLUSTER_MODE:
+        if all_or_nothing and len(booked) < len(slot_ids):
+            rollback = booked
+        else:
+            employee_slots = {slot_id: _date_int(replies_by_id[slot_id][1]) for slot_id in booked}
+
+    results = []
+    for slot_id in slot_ids:
+        code, work_date, slot_name = replies_by_id[slot_id]
+        code = 'aborted' if slot_id in rollback else code
+        metrics.BOOKING_OUTCOMES.labels(code, 'batch').inc()
+        results.append({'slot_id': slot_id, 'work_date': work_date, 'slot_name': slot_name,
+                        'result': code, 'message': BOOKING_MESSAGES[code]})
+    return results, rollback, employee_slots
+
+def _cancel_booking_keys(slot_id, employee_id):
+    """CANCEL_BOOKING_LUA 使用的 KEYS (與 BOOK_SLOT_LUA 相同)"""
+    return _book_slot_keys(slot_id, employee_id)
+
+def _cancel_booking_args(slot_id, employee_id):
+    """CANCEL_BOOKING_LUA 使用的 ARGV"""
+    return [employee_id, slot_id, SLOT_EVENTS_CHANNEL]
+
+def _slot_event(slot_id, booked, capacity, is_open):
+    """班別人數變化事件 (格式與 Lua 腳本發布的相同)"""
+    return json.dumps({'id': slot_id, 'booked': booked, 'capacity': capacity, 'open': is_open},
+                      separators=(',', ':'))
+
+@metrics.timed
 def add_booking(slot_id, work_date, employee_id, employee_name, id_last_4):
-    """新增報名記錄 (使用 List 儲存 JSON，並增加計數器和 Set 索引)"""
-    
-    # 1. 檢查是否已滿
-    slot = get_slot_by_id(slot_id)
-    if not slot or slot['current_bookings'] >= slot['capacity']:
-        return False, "該班別已額滿或不存在。"
-    
-    # 2. 檢查是否已報名
-    if is_already_booked(slot_id, employee_id):
-        return False, "您已報名此班別，請勿重複報名。"
+    """新增報名記錄 (透過 Lua 腳本原子地檢查容量/重複並寫入名單；姓名於讀取時從員工資料取得)"""
+    # 單次往返：腳本在伺服器端原子執行，不會因為併發而出現 WatchError
+    result = _book_slot_script(keys=_book_slot_keys(slot_id, employee_id), args=_book_slot_args(slot_id, employee_id))
+    metrics.BOOKING_OUTCOMES.labels(result, 'direct').inc()
+    if CLUSTER_MODE and result == 'ok':
+        r.zadd(_employee_slots_key(employee_id), {slot_id: _date_int(work_date)})
+    return result == 'ok', BOOKING_MESSAGES[result]
 
-    # 3. 執行報名操作 (使用 Transaction / Pipeline + WATCH)
-    booking_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 報名資料 (存入 List)
-    booking_data = {
-        'employee_id': employee_id,
-        'name': employee_name,
-        'id_last_4': id_last_4,
-        'booking_time': booking_time
-    }
-    
-    # 使用 WATCH + MULTI/EXEC 確保報名人數檢查是原子操作
-    pipe = r.pipeline()
-    
-    # Watch count key to prevent race condition on capacity check
-    pipe.watch(f'slot:{slot_id}:count') 
+@metrics.timed
+def add_bookings(slot_ids, employee_id, all_or_nothing=True):
+    """
+    一次報名多個班別 (重複的 slot_id 只報名一次)，返回每個班別的結果列表
+    [{'slot_id', 'work_date', 'slot_name', 'result', 'message'}]，順序同 slot_ids。
+    all_or_nothing=True 時所有班別都可報名才寫入，否則盡量報名。
+    單機 / 主從模式為單一 Lua 腳本 (一次往返)；Cluster 模式依分片以一個 Pipeline 執行，
+    all 模式有分片失敗時再以一個 Pipeline 取消其他分片已寫入的報名
+    """
+    slot_ids = list(dict.fromkeys(slot_ids))
+    if not slot_ids:
+        return []
 
-    # Re-check capacity within the watch block
-    current_count = r.get(f'slot:{slot_id}:count')
-    current_count = int(current_count) if current_count else 0
-    
-    if current_count < slot['capacity']:
-        # 開始交易
-        pipe.multi() 
-        
-        # 增加報名人數計數器
-        pipe.incr(f'slot:{slot_id}:count')
-        # 將報名資料推入 List (儲存 JSON 字串)
-        pipe.rpush(f'slot:{slot_id}:bookings', json.dumps(booking_data))
-        # 將員工 ID 加入 Set (用於快速檢查是否已報名)
-        pipe.sadd(f'slot:{slot_id}:members', employee_id)
-        
-        try:
-            pipe.execute() # 執行交易
-            return True, "報名成功"
-        except redis.exceptions.WatchError:
-            # WatchError 表示在 WATCH 期間 key 被修改，需重試
-            return False, "系統忙碌，請重試報名。"
+    calls = _book_slots_calls(slot_ids, employee_id, all_or_nothing)
+    if len(calls) == 1:
+        replies = [_book_slots_script(keys=calls[0][1], args=calls[0][2])]
     else:
-        # 容量已滿
-        pipe.unwatch()
-        return False, "報名失敗：該班別已額滿。"
+        pipe = r.pipeline(transaction=False)
+        for _, keys, args in calls:
+            _book_slots_script(keys=keys, args=args, client=pipe)
+        replies = pipe.execute()
 
+    results, rollback, employee_slots = _book_slots_results(slot_ids, calls, replies, all_or_nothing)
+    if rollback:
+        pipe = r.pipeline(transaction=False)
+        for slot_id in rollback:
+            _cancel_booking_script(keys=_cancel_booking_keys(slot_id, employee_id),
+                                   args=_cancel_booking_args(slot_id, employee_id), client=pipe)
+        pipe.execute()
+    if employee_slots:
+        r.zadd(_employee_slots_key(employee_id), employee_slots)
+    return results
 
+@metrics.timed
 def delete_booking(slot_id, employee_id):
-    """刪除特定報名者 (使用 List 的 LREM，並減少計數器和 Set 索引)"""
-    
-    booking_key = f'slot:{slot_id}:bookings'
-    members_key = f'slot:{slot_id}:members' 
-    
-    # 1. 找出要刪除的報名記錄的 JSON 字串
-    bookings = get_bookings_for_slot(slot_id)
-    target_booking_json = None
-    
-    for booking in bookings:
-        if booking['employee_id'] == employee_id:
-            target_booking_json = json.dumps(booking)
-            break
+    """刪除特定報名者 (以 employee_id 直接從名單移除)"""
+    deleted = _cancel_booking_script(keys=_cancel_booking_keys(slot_id, employee_id),
+                                     args=_cancel_booking_args(slot_id, employee_id))
+    if CLUSTER_MODE and deleted == 1:
+        r.zrem(_employee_slots_key(employee_id), slot_id)
+    return deleted == 1
+
+def migrate_booking_lists():
+    """將舊的 slot:<id>:bookings List 轉換為 roster (Sorted Set)，返回處理的班別數"""
+    total = 0
+    for keys in _scan_primary_keys('slot:*'):
+        slot_ids = [key.split(':')[-1] for key in keys]
 
-    if target_booking_json:
         pipe = r.pipeline()
-        
-        # 刪除 List 中的 JSON 字串 (只刪除一個)
-        pipe.lrem(booking_key, 1, target_booking_json)
-        # 從 Set 中刪除員工 ID
-        pipe.srem(members_key, employee_id)
-        # 減少計數器
-        pipe.decr(f'slot:{slot_id}:count')
-        
+        for slot_id in slot_ids:
+            pipe.lrange(_legacy_slot_key(slot_id, 'bookings'), 0, -1)
+        booking_lists = pipe.execute()
+
+        pipe = r.pipeline()
+        for slot_id, booking_list_json in zip(slot_ids, booking_lists):
+            if not booking_list_json:
+                continue
+            roster = {}
+            for index, booking_json in enumerate(booking_list_json):
+                booking = json.loads(booking_json)
+                booking_time = datetime.datetime.strptime(booking['booking_time'], '%Y-%m-%d %H:%M:%S')
+                # 同一秒內的報名以原 List 的順序排列
+                roster[booking['employee_id']] = _booking_score(booking_time) + index
+            pipe.zadd(_legacy_slot_key(slot_id, 'roster'), roster)
+            pipe.delete(_legacy_slot_key(slot_id, 'bookings'))
+            total += 1
         pipe.execute()
-        return True
-    return False
+
+    return total
+
+@metrics.timed
+def get_employee_shifts(employee_id, from_date=None):
+    """
+    獲取員工已報名、日期在 from_date (YYYY-MM-DD，含；預設今天) 以後的班別 (依日期排序)。
+    固定兩次往返：一次讀取員工班別索引，一次以 Pipeline 讀取所有班別、報名時間與報名人數。
+    """
+    from_date = from_date or datetime.date.today().isoformat()
+    slot_ids = r.zrangebyscore(_employee_slots_key(employee_id), _date_int(from_date), '+inf')
+    if not slot_ids:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for slot_id in slot_ids:
+        pipe.hgetall(_slot_key(slot_id))
+        pipe.zscore(_slot_key(slot_id, 'roster'), employee_id)
+        pipe.zcard(_slot_key(slot_id, 'roster'))
+    results = pipe.execute()
+
+    shifts = []
+    for slot_id, slot_data, score, count in zip(slot_ids, results[0::3], results[1::3], results[2::3]):
+        if slot_data and score is not None:
+            slot = _parse_slot(slot_id, slot_data, count)
+            slot['booking_time'] = _format_booking_time(score)
+            shifts.append(slot)
+    return shifts
+
+def backfill_employee_slots():
+    """從每個班別的報名名單建立 employee_slots:<employee_id> 索引 (舊版鍵)，返回處理的班別數"""
+    total = 0
+    offset = 0
+    while True:
+        slot_ids = r.zrange('all_slots_set', offset, offset + SLOTS_PER_PIPELINE - 1)
+        if not slot_ids:
+            return total
+        offset += len(slot_ids)
+
+        pipe = r.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.hget(_legacy_slot_key(slot_id), 'work_date')
+            pipe.zrange(_legacy_slot_key(slot_id, 'roster'), 0, -1)
+        results = pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        for slot_id, work_date, employee_ids in zip(slot_ids, results[0::2], results[1::2]):
+            if not work_date:
+                continue
+            for employee_id in employee_ids:
+                pipe.zadd(_employee_slots_key(employee_id), {slot_id: _date_int(work_date)})
+        pipe.execute()
+        total += len(slot_ids)
+
+def migrate_to_hash_tagged_keys():
+    """
+    將舊版未分片的鍵搬到 hash tag 格式 (slot:<id> -> slot:{<shard>}:<id>、employee:<id> -> employee:{emp}:<id>)，
+    並重建各分片的班別索引。只適用於單機 Redis (既有資料不會在 Cluster 上)，返回搬移的班別數
+    """
+    if CLUSTER_MODE:
+        # Cluster 上不會有舊版格式的資料；此外 Cluster Pipeline 不支援一次 DELETE 多個鍵
+        print("  Cluster 模式：沒有舊版格式的資料，略過")
+        return 0
+
+    total = 0
+    for keys in _scan_primary_keys('slot:*'):
+        slot_ids = [key.split(':')[-1] for key in keys]
+
+        pipe = r.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.hgetall(_legacy_slot_key(slot_id))
+            pipe.zrange(_legacy_slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+            pipe.zscore('open_slots_set', slot_id)
+        results = pipe.execute()
+
+        pipe = r.pipeline()
+        for i, slot_id in enumerate(slot_ids):
+            slot_data, roster, open_score = results[i * 3:i * 3 + 3]
+            if not slot_data.get('work_date'):
+                continue
+            timestamp = _date_score(slot_data['work_date'])
+            pipe.hset(_slot_key(slot_id), mapping=slot_data)
+            if roster:
+                pipe.zadd(_slot_key(slot_id, 'roster'), dict(roster))
+            pipe.zadd(_slot_index_key('all_slots_set', slot_id), {slot_id: timestamp})
+            if open_score is not None: # 保留舊索引的狀態 (已過日期而被移除的班別不再加入)
+                pipe.zadd(_slot_index_key('open_slots_set', slot_id), {slot_id: timestamp})
+            pipe.delete(_legacy_slot_key(slot_id), _legacy_slot_key(slot_id, 'roster'))
+            total += 1
+        pipe.execute()
+
+    pipe = r.pipeline()
+    pipe.delete('open_slots_set', 'all_slots_set', 'slots_version')
+    for key in _shard_keys('slots_version'):
+        pipe.incr(key)
+    pipe.execute()
+
+    employees = 0
+    for keys in _scan_primary_keys('employee:*'):
+        pipe = r.pipeline()
+        for key in keys:
+            pipe.rename(key, _employee_key(key.split(':')[-1]))
+        pipe.execute()
+        employees += len(keys)
+    for old_key, new_key in (('employee_index', EMPLOYEE_INDEX_KEY), ('employee_lookup', EMPLOYEE_LOOKUP_KEY)):
+        if r.exists(old_key):
+            r.rename(old_key, new_key)
+
+    print(f"  已搬移 {total} 個班別、{employees} 位員工")
+    return total
+
+# 舊版每個班別額外的報名鍵：人數計數器、報名資料 JSON、唯一性 Set (已改為 roster 的 ZCARD / ZSCORE 與員工資料)
+LEGACY_BOOKING_KEYS = ('count', 'booking_data', 'members')
+
+def _memory_usage(keys):
+    """以 Pipeline 加總多個鍵的 MEMORY USAGE (bytes)；不存在的鍵為 0，伺服器不支援時返回 None"""
+    if not keys:
+        return 0
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    results = pipe.execute(raise_on_error=False)
+    if any(isinstance(result, Exception) for result in results):
+        return None
+    return sum(result or 0 for result in results)
+
+def _legacy_slot_keys(slot_id):
+    """舊版 (未分片) 班別的所有鍵：班別本身、報名 List / roster 與已淘汰的報名鍵"""
+    return [_legacy_slot_key(slot_id, field) for field in (None, 'bookings', 'roster') + LEGACY_BOOKING_KEYS]
+
+MEMORY_BASELINE_KEY = 'memory_baseline'
+
+def record_booking_memory_baseline():
+    """
+    在 booking_roster 遷移前記錄舊版班別鍵 (含 slot:<id>:bookings List) 的 MEMORY USAGE，
+    供 compact_booking_storage 比較整個報名資料精簡前後的用量。返回記錄的 bytes (伺服器不支援時為 None)
+    """
+    total = 0
+    for keys in _scan_primary_keys('slot:*'):
+        slot_ids = [key.split(':')[-1] for key in keys]
+        usage = _memory_usage([key for slot_id in slot_ids for key in _legacy_slot_keys(slot_id)])
+        if usage is None:
+            return None
+        total += usage
+    if total: # 沒有舊版班別 (新資料庫或已遷移) 時不需要基準值
+        r.hset(MEMORY_BASELINE_KEY, 'booking_storage', total)
+    return total
+
+def compact_booking_storage():
+    """
+    刪除舊版的 slot:<id>:count / booking_data / members (報名人數改為 ZCARD、重複檢查改為 ZSCORE、
+    姓名於讀取時從員工資料取得)，並輸出遷移前後班別鍵的 MEMORY USAGE
+    (遷移前的用量為 booking_roster 遷移之前記錄的基準值；沒有基準值時為此步驟開始時的用量)。返回處理的班別數
+    """
+    total = 0
+    before = after = 0
+    for keys in _scan_primary_keys('slot:*'):
+        slot_ids = [key.split(':')[-1] for key in keys]
+        current_keys = [_legacy_slot_key(slot_id, field) for slot_id in slot_ids for field in (None, 'roster')]
+        legacy_keys = [_legacy_slot_key(slot_id, field) for slot_id in slot_ids for field in LEGACY_BOOKING_KEYS]
+
+        batch_before = _memory_usage(current_keys + legacy_keys)
+        r.delete(*legacy_keys)
+        batch_after = _memory_usage(current_keys)
+        if batch_before is None or batch_after is None or before is None:
+            before = after = None
+        else:
+            before += batch_before
+            after += batch_after
+        total += len(slot_ids)
+
+    baseline = r.hget(MEMORY_BASELINE_KEY, 'booking_storage')
+    r.hdel(MEMORY_BASELINE_KEY, 'booking_storage')
+    if before is not None and baseline is not None:
+        before = int(baseline)
+
+    if before is None:
+        print(f"  已精簡 {total} 個班別 (伺服器不支援 MEMORY USAGE，無法比較記憶體用量)")
+    else:
+        print(f"  已精簡 {total} 個班別：MEMORY USAGE {before} bytes -> {after} bytes")
+    return total
+
+def _legacy_memory_batches():
+    """逐批產生舊版 (尚未搬到 hash tag 格式) 班別的 (班別數, 報名數, 所有鍵)"""
+    for keys in _scan_primary_keys('slot:*'):
+        slot_ids = [key.split(':')[-1] for key in keys]
+        pipe = r.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.zcard(_legacy_slot_key(slot_id, 'roster'))
+            pipe.llen(_legacy_slot_key(slot_id, 'bookings'))
+        yield len(slot_ids), sum(pipe.execute()), [key for slot_id in slot_ids for key in _legacy_slot_keys(slot_id)]
+
+def _memory_batches(page_size):
+    """逐批產生目前格式班別的 (班別數, 報名數, 所有鍵)"""
+    for slot_ids in _iter_index_batches('all_slots_set', page_size):
+        pipe = r.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.zcard(_slot_key(slot_id, 'roster'))
+        yield len(slot_ids), sum(pipe.execute()), [key for slot_id in slot_ids for key in _slot_data_keys(slot_id)]
+
+def memory_report(page_size=SLOTS_PER_PIPELINE):
+    """
+    統計線上班別相關鍵與封存資料的 MEMORY USAGE，
+    返回 {'slots', 'bookings', 'slot_bytes', 'archive_bytes'} (伺服器不支援時 bytes 為 None)。
+    尚未執行 hash_tagged_keys 遷移的資料庫改為以 SCAN 統計舊版的鍵 (包含 slot:<id>:bookings 等舊報名鍵)，
+    因此可在 migrate 前後各執行一次比較。
+    """
+    legacy = not CLUSTER_MODE and not r.sismember('schema_migrations', 'hash_tagged_keys')
+    batches = _legacy_memory_batches() if legacy else _memory_batches(page_size)
+
+    report = {'slots': 0, 'bookings': 0, 'slot_bytes': 0, 'archive_bytes': 0}
+    for slots, bookings, keys in batches:
+        report['slots'] += slots
+        report['bookings'] += bookings
+        usage = _memory_usage(keys)
+        report['slot_bytes'] = None if usage is None or report['slot_bytes'] is None else report['slot_bytes'] + usage
+
+    report['archive_bytes'] = _memory_usage([_archive_key(month) for month in get_archive_months()])
+    return report
+
+def _booking_row(slot_id, slot_data, booking):
+    """匯出用的單筆報名資料 (欄位順序同 EXPORT_FIELDS)"""
+    return {
+        'work_date': slot_data.get('work_date'),
+        'slot_id': slot_id,
+        'slot_name': slot_data.get('slot_name'),
+        'employee_id': booking['employee_id'],
+        'name': booking['name'],
+        'id_last_4': booking['id_last_4'],
+        'booking_time': booking['booking_time'],
+    }
+
+def iter_bookings(start_date=None, end_date=None, page_size=SLOTS_PER_PIPELINE):
+    """
+    依日期順序逐筆產生指定日期區間 (含頭尾，YYYY-MM-DD) 內所有班別的報名資料。
+    以各分片 all_slots_set 的 (score, 同分已讀筆數) 作為游標分頁讀取並依日期合併，每頁一個 Pipeline，
+    不會一次載入全部資料，也不會以長時間指令阻塞 Redis。
+    """
+    min_score = _date_score(start_date) if start_date else '-inf'
+    max_score = _date_score(end_date) if end_date else '+inf'
+    slot_ids = (slot_id for slot_id, _ in _iter_index('all_slots_set', min_score, max_score, page_size))
+
+    while True:
+        page = list(itertools.islice(slot_ids, page_size))
+        if not page:
+            return
+
+        for slot_id, slot_data, bookings in _read_slots_with_bookings(page):
+            if not slot_data:
+                continue # 讀取期間被刪除
+            for booking in bookings:
+                yield _booking_row(slot_id, slot_data, booking)
+
+EXPORT_FIELDS = ['work_date', 'slot_id', 'slot_name', 'employee_id', 'name', 'id_last_4', 'booking_time']
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+def _iter_all_bookings(start_date=None, end_date=None):
+    """先產生已封存的報名資料，再產生仍在線上的報名資料 (封存的班別日期都較早)"""
+    yield from iter_archived_bookings(start_date, end_date)
+    yield from iter_bookings(start_date, end_date)
+
+def export_bookings(start_date=None, end_date=None, fmt='csv'):
+    """將報名資料 (含已封存的班別) 逐行轉為 CSV (含標題列) 或 JSONL 文字，供串流回應或寫檔使用"""
+    if fmt == 'jsonl':
+        for row in _iter_all_bookings(start_date, end_date):
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for row in _iter_all_bookings(start_date, end_date):
+        writer.writerow(row)
+        if buffer.tell() > 65536: # 累積約 64KB 再送出一次，減少小片段
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# --- 歷史班別封存 (Archive) 相關功能 ---
+# 已結束的班別會從 slot:<id> 等鍵搬到每月一個的 archive:<YYYY-MM> Hash (slot_id -> 壓縮後的 JSON)，
+# 線上的鍵與索引只與尚未結束的班別數量成正比；封存資料仍可透過 get_archived_slots / 匯出功能讀取
+
+def _archive_key(month):
+    return f'archive:{month}'
+
+def _encode_archive(record):
+    """班別資料 -> zlib 壓縮後的 base64 字串 (客戶端使用 decode_responses，因此不直接存 bytes)"""
+    return base64.b64encode(zlib.compress(json.dumps(record, ensure_ascii=False).encode('utf-8'))).decode('ascii')
+
+def _decode_archive(value):
+    return json.loads(zlib.decompress(base64.b64decode(value)))
+
+@metrics.timed
+def prune_open_slots(today=None):
+    """以每個分片一個 ZREMRANGEBYSCORE 從開放班別索引移除日期早於 today (YYYY-MM-DD) 的班別，返回移除數量"""
+    today = today or datetime.date.today().isoformat()
+    pipe = r.pipeline(transaction=False)
+    for key in _shard_keys('open_slots_set'):
+        pipe.zremrangebyscore(key, '-inf', f'({_date_score(today)}')
+    removed = pipe.execute()
+
+    # 讓有異動的分片的首頁快取失效
+    pipe = r.pipeline(transaction=False)
+    for shard, count in enumerate(removed):
+        if count:
+            pipe.incr(_shard_key('slots_version', shard))
+    pipe.execute()
+    return sum(removed)
+
+@metrics.timed
+def archive_slots(before_date, batch_size=SLOTS_PER_PIPELINE):
+    """
+    將日期早於 before_date (YYYY-MM-DD，不含) 的班別連同報名名單封存到 archive:<YYYY-MM>，
+    並刪除原本的班別鍵與索引。分批處理：每批先關閉報名 (之後的報名腳本都會失敗，讀到的名單不會再增加)，
+    再以一個讀取 Pipeline 與一個寫入交易封存並刪除 (封存與刪除同時生效；Cluster 模式下各鍵位於不同 hash slot，
+    改為依序寫入的 Pipeline，中斷後重新執行會覆寫相同的封存資料)。
+    返回封存的班別數。
+    """
+    max_score = f'({_date_score(before_date)}'
+    archived = 0
+
+    while True:
+        slot_ids = _index_range('all_slots_set', '-inf', max_score, count=batch_size)
+        if not slot_ids:
+            return archived
+
+        # 先關閉報名並記下原本的狀態 (不存在的班別會留下只有 is_open 的 Hash，下方會一併刪除)
+        pipe = r.pipeline(transaction=False)
+        for slot_id in slot_ids:
+            pipe.hget(_slot_key(slot_id), 'is_open')
+            pipe.hset(_slot_key(slot_id), 'is_open', 'False')
+            pipe.zrem(_slot_index_key('open_slots_set', slot_id), slot_id)
+        was_open = dict(zip(slot_ids, pipe.execute()[0::3]))
+
+        pipe = r.pipeline(transaction=not CLUSTER_MODE)
+        for slot_id, slot_data, bookings in _read_slots_with_bookings(slot_ids):
+            if 'work_date' in slot_data:
+                record = {
+                    'id': slot_id,
+                    'work_date': slot_data['work_date'],
+                    'slot_name': slot_data.get('slot_name'),
+                    'capacity': int(slot_data.get('capacity', 5)),
+                    'is_open': was_open[slot_id] == 'True',
+                    'bookings': bookings,
+                }
+                month = record['work_date'][:7]
+                pipe.hset(_archive_key(month), slot_id, _encode_archive(record))
+                pipe.sadd('archive_months', month)
+                archived += 1
+                for booking in bookings:
+                    pipe.zrem(_employee_slots_key(booking['employee_id']), slot_id)
+            for key in _slot_data_keys(slot_id): # Cluster Pipeline 的 DELETE 一次只能一個鍵
+                pipe.delete(key)
+            pipe.zrem(_slot_index_key('open_slots_set', slot_id), slot_id)
+            pipe.zrem(_slot_index_key('all_slots_set', slot_id), slot_id)
+            pipe.incr(_slot_index_key('slots_version', slot_id))
+        pipe.execute()
+
+def get_archive_months():
+    """獲取有封存資料的月份 (YYYY-MM，由舊到新)"""
+    return sorted(r.smembers('archive_months'))
+
+@metrics.timed
+def get_archived_slots(month):
+    """獲取某個月份 (YYYY-MM) 已封存的班別與報名名單 (依日期排序)"""
+    records = [_decode_archive(value) for value in r.hvals(_archive_key(month))]
+    records.sort(key=lambda record: (record['work_date'], record['id']))
+    return records
+
+def iter_archived_bookings(start_date=None, end_date=None):
+    """依日期順序逐筆產生已封存班別的報名資料 (一次只讀取一個月份)"""
+    for month in get_archive_months():
+        if (start_date and month < start_date[:7]) or (end_date and month > end_date[:7]):
+            continue
+        for record in get_archived_slots(month):
+            if (start_date and record['work_date'] < start_date) or (end_date and record['work_date'] > end_date):
+                continue
+            for booking in record['bookings']:
+                yield _booking_row(record['id'], record, booking)
+
+# --- 排隊報名 (Booking Queue) 相關功能 ---
+# 尖峰時段可改為「先排隊、再由 booking_worker.py 依序處理」，避免所有報名同時搶同一個班別
+
+BOOKING_STREAM = 'booking_requests'
+BOOKING_GROUP = 'booking_workers'
+BOOKING_STREAM_MAXLEN = 100000 # 約略保留的歷史請求數 (MAXLEN ~)
+BOOKING_TICKET_TTL = 3600 # 秒：報名結果保留時間
+
+def _ticket_key(ticket):
+    return f'booking_ticket:{ticket}'
+
+@metrics.timed
+def enqueue_booking(slot_id, work_date, slot_name, employee_id, employee_name, id_last_4):
+    """將報名請求加入 Stream 並立即返回 ticket (結果由 consumer 處理後寫入 booking_ticket:<ticket>)"""
+    ticket = secrets.token_urlsafe(12)
+    pipe = r.pipeline()
+    pipe.hset(_ticket_key(ticket), mapping={
+        'status': 'pending',
+        'slot_id': slot_id,
+        'work_date': work_date,
+        'slot_name': slot_name,
+        'name': employee_name,
+    })
+    pipe.expire(_ticket_key(ticket), BOOKING_TICKET_TTL)
+    pipe.xadd(BOOKING_STREAM, {
+        'ticket': ticket,
+        'slot_id': slot_id,
+        'employee_id': employee_id,
+        'name': employee_name,
+        'id_last_4': id_last_4,
+        'work_date': work_date,
+    }, maxlen=BOOKING_STREAM_MAXLEN, approximate=True)
+    pipe.execute()
+    return ticket
+
+@metrics.timed
+def get_booking_ticket(ticket):
+    """獲取排隊報名的處理狀態 (pending / success / failed)，ticket 不存在或已過期時返回 None"""
+    data = r.hgetall(_ticket_key(ticket))
+    return data or None
+
+@metrics.timed
+def get_booking_queue_length():
+    """獲取尚未被 consumer 讀取或尚未確認的報名請求數 (用於監控與負載控制)"""
+    try:
+        groups = r.xinfo_groups(BOOKING_STREAM)
+    except redis.exceptions.ResponseError:
+        return 0 # Stream 尚未建立
+    return sum((g.get('lag') or 0) + g['pending'] for g in groups if g['name'] == BOOKING_GROUP)
+
+def ensure_booking_group():
+    """建立 consumer group (Stream 不存在時一併建立；已存在則略過)"""
+    try:
+        r.xgroup_create(BOOKING_STREAM, BOOKING_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def _process_booking_messages(messages, reclaimed=False):
+    """
+    以單一 Pipeline 依到達順序執行報名腳本，寫回結果並 XACK。
+    reclaimed=True 表示這些請求曾被其他 consumer 讀取：對方可能在報名腳本成功後、XACK 前中斷，
+    重新執行時會得到 duplicate，此時員工確實已在名單中，因此視為報名成功 (處理結果可以安全地重複寫入)
+    """
+    if not messages:
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for _, fields in messages:
+        _book_slot_script(keys=_book_slot_keys(fields['slot_id'], fields['employee_id']),
+                          args=_book_slot_args(fields['slot_id'], fields['employee_id']),
+                          client=pipe)
+    results = pipe.execute(raise_on_error=False)
+
+    pipe = r.pipeline(transaction=False)
+    for (message_id, fields), result in zip(messages, results):
+        if isinstance(result, Exception):
+            status, message = 'failed', "系統忙碌，請重試報名。"
+            metrics.BOOKING_OUTCOMES.labels('error', 'queue').inc()
+        else:
+            if reclaimed and result == 'duplicate':
+                result = 'ok'
+            metrics.BOOKING_OUTCOMES.labels(result, 'queue').inc()
+            status, message = ('success' if result == 'ok' else 'failed'), BOOKING_MESSAGES[result]
+            if CLUSTER_MODE and result == 'ok' and fields.get('work_date'):
+                pipe.zadd(_employee_slots_key(fields['employee_id']), {fields['slot_id']: _date_int(fields['work_date'])})
+        pipe.hset(_ticket_key(fields['ticket']), mapping={'status': status, 'message': message})
+        # 重新設定 TTL，避免為已過期的 ticket 留下永久的 Hash
+        pipe.expire(_ticket_key(fields['ticket']), BOOKING_TICKET_TTL)
+        pipe.xack(BOOKING_STREAM, BOOKING_GROUP, message_id)
+    pipe.execute()
+    return len(messages)
+
+@metrics.timed
+def process_booking_requests(consumer, count=100, block_ms=5000):
+    """讀取並處理一批新的報名請求，返回處理筆數 (沒有請求時最多等待 block_ms 毫秒)"""
+    response = r.xreadgroup(BOOKING_GROUP, consumer, {BOOKING_STREAM: '>'}, count=count, block=block_ms)
+    if not response:
+        return 0
+    _, messages = response[0]
+    return _process_booking_messages(messages)
+
+@metrics.timed
+def reclaim_stale_booking_requests(consumer, min_idle_ms=30000, count=100):
+    """接手其他 consumer 讀取後超過 min_idle_ms 仍未確認的請求 (例如 worker 當機)，返回處理筆數"""
+    _, messages, _ = r.xautoclaim(BOOKING_STREAM, BOOKING_GROUP, consumer, min_idle_ms, count=count)
+    # 已被 Stream 修剪掉的訊息會以 (id, None) 返回，直接確認即可
+    for message_id, fields in messages:
+        if fields is None:
+            r.xack(BOOKING_STREAM, BOOKING_GROUP, message_id)
+    return _process_booking_messages([m for m in messages if m[1] is not None], reclaimed=True)
+
+# --- 請求限流 (Rate Limit) 相關功能 ---
+
+RATE_LIMIT_LUA = """
+-- KEYS: 每個限流規則一個 ratelimit:<scope>:<identity> (Sorted Set，member 為請求，score 為時間微秒)
+-- ARGV[1]: 此次請求的唯一 member；之後每個規則兩個參數：window_us, limit
+-- 滑動視窗：所有規則都未超過上限時才記錄此次請求；返回 0 或需等待的毫秒數 (取最大值)
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local retry_ms = 0
+for i, key in ipairs(KEYS) do
+    local window = tonumber(ARGV[i * 2])
+    local limit = tonumber(ARGV[i * 2 + 1])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    if redis.call('ZCARD', key) >= limit then
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        local wait = math.ceil((tonumber(oldest[2]) + window - now) / 1000)
+        retry_ms = math.max(retry_ms, wait, 1)
+    end
+end
+if retry_ms > 0 then
+    return retry_ms
+end
+for i, key in ipairs(KEYS) do
+    local window = tonumber(ARGV[i * 2])
+    redis.call('ZADD', key, now, ARGV[1])
+    redis.call('PEXPIRE', key, math.ceil(window / 1000))
+end
+return 0
+"""
+
+def _rate_limit_key(scope, identity):
+    return f'ratelimit:{scope}:{identity}'
+
+def _rate_limit_calls(rules):
+    """
+    組合 RATE_LIMIT_LUA 的呼叫列表 [(keys, args)]：通常只有一次呼叫；
+    Cluster 模式下各規則的鍵位於不同 hash slot，改為每個規則各一次 (未超過上限的規則仍會記錄此次請求，限制會稍微嚴格一些)
+    """
+    member = secrets.token_hex(8)
+    if CLUSTER_MODE:
+        return [([_rate_limit_key(scope, identity)], [member, int(window_seconds * 1000000), limit])
+                for scope, identity, limit, window_seconds in rules]
+
+    keys = []
+    args = [member]
+    for scope, identity, limit, window_seconds in rules:
+        keys.append(_rate_limit_key(scope, identity))
+        args.extend([int(window_seconds * 1000000), limit])
+    return [(keys, args)]
+
+@metrics.timed
+def check_rate_limit(rules):
+    """
+    以單次原子腳本檢查多個滑動視窗限流規則 (rules 為 (scope, identity, limit, window_seconds) 列表)。
+    全部通過時記錄此次請求並返回 0，否則不記錄並返回需等待的秒數。
+    """
+    if not rules:
+        return 0
+    calls = _rate_limit_calls(rules)
+    if len(calls) == 1:
+        keys, args = calls[0]
+        return _rate_limit_script(keys=keys, args=args) / 1000
+
+    pipe = r.pipeline(transaction=False)
+    for keys, args in calls:
+        _rate_limit_script(keys=keys, args=args, client=pipe)
+    return max(pipe.execute()) / 1000
 
 # --- 管理員 (Admin) 相關功能 ---
 
-def init_redis(redis_client):
-    """初始化 Redis 連線和預設資料"""
-    global r
+def run_migrations(lock=None):
+    """執行尚未套用的資料遷移 (以 schema_migrations Set 記錄已完成的項目；lock 為持有中的遷移鎖，每完成一項重新計時)"""
+    for name, migration in MIGRATIONS:
+        if r.sismember('schema_migrations', name):
+            continue
+        print(f"Redis 資料遷移：{name} ...")
+        migration()
+        r.sadd('schema_migrations', name)
+        if lock is not None:
+            lock.reacquire()
+
+def pending_migrations():
+    """尚未套用的資料遷移名稱 (預設資料尚未寫入時包含 'seed_defaults')，一次往返"""
+    names = [name for name, _ in MIGRATIONS]
+    pipe = r.pipeline(transaction=False)
+    pipe.smismember('schema_migrations', names)
+    pipe.exists('defaults_seeded')
+    applied, seeded = pipe.execute()
+    pending = [name for name, done in zip(names, applied) if not done]
+    return pending if seeded else pending + ['seed_defaults']
+
+def migrate():
+    """
+    執行資料遷移並寫入預設資料 (部署時以 python manage.py migrate 執行，不在 HTTP 請求中執行)。
+    同一時間只允許一個 process 執行，已有其他 process 在執行時直接失敗。
+    """
+    lock = r.lock('migration_lock', timeout=MIGRATION_LOCK_TIMEOUT, blocking_timeout=0)
+    if not lock.acquire():
+        raise redis.exceptions.LockError("其他 process 正在執行資料遷移")
+    try:
+        run_migrations(lock)
+        seed_defaults()
+    finally:
+        lock.release()
+
+def create_client(url=None, host='localhost', port=6379, password=None, db=0,
+                  max_connections=20, pool_timeout=5, socket_timeout=5,
+                  socket_connect_timeout=3, health_check_interval=30, cluster=False):
+    """建立使用有上限、可等待 (Blocking) 連線池的 Redis 客戶端；建立時不會實際連線"""
+    if cluster:
+        return _create_cluster_client(url, host, port, password, max_connections,
+                                      socket_timeout, socket_connect_timeout, health_check_interval)
+    pool_options = {
+        'max_connections': max_connections,
+        'timeout': pool_timeout,
+        'socket_timeout': socket_timeout,
+        'socket_connect_timeout': socket_connect_timeout,
+        'health_check_interval': health_check_interval,
+        'decode_responses': True,
+    }
+    if url:
+        pool = redis.BlockingConnectionPool.from_url(url, **pool_options)
+    else:
+        pool = redis.BlockingConnectionPool(host=host, port=port, password=password, db=db, **pool_options)
+    # 連線池會在 fork 後 (pid 改變時) 自動重建連線，gunicorn worker 之間不會共用 socket
+    # 客戶端會記錄每個指令 / Pipeline 的次數與延遲 (見 metrics.py)
+    return metrics.InstrumentedRedis(connection_pool=pool)
+
+def _create_cluster_client(url, host, port, password, max_connections,
+                           socket_timeout, socket_connect_timeout, health_check_interval):
+    """建立 Redis Cluster 客戶端 (url / host 為任一節點，其餘節點於第一次使用時自動探索)"""
+    options = {
+        'max_connections': max_connections, # 每個節點的連線數上限
+        'socket_timeout': socket_timeout,
+        'socket_connect_timeout': socket_connect_timeout,
+        'health_check_interval': health_check_interval,
+        'decode_responses': True,
+    }
+    if url:
+        return metrics.InstrumentedRedisCluster.from_url(url, **options)
+    return metrics.InstrumentedRedisCluster(host=host, port=port, password=password, **options)
+
+def init_redis(redis_client, replica_clients=(), replica_max_lag=2):
+    """
+    設定 Redis 客戶端並註冊 Lua 腳本 (不會連線；資料遷移與預設資料由 migrate 寫入)。
+    replica_clients 為唯讀副本的客戶端 (Cluster 模式不使用)，落後超過 replica_max_lag 秒時改讀主節點
+    """
+    global r, _book_slot_script, _book_slots_script, _cancel_booking_script, _create_employees_script, \
+        _rate_limit_script, _delete_slot_script, _touch_slot_script, _replica_heartbeat_script, _initialized, \
+        CLUSTER_MODE, _replicas, _replica_max_lag
     r = redis_client
-    
-    if not r.exists('admin_user:admin'):
-        print("Redis 初始化：載入預設資料...")
-        
-        # 創建預設的管理員帳號 (Super Admin & Viewer)
-        r.hset('admin_user:admin', mapping={'password': 'super', 'role': 'super'})
-        r.hset('admin_user:viewer', mapping={'password': 'view', 'role': 'viewer'})
-        
-        # 創建預設開放班別
-        today = datetime.date.today()
-        
-        slot_id_1 = secrets.token_urlsafe(8)
-        work_date_1 = (today + datetime.timedelta(days=1)).isoformat()
-        _create_slot_data(slot_id_1, work_date_1, '上午班 (08:00-12:00)', is_open=True, capacity=5)
-        
-        slot_id_2 = secrets.token_urlsafe(8)
-        work_date_2 = (today + datetime.timedelta(days=2)).isoformat()
-        _create_slot_data(slot_id_2, work_date_2, '下午班 (13:00-17:00)', is_open=True, capacity=10)
-        
-        slot_id_3 = secrets.token_urlsafe(8)
-        work_date_3 = (today + datetime.timedelta(days=3)).isoformat()
-        _create_slot_data(slot_id_3, work_date_3, '假日全天班 (09:00-17:00)', is_open=False, capacity=5)
-        
-        print("Redis 初始化完成。")
+    CLUSTER_MODE = isinstance(redis_client, redis.RedisCluster)
+    _replicas = [] if CLUSTER_MODE else [_new_replica_state(client) for client in replica_clients]
+    _replica_max_lag = replica_max_lag
+    _book_slot_script = r.register_script(BOOK_SLOT_LUA)
+    _book_slots_script = r.register_script(BOOK_SLOTS_LUA)
+    _cancel_booking_script = r.register_script(CANCEL_BOOKING_LUA)
+    _create_employees_script = r.register_script(CREATE_EMPLOYEES_LUA)
+    _rate_limit_script = r.register_script(RATE_LIMIT_LUA)
+    _delete_slot_script = r.register_script(DELETE_SLOT_LUA)
+    _touch_slot_script = r.register_script(TOUCH_SLOT_LUA)
+    _replica_heartbeat_script = r.register_script(REPLICA_HEARTBEAT_LUA)
+    _initialized = False
+
+def ensure_initialized():
+    """
+    確認資料遷移與預設資料都已套用 (一次往返，確認後每個 process 不再檢查)；
+    尚未套用時拋出 MigrationRequiredError，不會在請求中執行遷移
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        pending = pending_migrations()
+        if pending:
+            raise MigrationRequiredError(f"尚未套用的資料遷移：{', '.join(pending)}，請先執行 python manage.py migrate")
+        if CLUSTER_MODE:
+            # Cluster Pipeline 內的 EVALSHA 不會自動載入腳本，先載入到所有主節點
+            for script in (_book_slot_script, _book_slots_script, _cancel_booking_script,
+                           _create_employees_script, _rate_limit_script, _delete_slot_script, _touch_slot_script):
+                r.script_load(script.script)
+        _initialized = True
+
+def seed_defaults():
+    """寫入預設管理員帳號與班別 (只會執行一次，由 migrate 在遷移鎖內呼叫)"""
+    if r.exists('defaults_seeded'):
+        return
+    if r.exists('admin_user:admin'): # 既有資料庫：只補上標記
+        r.set('defaults_seeded', '1')
+        return
+
+    print("Redis 初始化：載入預設資料...")
+    # 標記與預設資料在同一個交易內寫入，中途失敗時兩者都不會生效，下次 migrate 會重新寫入
+    pipe = r.pipeline(transaction=not CLUSTER_MODE)
+
+    # 創建預設的管理員帳號 (Super Admin & Viewer)
+    pipe.hset('admin_user:admin', mapping={'password': 'super', 'role': 'super'})
+    pipe.hset('admin_user:viewer', mapping={'password': 'view', 'role': 'viewer'})
+
+    # 創建預設開放班別
+    today = datetime.date.today()
 
+    slot_id_1 = secrets.token_urlsafe(8)
+    work_date_1 = (today + datetime.timedelta(days=1)).isoformat()
+    _create_slot_data(slot_id_1, work_date_1, '上午班 (08:00-12:00)', is_open=True, capacity=5, pipe=pipe)
 
+    slot_id_2 = secrets.token_urlsafe(8)
+    work_date_2 = (today + datetime.timedelta(days=2)).isoformat()
+    _create_slot_data(slot_id_2, work_date_2, '下午班 (13:00-17:00)', is_open=True, capacity=10, pipe=pipe)
+
+    slot_id_3 = secrets.token_urlsafe(8)
+    work_date_3 = (today + datetime.timedelta(days=3)).isoformat()
+    _create_slot_data(slot_id_3, work_date_3, '假日全天班 (09:00-17:00)', is_open=False, capacity=5, pipe=pipe)
+
+    if not CLUSTER_MODE:
+        pipe.set('defaults_seeded', '1')
+    pipe.execute()
+    if CLUSTER_MODE:
+        # 各鍵位於不同 hash slot，無法放進同一個交易：預設資料全部寫入後才設定標記
+        r.set('defaults_seeded', '1')
+    print("Redis 初始化完成。")
+
+
+@metrics.timed
 def get_admin_user(username):
     """根據使用者名稱獲取管理員資料"""
     key = f'admin_user:{username}'
@@ -348,6 +2021,7 @@ def get_admin_user(username):
         return {'username': username, 'password': user_data.get('password'), 'role': user_data.get('role')}
     return None
 
+@metrics.timed
 def create_admin_user(username, password, role):
     """新增管理員帳號"""
     key = f'admin_user:{username}'
@@ -357,6 +2031,7 @@ def create_admin_user(username, password, role):
     r.hset(key, mapping={'password': password, 'role': role})
     return True
 
+@metrics.timed
 def update_admin_password(username, new_password):
     """更新管理員密碼"""
     key = f'admin_user:{username}'
@@ -365,6 +2040,19 @@ def update_admin_password(username, new_password):
         return True
     return False
 
+# --- 資料遷移 ---
+# (名稱, 函式)：依序執行，每個遷移都必須可以安全地重複執行
+MIGRATIONS = [
+    ('employee_lookup', backfill_employee_lookup),
+    ('slot_registry', backfill_slot_registry),
+    ('booking_memory_baseline', record_booking_memory_baseline),
+    ('booking_roster', migrate_booking_lists),
+    ('compact_bookings', compact_booking_storage),
+    ('employee_slots', backfill_employee_slots),
+    ('hash_tagged_keys', migrate_to_hash_tagged_keys),
+    ('employee_search_index', backfill_employee_search_index),
+]
+
 # ----------------------------------------------------------------------
 # 以下為管理員驗證碼，用於註冊時判斷權限
 SUPER_ADMIN_CODE = '7726a9c1-58e1-4c4f-9e2e-2e0f8073b64c'
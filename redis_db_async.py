@@ -0,0 +1,385 @@
+# redis_db_async.py
+# redis_db 的非同步版本 (redis.asyncio)，供 ASGI 入口 (asgi.py) 使用。
+# 鍵命名規範、Lua 腳本與資料轉換全部沿用 redis_db，兩邊讀寫的資料格式完全相同。
+
+import asyncio
+import datetime
+import itertools
+import time
+
+import redis
+import redis.asyncio as aioredis
+
+import metrics
+import redis_db as db
+
+# 全域非同步 Redis 客戶端變數
+r = None
+# 已註冊的 Lua 腳本 (於 init_redis 時建立)
+_book_slot_script = None
+_book_slots_script = None
+_cancel_booking_script = None
+_create_employees_script = None
+_rate_limit_script = None
+_replica_heartbeat_script = None
+# 唯讀副本 (與 redis_db 相同的規則與心跳鍵)
+_replicas = []
+_replica_counter = itertools.count()
+_replica_max_lag = 2
+_replica_heartbeat_task = None
+
+# 首頁開放班別快取 (與 redis_db 相同的規則，但每個 event loop process 各自一份)
+_open_slots_cache = {'version': None, 'expires_at': 0, 'slots': None}
+
+
+def create_client(url=None, host='localhost', port=6379, password=None, db=0,
+                  max_connections=100, pool_timeout=5, socket_timeout=5,
+                  socket_connect_timeout=3, health_check_interval=30, cluster=False):
+    """建立使用有上限、可等待 (Blocking) 連線池的非同步 Redis 客戶端；建立時不會實際連線"""
+    if cluster:
+        # Redis Cluster：url / host 為任一節點，max_connections 為每個節點的連線上限
+        cluster_options = {
+            'max_connections': max_connections,
+            'socket_timeout': socket_timeout,
+            'socket_connect_timeout': socket_connect_timeout,
+            'health_check_interval': health_check_interval,
+            'decode_responses': True,
+        }
+        if url:
+            return aioredis.RedisCluster.from_url(url, **cluster_options)
+        return aioredis.RedisCluster(host=host, port=port, password=password, **cluster_options)
+    pool_options = {
+        'max_connections': max_connections,
+        'timeout': pool_timeout,
+        'socket_timeout': socket_timeout,
+        'socket_connect_timeout': socket_connect_timeout,
+        'health_check_interval': health_check_interval,
+        'decode_responses': True,
+    }
+    if url:
+        pool = aioredis.BlockingConnectionPool.from_url(url, **pool_options)
+    else:
+        pool = aioredis.BlockingConnectionPool(host=host, port=port, password=password, db=db, **pool_options)
+    return aioredis.Redis(connection_pool=pool)
+
+def init_redis(redis_client, replica_clients=(), replica_max_lag=2):
+    """設定非同步 Redis 客戶端並註冊 Lua 腳本 (資料遷移與預設資料仍由 redis_db.ensure_initialized 負責)"""
+    global r, _book_slot_script, _book_slots_script, _cancel_booking_script, _create_employees_script, \
+        _rate_limit_script, _replica_heartbeat_script, _replicas, _replica_max_lag
+    r = redis_client
+    cluster = isinstance(redis_client, aioredis.RedisCluster)
+    _replicas = [] if cluster else [db._new_replica_state(client) for client in replica_clients]
+    _replica_max_lag = replica_max_lag
+    _book_slot_script = r.register_script(db.BOOK_SLOT_LUA)
+    _book_slots_script = r.register_script(db.BOOK_SLOTS_LUA)
+    _cancel_booking_script = r.register_script(db.CANCEL_BOOKING_LUA)
+    _create_employees_script = r.register_script(db.CREATE_EMPLOYEES_LUA)
+    _rate_limit_script = r.register_script(db.RATE_LIMIT_LUA)
+    _replica_heartbeat_script = r.register_script(db.REPLICA_HEARTBEAT_LUA)
+
+async def close():
+    """關閉主節點與所有 replica 的連線池 (ASGI lifespan shutdown 時呼叫)"""
+    if _replica_heartbeat_task is not None:
+        _replica_heartbeat_task.cancel()
+    for client in [r] + [replica['client'] for replica in _replicas]:
+        await client.aclose()
+
+async def _check_replica(replica, now):
+    """更新 replica 的落後時間與可用狀態 (同 redis_db._check_replica)"""
+    try:
+        heartbeat = await replica['client'].get(db.REPLICA_HEARTBEAT_KEY)
+        lag = db._replica_lag(heartbeat, await r.time())
+    except redis.RedisError:
+        lag = None
+    replica['lag'] = lag
+    replica['healthy'] = replica['lag'] is not None and replica['lag'] <= _replica_max_lag
+    replica['checked_at'] = now
+
+async def _write_replica_heartbeat():
+    """背景 task：定期把主節點的 TIME 寫入心跳 (同 redis_db._write_replica_heartbeat)"""
+    while True:
+        try:
+            await _replica_heartbeat_script(keys=[db.REPLICA_HEARTBEAT_KEY])
+        except redis.RedisError:
+            pass
+        await asyncio.sleep(db.REPLICA_HEARTBEAT_INTERVAL)
+
+async def _pick_replica():
+    """輪流選擇一個可用的 replica，都不可用時返回 None"""
+    global _replica_heartbeat_task
+    if not _replicas:
+        return None
+    if _replica_heartbeat_task is None or _replica_heartbeat_task.done():
+        _replica_heartbeat_task = asyncio.get_running_loop().create_task(_write_replica_heartbeat())
+    now = time.monotonic()
+    start = next(_replica_counter)
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        if now - replica['checked_at'] >= db.REPLICA_CHECK_INTERVAL:
+            await _check_replica(replica, now)
+        if replica['healthy']:
+            return replica
+    return None
+
+async def _read(func, replica=True):
+    """以 await func(client) 執行唯讀操作：replica=True 時優先使用可用的 replica，讀取失敗時改用主節點"""
+    chosen = await _pick_replica() if replica else None
+    if chosen is not None:
+        try:
+            result = await func(chosen['client'])
+            metrics.REDIS_REPLICA_READS.labels('replica').inc()
+            return result
+        except (redis.ConnectionError, redis.TimeoutError):
+            chosen['healthy'] = False
+    if replica and _replicas:
+        metrics.REDIS_REPLICA_READS.labels('primary').inc()
+    return await func(r)
+
+async def _index_range(name, min_score='-inf', max_score='+inf', client=None):
+    """以單一 Pipeline 讀取所有分片的索引並依日期合併 (同 redis_db._index_range)"""
+    pipe = (client or r).pipeline(transaction=False)
+    for key in db._shard_keys(name):
+        pipe.zrangebyscore(key, min_score, max_score, withscores=True)
+    return [slot_id for slot_id, _ in db._merge_index_results(await pipe.execute())]
+
+async def _slots_version(client=None):
+    """所有分片的版本號 (同 redis_db._slots_version)"""
+    pipe = (client or r).pipeline(transaction=False)
+    for key in db._shard_keys('slots_version'):
+        pipe.get(key)
+    return tuple(await pipe.execute())
+
+# --- 員工 (Employee) 相關功能 ---
+
+async def create_employee(name, id_full, phone):
+    """註冊新員工，返回 employee_id (與 redis_db.create_employee 使用同一個原子 Lua 腳本)"""
+    employee_ids, keys, args = db._create_employees_call([(name, id_full, phone)])
+    result = (await _create_employees_script(keys=keys, args=args))[0]
+    return employee_ids[0] if result == 1 else None, db.CREATE_EMPLOYEE_MESSAGES[result]
+
+async def get_employee_by_info(name, id_last_4):
+    """透過姓名和身分證後四碼查找員工 ID (使用 employee_lookup 索引)"""
+    employee_id = await r.hget(db.EMPLOYEE_LOOKUP_KEY, db._employee_lookup_field(name, id_last_4))
+    if not employee_id:
+        return None, None
+
+    employee_data = await r.hgetall(db._employee_key(employee_id))
+    if not employee_data:
+        return None, None
+
+    return employee_id, employee_data
+
+async def _get_employee_map(employee_ids, client=None):
+    """以單一 Pipeline 讀取多位員工的姓名/身分證，返回 employee_id -> [name, id_full]"""
+    if not employee_ids:
+        return {}
+    pipe = (client or r).pipeline(transaction=False)
+    unique_ids = db._queue_employee_lookups(pipe, employee_ids)
+    return dict(zip(unique_ids, await pipe.execute()))
+
+# --- 班別 (Slot) 相關功能 ---
+
+async def get_slot_by_id(slot_id, replica=False):
+    """獲取單個班別的詳細資訊，包含報名人數 (報名流程使用預設的主節點)"""
+    async def read(client):
+        pipe = client.pipeline()
+        pipe.hgetall(db._slot_key(slot_id))
+        pipe.zcard(db._slot_key(slot_id, 'roster'))
+        return await pipe.execute()
+
+    slot_hash, count = await _read(read, replica)
+    if not slot_hash:
+        return None
+
+    return db._parse_slot(slot_id, slot_hash, count)
+
+async def get_all_slots(replica=True):
+    """獲取所有班別的詳細資訊與報名名單 (依日期排序，預設從 replica 讀取)"""
+    return await _read(_read_all_slots, replica)
+
+async def _read_all_slots(client):
+    slot_ids = await _index_range('all_slots_set', client=client)
+    if not slot_ids:
+        return []
+
+    pipe = client.pipeline(transaction=False)
+    for slot_id in slot_ids:
+        pipe.hgetall(db._slot_key(slot_id))
+        pipe.zrange(db._slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+    results = await pipe.execute()
+
+    rosters = results[1::2]
+    employee_map = await _get_employee_map([e for roster in rosters for e, _ in roster], client)
+
+    all_slots = []
+    for slot_id, slot_data, roster in zip(slot_ids, results[0::2], rosters):
+        if slot_data:
+            slot = db._parse_slot(slot_id, slot_data, len(roster))
+            slot['bookings'] = db._parse_bookings(roster, employee_map)
+            all_slots.append(slot)
+    return all_slots
+
+async def get_open_slots(replica=True):
+    """獲取目前開放報名的班別，並按日期排序 (預設從 replica 讀取)"""
+    return await _read(_read_open_slots, replica)
+
+async def _read_open_slots(client):
+    slot_ids = await _index_range('open_slots_set', db._today_score(), client=client)
+    if not slot_ids:
+        return []
+
+    pipe = client.pipeline(transaction=False)
+    for slot_id in slot_ids:
+        pipe.hgetall(db._slot_key(slot_id))
+        pipe.zcard(db._slot_key(slot_id, 'roster'))
+    results = await pipe.execute()
+
+    open_slots = []
+    for i, slot_id in enumerate(slot_ids):
+        slot_data, count = results[i * 2:i * 2 + 2]
+        if slot_data:
+            slot = db._parse_slot(slot_id, slot_data, count)
+            if slot['is_open']:
+                open_slots.append(slot)
+    return open_slots
+
+async def get_open_slots_cached(replica=True):
+    """獲取開放班別 (優先使用 process 內快取，只在 slots_version 改變或 TTL 過期時重新讀取)"""
+    return await _read(_read_open_slots_cached, replica)
+
+async def _read_open_slots_cached(client):
+    # 版本與資料從同一個節點讀取
+    version = await _slots_version(client)
+    now = time.monotonic()
+
+    if (_open_slots_cache['slots'] is not None
+            and _open_slots_cache['version'] == version
+            and now < _open_slots_cache['expires_at']):
+        return _open_slots_cache['slots']
+
+    slots = await _read_open_slots(client)
+    _open_slots_cache['version'] = version
+    _open_slots_cache['expires_at'] = now + db.OPEN_SLOTS_CACHE_TTL
+    _open_slots_cache['slots'] = slots
+    return slots
+
+# --- 報名 (Booking) 相關功能 ---
+
+async def get_bookings_for_slot(slot_id, replica=True):
+    """獲取所有報名名單 (依 roster 的報名順序排列，姓名以 Pipeline 從員工資料取得，預設從 replica 讀取)"""
+    async def read(client):
+        roster = await client.zrange(db._slot_key(slot_id, 'roster'), 0, -1, withscores=True)
+        return db._parse_bookings(roster, await _get_employee_map([e for e, _ in roster], client))
+    return await _read(read, replica)
+
+async def get_booking(slot_id, employee_id):
+    """獲取單筆報名資料，不存在時返回 None"""
+    pipe = r.pipeline(transaction=False)
+    pipe.zscore(db._slot_key(slot_id, 'roster'), employee_id)
+    pipe.hmget(db._employee_key(employee_id), 'name', 'id_full')
+    score, employee = await pipe.execute()
+    if score is None:
+        return None
+    return db._parse_bookings([(employee_id, score)], {employee_id: employee})[0]
+
+async def add_booking(slot_id, work_date, employee_id, employee_name, id_last_4):
+    """新增報名記錄 (與 redis_db.add_booking 使用同一個原子 Lua 腳本)"""
+    result = await _book_slot_script(keys=db._book_slot_keys(slot_id, employee_id),
+                                     args=db._book_slot_args(slot_id, employee_id))
+    metrics.BOOKING_OUTCOMES.labels(result, 'direct').inc()
+    if db.CLUSTER_MODE and result == 'ok':
+        await r.zadd(db._employee_slots_key(employee_id), {slot_id: db._date_int(work_date)})
+    return result == 'ok', db.BOOKING_MESSAGES[result]
+
+async def add_bookings(slot_ids, employee_id, all_or_nothing=True):
+    """一次報名多個班別 (同 redis_db.add_bookings；Cluster 模式下各分片的腳本同時執行)"""
+    slot_ids = list(dict.fromkeys(slot_ids))
+    if not slot_ids:
+        return []
+
+    calls = db._book_slots_calls(slot_ids, employee_id, all_or_nothing)
+    replies = await asyncio.gather(*(_book_slots_script(keys=keys, args=args) for _, keys, args in calls))
+
+    results, rollback, employee_slots = db._book_slots_results(slot_ids, calls, replies, all_or_nothing)
+    await asyncio.gather(*(_cancel_booking_script(keys=db._cancel_booking_keys(slot_id, employee_id),
+                                                  args=db._cancel_booking_args(slot_id, employee_id))
+                           for slot_id in rollback))
+    if employee_slots:
+        await r.zadd(db._employee_slots_key(employee_id), employee_slots)
+    return results
+
+async def delete_booking(slot_id, employee_id):
+    """刪除特定報名者"""
+    deleted = await _cancel_booking_script(keys=db._cancel_booking_keys(slot_id, employee_id),
+                                           args=db._cancel_booking_args(slot_id, employee_id))
+    if db.CLUSTER_MODE and deleted == 1:
+        await r.zrem(db._employee_slots_key(employee_id), slot_id)
+    return deleted == 1
+
+async def get_employee_shifts(employee_id, from_date=None):
+    """同 redis_db.get_employee_shifts：員工日期在 from_date 以後的班別 (固定兩次往返)"""
+    from_date = from_date or datetime.date.today().isoformat()
+    slot_ids = await r.zrangebyscore(db._employee_slots_key(employee_id), db._date_int(from_date), '+inf')
+    if not slot_ids:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for slot_id in slot_ids:
+        pipe.hgetall(db._slot_key(slot_id))
+        pipe.zscore(db._slot_key(slot_id, 'roster'), employee_id)
+        pipe.zcard(db._slot_key(slot_id, 'roster'))
+    results = await pipe.execute()
+
+    shifts = []
+    for slot_id, slot_data, score, count in zip(slot_ids, results[0::3], results[1::3], results[2::3]):
+        if slot_data and score is not None:
+            slot = db._parse_slot(slot_id, slot_data, count)
+            slot['booking_time'] = db._format_booking_time(score)
+            shifts.append(slot)
+    return shifts
+
+# --- 限流與負載控制 ---
+
+async def check_rate_limit(rules):
+    """同 redis_db.check_rate_limit：全部規則通過時記錄此次請求並返回 0，否則返回需等待的秒數"""
+    if not rules:
+        return 0
+    calls = db._rate_limit_calls(rules)
+    start = time.perf_counter()
+    retry_ms = await asyncio.gather(*(_rate_limit_script(keys=keys, args=args) for keys, args in calls))
+    # 非同步客戶端沒有經過 metrics.InstrumentedRedis，以限流腳本的往返時間更新延遲平均 (供負載控制使用)
+    metrics._record(time.perf_counter() - start, len(calls), single=len(calls) == 1)
+    return max(retry_ms) / 1000
+
+async def get_booking_queue_length():
+    """同 redis_db.get_booking_queue_length"""
+    try:
+        groups = await r.xinfo_groups(db.BOOKING_STREAM)
+    except redis.exceptions.ResponseError:
+        return 0 # Stream 尚未建立
+    return sum((g.get('lag') or 0) + g['pending'] for g in groups if g['name'] == db.BOOKING_GROUP)
+
+# --- 管理員 (Admin) 相關功能 ---
+
+async def get_admin_user(username):
+    """根據使用者名稱獲取管理員資料"""
+    user_data = await r.hgetall(f'admin_user:{username}')
+    if user_data:
+        return {'username': username, 'password': user_data.get('password'), 'role': user_data.get('role')}
+    return None
+
+async def create_admin_user(username, password, role):
+    """新增管理員帳號"""
+    key = f'admin_user:{username}'
+    if await r.exists(key):
+        return False
+    await r.hset(key, mapping={'password': password, 'role': role})
+    return True
+
+async def update_admin_password(username, new_password):
+    """更新管理員密碼"""
+    key = f'admin_user:{username}'
+    if await r.exists(key):
+        await r.hset(key, 'password', new_password)
+        return True
+    return False
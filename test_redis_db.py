@@ -0,0 +1,186 @@
+# test_redis_db.py
+"""
+redis_db 的回歸測試 (以 fakeredis 執行 Lua 腳本，不需要 Redis 伺服器)
+
+用法：
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+
+import datetime
+import time
+
+import fakeredis
+import pytest
+import redis
+
+import metrics
+import redis_db as db
+
+
+@pytest.fixture
+def client():
+    """使用 metrics.InstrumentedRedis 的 fakeredis 客戶端 (每個測試一個獨立的伺服器)"""
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer(),
+                                decode_responses=True)
+    client = metrics.InstrumentedRedis(connection_pool=pool)
+    db.init_redis(client)
+    db.migrate()
+    return client
+
+
+def _add_slots(count, bookings_per_slot=2):
+    """新增 count 個明天的開放班別，每個班別有 bookings_per_slot 位報名者"""
+    work_date = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    for _ in range(count):
+        slot_id = db.add_slot(work_date, "測試班", True, bookings_per_slot + 1)
+        for _ in range(bookings_per_slot):
+            id_full = f"A{db.secrets.randbelow(10 ** 9):09d}"
+            name = f"測試員{id_full}"
+            employee_id, _ = db.create_employee(name, id_full, "0900")
+            if employee_id:
+                db.add_booking(slot_id, work_date, employee_id, name, id_full[-4:])
+
+
+def _redis_usage(func):
+    """執行 func 並返回其 Redis 使用量 {'roundtrips', 'commands', 'seconds'}"""
+    metrics.start_request()
+    func()
+    return metrics.finish_request('test')
+
+
+# (函式, 固定的往返次數)：與班別數、報名數無關
+LISTING_ROUNDTRIPS = [
+    (db.get_open_slots, 2),  # 索引 + 班別/人數
+    (db.get_all_slots, 3),   # 索引 + 班別/名單 + 報名者姓名
+    (lambda: db.get_slots_page(count=20), 2),  # 索引分頁 + 班別/人數
+]
+
+@pytest.mark.parametrize('func, roundtrips', LISTING_ROUNDTRIPS)
+def test_listing_roundtrips_do_not_grow_with_slots(client, func, roundtrips):
+    _add_slots(3)
+    small = _redis_usage(func)
+    _add_slots(30)
+    large = _redis_usage(func)
+
+    assert small['roundtrips'] == large['roundtrips'] == roundtrips
+
+
+def test_open_slots_commands_per_slot(client):
+    """每多一個班別只多 2 個指令 (HGETALL + ZCARD)，而且都在同一個 Pipeline 內"""
+    before = _redis_usage(db.get_open_slots)
+    _add_slots(10)
+    after = _redis_usage(db.get_open_slots)
+    assert after['commands'] - before['commands'] == 10 * 2
+
+
+@pytest.fixture
+def cluster_client(client, monkeypatch):
+    """模擬 Cluster 模式：Cluster Pipeline 的 DELETE 一次只能一個鍵 (redis-py ClusterPipeline 的限制)"""
+    delete = redis.client.Pipeline.delete
+
+    def single_key_delete(self, *names):
+        if len(names) != 1:
+            raise redis.exceptions.RedisClusterException("deleting multiple keys is not implemented in pipeline command")
+        return delete(self, *names)
+
+    monkeypatch.setattr(redis.client.Pipeline, 'delete', single_key_delete)
+    monkeypatch.setattr(db, 'CLUSTER_MODE', True)
+    client.delete('schema_migrations')
+    return client
+
+
+def test_cluster_migrations_and_archive(cluster_client):
+    db.run_migrations()
+    slot_id = db.add_slot('2020-01-05', "測試班", True, 3)
+    employee_id, _ = db.create_employee("測試員", "A123456789", "0900")
+    db.add_booking(slot_id, '2020-01-05', employee_id, "測試員", "6789")
+
+    assert db.archive_slots('2020-02-01') == 1
+    assert db.get_slot_by_id(slot_id) is None
+    assert [record['id'] for record in db.get_archived_slots('2020-01')] == [slot_id]
+
+
+def test_requests_fail_fast_until_migrated():
+    """請求只檢查遷移狀態：尚未執行 migrate 時拋出 MigrationRequiredError，不會在請求中遷移"""
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer(),
+                                decode_responses=True)
+    db.init_redis(redis.Redis(connection_pool=pool))
+    with pytest.raises(db.MigrationRequiredError):
+        db.ensure_initialized()
+    assert not db.r.exists('schema_migrations')
+
+    db.migrate()
+    db.ensure_initialized()
+    assert db.pending_migrations() == []
+
+
+def test_seed_defaults_writes_flag_with_data(client, monkeypatch):
+    """預設資料寫入失敗時不留下 defaults_seeded 標記，下次 migrate 會重新寫入"""
+    client.flushall()
+
+    def fail(self, raise_on_error=True):
+        raise redis.ConnectionError("connection lost")
+
+    with monkeypatch.context() as m:
+        m.setattr(redis.client.Pipeline, 'execute', fail)
+        with pytest.raises(redis.ConnectionError):
+            db.seed_defaults()
+    assert not client.exists('defaults_seeded')
+
+    db.seed_defaults()
+    assert client.exists('defaults_seeded') and client.exists('admin_user:admin')
+
+
+def test_replica_lag_ignores_app_host_clock(client, monkeypatch):
+    """心跳與比較都使用主節點的 TIME：應用程式主機的時鐘偏差不影響落後時間"""
+    class SkewedClock:
+        monotonic = staticmethod(time.monotonic)
+        sleep = staticmethod(time.sleep)
+
+        @staticmethod
+        def time():
+            return time.time() + 3600
+
+    monkeypatch.setattr(db, 'time', SkewedClock)
+    db._replica_heartbeat_script(keys=[db.REPLICA_HEARTBEAT_KEY])
+    replica = db._new_replica_state(client)
+    db._check_replica(replica, time.monotonic())
+    assert replica['healthy'] and 0 <= replica['lag'] < 1
+
+
+def test_employee_lookup_collision_is_rejected(client):
+    """姓名與身分證後四碼相同的第二位員工不可註冊，也不可改名成相同的組合 (否則第一位員工無法報名)"""
+    first_id, _ = db.create_employee("王小明", "A100001234", "0900")
+    second_id, message = db.create_employee("王小明", "B200001234", "0911")
+    assert second_id is None and message == db.CREATE_EMPLOYEE_MESSAGES[2]
+    assert db.get_employee_by_info("王小明", "1234")[0] == first_id
+
+    rows = [{'name': "王小明", 'id_full': "C300001234", 'phone': "0922"},
+            {'name': "李小華", 'id_full': "D400005678", 'phone': "0933"},
+            {'name': "李小華", 'id_full': "E500005678", 'phone': "0944"}]
+    results = list(db.import_employees(rows))
+    assert [employee_id is not None for _, employee_id, _ in results] == [False, True, False]
+
+    other_id, _ = db.create_employee("陳大文", "F600001234", "0955")
+    assert db.update_employee(other_id, "王小明", "0955") == (False, db.CREATE_EMPLOYEE_MESSAGES[2])
+    assert db.get_employee_by_info("王小明", "1234")[0] == first_id
+    assert db.update_employee(first_id, "王小明", "0999") == (True, "更新成功")
+
+
+def test_reclaimed_booking_after_crash_reports_success(client):
+    """consumer 在報名腳本成功後、XACK 前中斷：接手的 consumer 重新執行時 ticket 仍為成功"""
+    work_date = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    slot_id = db.add_slot(work_date, "測試班", True, 3)
+    employee_id, _ = db.create_employee("測試員", "A123456789", "0900")
+    db.ensure_booking_group()
+    ticket = db.enqueue_booking(slot_id, work_date, "測試班", employee_id, "測試員", "6789")
+
+    # 第一個 consumer 讀取並完成報名，但在寫回結果與 XACK 之前中斷
+    _, messages = client.xreadgroup(db.BOOKING_GROUP, 'crashed', {db.BOOKING_STREAM: '>'})[0]
+    fields = messages[0][1]
+    assert db.add_booking(slot_id, work_date, employee_id, fields['name'], fields['id_last_4'])[0]
+
+    assert db.reclaim_stale_booking_requests('other', min_idle_ms=0) == 1
+    assert db.get_booking_ticket(ticket)['status'] == 'success'
+    assert db.get_booking_queue_length() == 0